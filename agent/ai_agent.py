@@ -1,16 +1,48 @@
 from videosdk import MeetingConfig, VideoSDK, MeetingEventHandler, Meeting, PubSubSubscribeConfig, PubSubPublishConfig, ParticipantEventHandler, Participant
 import asyncio
+from contextlib import aclosing
 import json
-from intelligence.intelligence import OpenAiIntelligence
+import logging
+import time
+from typing import Callable, Optional
+from intelligence.intelligence import OpenAiIntelligence, MOVE_COMMENT
+from intelligence.memory import ConversationMemory
+from intelligence.move_parser import parse_spoken_move
 from tts.elevenlabs import ElevenLabsTTS
+from tts.scheduler import CHAT, MOVE
 from agent.audio_stream_track import CustomAudioStreamTrack
 from videosdk.stream import MediaStreamTrack
-from stt.deepgram import DeepgramSTT
+from stt.deepgram import DeepgramSTT, STT_BATCH_MS, STT_SAMPLE_RATE
+from stt.vad import SPEECH_END, SPEECH_START
+from game.board import GameState
+from game.sync import StateSync, RESYNC
+from agent.speculation import MoveSpeculator, SPECULATE_MOVES, branch_result
+from agent.command_queue import Command, CommandQueue, RESET
+from agent.recorder import SessionRecorder
+import os
+from agent import tracing
+from agent.tracing import current_turn, start_turn
+
+logger = logging.getLogger(__name__)
+
+# speak llm replies sentence by sentence while they are generated
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "true").lower() == "true"
+# stop speaking when a player talks over the agent, after they kept talking
+# for the grace window (keep it at least STT_BATCH_MS to ignore coughs);
+# without the local VAD, once deepgram transcribed their first words
+BARGE_IN = os.getenv("BARGE_IN", "true").lower() == "true"
+BARGE_IN_GRACE_MS = int(os.getenv("BARGE_IN_GRACE_MS", "40"))
+
+# a move the player asked for by voice, published by the agent once applied
+SPOKEN_MOVE = "spoken_move"
 
 class AIAgent:
-    def __init__(self, meeting_id: str, authToken: str, name: str):
+    def __init__(self, meeting_id: str, authToken: str, name: str, on_leave: Optional[Callable[[], None]] = None):
         # 2
         self.loop = asyncio.get_running_loop()
+        self.meeting_id = meeting_id
+        self.on_leave = on_leave
+        self.event_handler = None
         self.audio_track = CustomAudioStreamTrack(
             loop=self.loop,
             handle_interruption=True
@@ -32,115 +64,189 @@ class AIAgent:
         
     async def join(self):
         # 3
-        self.ai_agent.add_event_listener(GameEventHandler(agent=self.ai_agent, audio_track=self.audio_track, loop=self.loop))
+        self.event_handler = GameEventHandler(agent=self.ai_agent, audio_track=self.audio_track, loop=self.loop, on_leave=self.on_leave,
+                                              session_id=self.meeting_id)
+        self.ai_agent.add_event_listener(self.event_handler)
         await self.ai_agent.async_join()
     
     def leave(self):
+        if self.event_handler is not None:
+            self.event_handler.close()
         self.ai_agent.leave()
+        self.audio_track.stop()
+
+    def stats(self) -> dict:
+        stats = {"buffered_frames": self.audio_track.buffered_frames()}
+        stats.update(self.audio_track.pacing_stats())
+        if self.event_handler is not None:
+            stats.update(self.event_handler.stats())
+        return stats
     
 class GameEventHandler(MeetingEventHandler):
-    def __init__(self, agent: Meeting, audio_track: MediaStreamTrack, loop: asyncio.AbstractEventLoop):
+    def __init__(self, agent: Meeting, audio_track: MediaStreamTrack, loop: asyncio.AbstractEventLoop, on_leave: Optional[Callable[[], None]] = None,
+                 session_id: str = ""):
         super().__init__()
         self.loop = loop
+        # labels this meeting's latency metrics
+        self.session_id = session_id
+        self.on_leave = on_leave
         self.agent = agent
         self.pubsub_topic = "GAME_MOVES"
         self.openai_client = OpenAiIntelligence()
-        self.game_state = {
-            "board": [None]*9,
-            "current_player": "X",
-            "winner": None,
-            "game_over": False
-        }
+        # what was said in this meeting, kept across games
+        self.memory = ConversationMemory(summarize=self.openai_client.summarize_conversation)
+        self.game_state = GameState()
+        self.sync = StateSync(self.game_state)
+        # moves and resets are applied one at a time, in order
+        self.commands = CommandQueue(self.apply_command)
         
         # 4
         self.audio_track= audio_track
         self.tts = ElevenLabsTTS(output_track=self.audio_track)
-        self.stt = DeepgramSTT(callback=self.handle_transcript)
+        self.stt = DeepgramSTT(callback=self.handle_transcript, on_speech=self.handle_speech_event)
+        # peers heard talking, by the local VAD or else until their turn ends
+        self.speaking_peers = set()
+        # llm replies and comments being generated or spoken, cut off by barge-in
+        self.reply_tasks = set()
+        # transcripts being read for a move, a barge-in must not lose the move
+        self.utterance_tasks = set()
+        self._barge_in_timers = {}
+        self.barge_ins = 0
+        self.spoken_moves = 0
+        self.llm_move_parses = 0
+        self.speculator = MoveSpeculator(self.openai_client, self.tts) if SPECULATE_MOVES else None
+        # inputs and vendor timings of the session, with SESSION_RECORD_DIR set
+        self.recorder = SessionRecorder.create(session_id)
+        self.stt.recorder = self.tts.recorder = self.openai_client.recorder = self.recorder
         
-    def check_winner(self):
-        board = self.game_state["board"]
-        lines = [
-            [0,1,2], [3,4,5], [6,7,8],  # rows
-            [0,3,6], [1,4,7], [2,5,8],  # columns
-            [0,4,8], [2,4,6]  # diagonals
-        ]
-        for line in lines:
-            a, b, c = line
-            if board[a] and board[a] == board[b] == board[c]:
-                return board[a]
-        return None
-   
     async def publish_game_state(self):
-        state_message = {
-            "type": "state_update",
-            "game_state": self.game_state
-        }
-        await self.publish_to_pubsub(state_message)
+        await self.publish_message(self.sync.snapshot())
  
     async def generate_ai_move(self):
-            ai_move = self.openai_client.generate_server_response(game_state=self.game_state)
-            # 1. get ai comment
-            comment = ai_move.get("comment", "")
-            
-            # 2. Generate TTS and get the audio bytes
-            await self.tts.generate(comment)
-
-          
-            await self.publish_to_pubsub(ai_move)
+        # the engine picks the move locally, so it is published right away and
+        # the comment is generated and spoken afterwards
+        if current_turn.get() is None:
+            # a spoken move already started its turn with the player's speech
+            start_turn(self.session_id, "move")
+        board = self.game_state.board
+        branch = self.speculator.take(board) if self.speculator else None
+        if branch is not None:
+            ai_move = {"type": "move", "position": branch.position, "player": "O"}
+        else:
+            ai_move = self.openai_client.generate_server_move(game_state=self.game_state)
+        if ai_move["type"] == "move":
+            # applied right away, the echo from pubsub is ignored as an illegal repeat
+            self.game_state.apply_move(ai_move["position"], "O")
+            await self.publish_message(self.sync.delta(ai_move["position"], "O"))
+            if self.speculator:
+                # prepare replies while X is thinking
+                self.speculator.start(self.game_state)
+        else:
             await self.publish_game_state()
-            
-            
-    async def validate_and_process_move(self, move: dict):
-        position = int(move["position"])
-        player = move["player"]
-        
-        if self.game_state["game_over"]:
-            return
-            
-        if player != self.game_state["current_player"]:
+        # speaking is not part of the command, the next one can be applied meanwhile
+        self.start_reply(self.announce_move(board, ai_move, branch))
+
+    async def announce_move(self, board, ai_move: dict, branch=None):
+        if branch is not None:
+            prepared = await branch_result(branch)
+            if prepared is not None:
+                comment, audio = prepared
+                await self.tts.generate(comment, audio=audio, priority=MOVE)
+                return
+
+        if ai_move["type"] != "move":
+            if ai_move.get("comment"):
+                await self.tts.generate(ai_move["comment"], priority=MOVE)
             return
-            
-        if position < 0 or position > 8:
+
+        await self.comment_move(board, ai_move["position"])
+
+    async def comment_move(self, board, position):
+        if STREAM_RESPONSES:
+            await self.speak(self.openai_client.stream_move_comment(board, position), priority=MOVE)
             return
+        try:
+            comment = await self.openai_client.generate_move_comment(board, position)
+        except asyncio.TimeoutError:
+            comment = MOVE_COMMENT
+        await self.tts.generate(comment, priority=MOVE)
+
+    async def speak(self, fragments, priority=CHAT):
+        """Queue each text fragment for TTS as soon as it is produced, the first
+        one interrupts the current speech and the rest play back to back."""
+        interrupt = True
+        try:
+            async with aclosing(fragments):
+                async for fragment in fragments:
+                    await self.tts.generate(fragment, interrupt=interrupt, priority=priority)
+                    interrupt = False
+        except asyncio.TimeoutError:
+            logger.warning("LLM response timed out")
+        except Exception:
+            logger.exception("Error while generating response")
             
-        if self.game_state["board"][position] is not None:
+    async def validate_and_process_move(self, move: dict, publish: bool = False):
+        position = int(move["position"])
+        player = move["player"]
+
+        # Update game state, illegal moves are ignored
+        if not self.game_state.apply_move(position, player):
             return
+        if publish:
+            # not played on the board, the echo from pubsub is ignored as an
+            # illegal repeat
+            await self.publish_message(self.sync.delta(position, player))
 
-        # Update game state
-        self.game_state["board"][position] = player
-        self.game_state["current_player"] = "O" if player == "X" else "X"
-        
-        # Check for winner
-        winner = self.check_winner()
-        if winner or None not in self.game_state["board"]:
-            self.game_state["winner"] = winner
-            self.game_state["game_over"] = True
+        if self.game_state.game_over:
             await self.publish_game_state()
         elif player == "X":
             await self.generate_ai_move()
 
     def receive_client_msg(self, data):
         try:
+            if self.recorder is not None:
+                self.recorder.pubsub_in(data["message"])
             message = json.loads(data["message"])
             if message.get("type") == "reset":
-                self.game_state = {
-                    "board": [None]*9,
-                    "current_player": "X",
-                    "winner": None,
-                    "game_over": False
-                }
-                asyncio.create_task(self.publish_game_state())
+                # a move still being read out of speech belongs to the old game
+                for task in list(self.utterance_tasks):
+                    task.cancel()
+                self.commands.submit(RESET)
             elif message.get("type") == "move":
-                asyncio.create_task(self.validate_and_process_move(message))
+                self.commands.submit("move", message)
+            elif message.get("type") == RESYNC:
+                self.commands.submit(RESYNC, coalesce=True)
         except Exception as e:
-            print(f"Error processing message: {str(e)}")
+            logger.error("Error processing message: %s", e)
 
-    async def publish_to_pubsub(self, ai_move: dict):
-        publish_config=PubSubPublishConfig(
-            topic=self.pubsub_topic,
-            message=json.dumps(ai_move) # llm response
-        )
-        await self.agent.pubsub.publish(pubsub_config=publish_config)
+    async def apply_command(self, command: Command):
+        if command.kind == RESET:
+            # comments of the old game are not wanted anymore
+            for task in list(self.reply_tasks):
+                task.cancel()
+            if self.speculator:
+                self.speculator.cancel()
+            self.game_state.reset()
+            await self.publish_game_state()
+        elif command.kind == "move":
+            await self.validate_and_process_move(command.payload)
+        elif command.kind == SPOKEN_MOVE:
+            await self.validate_and_process_move(command.payload, publish=True)
+        elif command.kind == RESYNC:
+            await self.publish_game_state()
+
+    def start_reply(self, coro) -> asyncio.Task:
+        # spoken replies, cancelled when a player barges in
+        task = asyncio.create_task(coro)
+        self.reply_tasks.add(task)
+        task.add_done_callback(self.reply_tasks.discard)
+        return task
+
+    async def publish_message(self, message: str):
+        # already encoded, e.g. by StateSync
+        if self.recorder is not None:
+            self.recorder.pubsub_out(message)
+        await self.agent.pubsub.publish(pubsub_config=PubSubPublishConfig(topic=self.pubsub_topic, message=message))
                   
     async def subscribe_to_pubsub(self):
         pubsub_config = PubSubSubscribeConfig(
@@ -154,33 +260,156 @@ class GameEventHandler(MeetingEventHandler):
     def on_meeting_joined(self, data):
         asyncio.create_task(self.subscribe_to_pubsub())
 
+    def on_meeting_left(self, data):
+        if self.on_leave is not None:
+            self.on_leave()
+
     def on_participant_joined(self, participant):
-        print(f"Participant {participant.display_name} joined")
+        logger.info("Participant %s joined", participant.display_name)
+        if self.recorder is not None:
+            self.recorder.peer(participant.id, participant.display_name, STT_SAMPLE_RATE)
         participant.add_event_listener(
             ParticipantSTTEventListener(stt=self.stt, participant=participant)
         )
+        # a late joiner gets the current game
+        if self.game_state.board.occupied:
+            self.commands.submit(RESYNC, coalesce=True)
 
     def on_participant_left(self, participant):
-        print(f"Participant {participant.display_name} left")
+        logger.info("Participant %s left", participant.display_name)
         self.stt.stop(peer_id=participant.id)
+        self.speaking_peers.discard(participant.id)
+
+    def handle_speech_event(self, peer_id, peer_name, event):
+        if event == SPEECH_START:
+            self.speaking_peers.add(peer_id)
+            if BARGE_IN and peer_id not in self._barge_in_timers:
+                # the speech began with the batch it was heard in
+                onset = time.monotonic() - STT_BATCH_MS / 1000
+                self._barge_in_timers[peer_id] = self.loop.call_later(
+                    BARGE_IN_GRACE_MS / 1000, self.barge_in, peer_id, onset
+                )
+        elif event == SPEECH_END:
+            self.speaking_peers.discard(peer_id)
+            timer = self._barge_in_timers.pop(peer_id, None)
+            if timer is not None:
+                timer.cancel()
+
+    def barge_in(self, peer_id, onset):
+        self._barge_in_timers.pop(peer_id, None)
+        if not self.stt.is_voiced(peer_id):
+            if self.stt.local_vad:
+                # the sound stopped within the grace window
+                return
+            # without the VAD only deepgram's words tell speech from noise,
+            # keep waiting for them until the speech is reported over
+            self._barge_in_timers[peer_id] = self.loop.call_later(
+                BARGE_IN_GRACE_MS / 1000, self.barge_in, peer_id, onset
+            )
+            return
+        if not (self.audio_track.is_speaking() or self.reply_tasks or self.tts.queued()):
+            return
+        for task in list(self.reply_tasks):
+            task.cancel()
+        self.tts.cancel()
+        self.audio_track.barge_in()
+        self.barge_ins += 1
+        tracing.observe(self.session_id, "barge_in", time.monotonic() - onset)
+        logger.info("Barge-in by %s, speech stopped %.0f ms after onset", peer_id, 1000 * (time.monotonic() - onset))
 
-    def handle_transcript(self, peer_name, text):
-        print(f"[{peer_name}]:", text)
+    def handle_transcript(self, peer_name, text, speech_end=None):
+        logger.info("[%s]: %s", peer_name, text)
+        if self.recorder is not None:
+            self.recorder.transcript(peer_name, text, speech_end)
         # Generate conversational response in a non-blocking manner
-        asyncio.run_coroutine_threadsafe(self.generate_conversational_response(text), self.loop)
+        self.loop.call_soon_threadsafe(self.start_utterance, self.handle_utterance(text, speech_end))
+
+    def start_utterance(self, coro) -> asyncio.Task:
+        # not cut off by barge-in, only the reply it starts is
+        task = asyncio.create_task(coro)
+        self.utterance_tasks.add(task)
+        task.add_done_callback(self.utterance_tasks.discard)
+        return task
+
+    async def handle_utterance(self, text, speech_end=None):
+        start_turn(self.session_id, "reply", speech_end)
+        position = await self.spoken_move(text)
+        if position is None:
+            self.start_reply(self.generate_conversational_response(text))
+            return
+        # applied and published in order with the moves from the board
+        self.commands.submit(SPOKEN_MOVE, {"type": "move", "position": position, "player": "X"})
+
+    async def spoken_move(self, text) -> Optional[int]:
+        """Position the player asked for by voice, if it is a legal X move."""
+        if self.game_state.game_over or self.game_state.current_player != "X":
+            return None
+        position, confident = parse_spoken_move(text)
+        if not confident:
+            # looks like a move the grammar can't place, let the llm decide
+            self.llm_move_parses += 1
+            try:
+                position = await self.openai_client.parse_move(text)
+            except asyncio.TimeoutError:
+                return None
+            if position < 0:
+                position = None
+        if position is None or not self.game_state.board.is_free(position):
+            return None
+        self.spoken_moves += 1
+        return position
         
     async def generate_conversational_response(self, text):
-        # Generate response using OpenAI (run in executor to avoid blocking)
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            self.openai_client.generate_chat_response,
-            text,
-            self.game_state  # Optional: pass game state for context
-        )
+        # Generate response using OpenAI
+        if STREAM_RESPONSES:
+            fragments = self.openai_client.stream_chat_response(text, self.game_state.snapshot(), self.memory)
+            await self.speak(fragments)
+            return
+
+        try:
+            response = await self.openai_client.generate_chat_response(
+                text,
+                self.game_state.snapshot(),  # Optional: pass game state for context
+                self.memory
+            )
+        except asyncio.TimeoutError:
+            logger.warning("LLM response timed out")
+            return
         # Queue the response for TTS
         await self.tts.generate(response)
 
+    def stats(self) -> dict:
+        stats = {
+            "participants": len(self.stt.deepgram_connections),
+            "stt": self.stt.stats(),
+            "speaking": len(self.speaking_peers),
+            "barge_ins": self.barge_ins,
+            "spoken_moves": self.spoken_moves,
+            "llm_move_parses": self.llm_move_parses,
+        }
+        stats.update(self.tts.stats())
+        stats.update(self.memory.stats())
+        stats.update(self.commands.stats())
+        stats.update(self.sync.stats())
+        if self.speculator:
+            stats.update(self.speculator.stats())
+        return stats
+
+    def close(self):
+        self.commands.close()
+        for task in list(self.reply_tasks) + list(self.utterance_tasks):
+            task.cancel()
+        for timer in self._barge_in_timers.values():
+            timer.cancel()
+        if self.speculator:
+            self.speculator.cancel()
+        self.memory.close()
+        for peer_id in list(self.stt.deepgram_connections):
+            self.stt.stop(peer_id=peer_id)
+        self.tts.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
 
 class ParticipantSTTEventListener(ParticipantEventHandler):
     def __init__(self, stt: DeepgramSTT, participant: Participant):
@@ -1,118 +1,307 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
 from fractions import Fraction
-import threading
+import logging
+import os
 import time
-import traceback
-from typing import Iterator, Optional
+from typing import AsyncIterator, Iterator, Optional
 from av import AudioFrame
 from vsaiortc.mediastreams import AudioStreamTrack
 import numpy as np
+from agent.tracing import Turn
+
+logger = logging.getLogger(__name__)
 
 AUDIO_PTIME = 0.02
+# rate of the audio sent to the meeting, 48000 is what the opus encoder
+# takes without resampling, lower rates cost less to buffer and frame
+AUDIO_SAMPLE_RATE = int(os.getenv("AUDIO_SAMPLE_RATE", "24000"))
+# threads shared by all tracks for blocking reads from tts byte streams
+TTS_READER_THREADS = 8
+# upper bound of tts audio held in memory per track, the producer waits beyond this
+MAX_BUFFERED_AUDIO_SECONDS = 10
+# seconds recv() may lag behind the pacing clock before it is reset
+JITTER_BUDGET = 0.1
+# length of the fade-out when speech is cut off by a player talking over it
+BARGE_IN_FADE_MS = 10
+
+_tts_reader_pool = ThreadPoolExecutor(max_workers=TTS_READER_THREADS, thread_name_prefix="tts-reader")
 
-def build_audio_frame(chunk: bytes) -> AudioFrame:
-    data = np.frombuffer(chunk, dtype=np.int16)
-    data = data.reshape(-1, 1)
-    audio_frame = AudioFrame.from_ndarray(data.T, format="s16", layout="mono")
+def build_audio_frame(samples: np.ndarray) -> AudioFrame:
+    # AudioFrame copies the samples, so a view into the ring buffer is enough
+    audio_frame = AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="mono")
     return audio_frame
 
+
+class PcmRingBuffer:
+    """Preallocated ring of mono int16 samples.
+
+    Frames are read with peek()/advance() so the caller can build the
+    AudioFrame straight from the returned view before the space is reused.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._buf = np.zeros(capacity, dtype=np.int16)
+        self._scratch = np.zeros(0, dtype=np.int16)
+        self._read = 0
+        self._write = 0
+        # trailing odd byte of the previous write
+        self._carry = b""
+
+    def __len__(self) -> int:
+        return self._write - self._read
+
+    def free(self) -> int:
+        return self.capacity - len(self)
+
+    def write(self, data: memoryview) -> int:
+        """Copy as many whole samples as fit, returns the number of bytes consumed."""
+        consumed = 0
+        if self._carry and len(data):
+            if not self.free():
+                return 0
+            self._store(np.frombuffer(self._carry + bytes(data[:1]), dtype=np.int16))
+            self._carry = b""
+            data = data[1:]
+            consumed = 1
+        count = min(len(data) // 2, self.free())
+        if count:
+            self._store(np.frombuffer(data, dtype=np.int16, count=count))
+        consumed += count * 2
+        if count == len(data) // 2 and len(data) % 2:
+            self._carry = bytes(data[-1:])
+            consumed += 1
+        return consumed
+
+    def _store(self, samples: np.ndarray):
+        count = len(samples)
+        start = self._write % self.capacity
+        first = min(count, self.capacity - start)
+        self._buf[start:start + first] = samples[:first]
+        self._buf[:count - first] = samples[first:]
+        self._write += count
+
+    def pad(self, multiple: int):
+        """Zero fill up to the next multiple of `multiple` samples."""
+        self._carry = b""
+        missing = -len(self) % multiple
+        if missing and missing <= self.free():
+            self.write(bytes(missing * 2))
+
+    def peek(self, count: int) -> Optional[np.ndarray]:
+        if len(self) < count:
+            return None
+        start = self._read % self.capacity
+        if start + count <= self.capacity:
+            return self._buf[start:start + count]
+        # wrapped around the end, only this case copies
+        if len(self._scratch) != count:
+            self._scratch = np.empty(count, dtype=np.int16)
+        first = self.capacity - start
+        self._scratch[:first] = self._buf[start:]
+        self._scratch[first:] = self._buf[:count - first]
+        return self._scratch
+
+    def advance(self, count: int):
+        self._read += min(count, len(self))
+
+    def clear(self):
+        self._read = self._write
+        self._carry = b""
+
 class MediaStreamError(Exception):
     pass
 
 
+async def read_chunks(stream, loop: asyncio.AbstractEventLoop, executor=None) -> AsyncIterator[bytes]:
+    """Pull chunks from a tts byte stream one at a time.
+
+    Blocking iterators (the ElevenLabs sdk) are advanced on the shared reader
+    pool, so the next chunk is only requested once the previous one was taken.
+    """
+    executor = executor or _tts_reader_pool
+    if isinstance(stream, (list, tuple)):
+        # already in memory (cached audio), no reader thread needed
+        for chunk in stream:
+            yield chunk
+        return
+    if hasattr(stream, "__aiter__"):
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await close_stream(stream)
+        return
+    iterator = iter(stream)
+    pending = None
+    try:
+        while True:
+            pending = executor.submit(next, iterator, None)
+            chunk = await asyncio.wrap_future(pending, loop=loop)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None and pending is None:
+            executor.submit(close)
+        elif close is not None:
+            # a cancelled read may still be running, close once it returns
+            pending.add_done_callback(lambda _: executor.submit(close))
+
+
+async def close_stream(stream):
+    """Release a stream that will not be read to the end."""
+    if hasattr(stream, "aclose"):
+        await stream.aclose()
+    elif hasattr(stream, "close"):
+        _tts_reader_pool.submit(stream.close)
+
+
+class CancelToken:
+    """Marks queued or playing audio as stale, checked between tts chunks."""
+
+    __slots__ = ("cancelled",)
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
 class CustomAudioStreamTrack(AudioStreamTrack):
     def __init__(
-        self, loop, handle_interruption: Optional[bool] = True,
+        self, loop, handle_interruption: Optional[bool] = True, jitter_budget: float = JITTER_BUDGET,
+        sample_rate: int = AUDIO_SAMPLE_RATE,
     ):
         super().__init__()
         self.loop = loop
         self._start = None
         self._timestamp = 0
 
-        # frame buffer to send frames in videosdk meeting
-        self.frame_buffer = []
-
-        # Audio data buffer to store incoming audio
-        self.audio_data_buffer = bytearray()
-
         # Audio frame properties
         self.frame_time = 0
-        self.sample_rate = 24000
+        self.sample_rate = sample_rate
         self.channels = 1
         self.sample_width = 2
         self.time_base_fraction = Fraction(1, self.sample_rate)
         self.samples = int(AUDIO_PTIME * self.sample_rate)
         self.chunk_size = int(self.samples * self.channels * self.sample_width)
 
-        self._process_audio_task_queue = asyncio.Queue()
-        self._process_audio_thread = threading.Thread(target=self.process_incoming_audio)
-        self._process_audio_thread.daemon = True
-        self._process_audio_thread.start()
+        # pcm buffer to send frames in videosdk meeting, filled by the
+        # pipeline task and drained by recv(), both on the event loop
+        self.pcm_buffer = PcmRingBuffer(int(MAX_BUFFERED_AUDIO_SECONDS * self.sample_rate))
+        self._space_available = asyncio.Event()
+
+        self._utterances: asyncio.Queue = asyncio.Queue()
+        self._token = CancelToken()
+        # turn whose first audio is being written, marked once it is sent
+        self._turn: Optional[Turn] = None
+        self._pipeline_task = self.loop.create_task(self._run_pipeline())
 
         self.handle_interruption = handle_interruption
-        self.skip_next_chunk = False
+
+        # pacing: how far recv() may fall behind before the clock is reset
+        self.jitter_budget = jitter_budget
+        self.underruns = 0
+        self.late_frames = 0
+        self.resyncs = 0
+        self._playing = False
+
+        # sent while nothing is buffered, only pts changes between frames
+        self._silence_frame = AudioFrame(format="s16", layout="mono", samples=self.samples)
+        for p in self._silence_frame.planes:
+            p.update(bytes(p.buffer_size))
+
+    def pacing_stats(self) -> dict:
+        return {
+            "underruns": self.underruns,
+            "late_frames": self.late_frames,
+            "resyncs": self.resyncs,
+        }
+
+    def buffered_frames(self) -> int:
+        return len(self.pcm_buffer) // self.samples
 
     def interrupt(self):
         if self.handle_interruption == True:
-          length = len(self.frame_buffer)
-          self.frame_buffer.clear()
-          while not self._process_audio_task_queue.empty():
-              self.skip_next_chunk = True
-              self._process_audio_task_queue.get_nowait()
-              self._process_audio_task_queue.task_done()
-              
-          if length>0:
-              self.skip_next_chunk = True
-
-    def add_new_bytes(self, bytes: Iterator[bytes]):
+            # everything queued or playing under the current token is dropped
+            self._token.cancel()
+            self._token = CancelToken()
+            self.pcm_buffer.clear()
+            self._space_available.set()
+            self._turn = None
+
+    def is_speaking(self) -> bool:
+        return self._playing or len(self.pcm_buffer) > 0 or not self._utterances.empty()
+
+    def barge_in(self, fade_ms: int = BARGE_IN_FADE_MS) -> bool:
+        """Stops speech on the next frame with a short fade-out instead of a
+        click, drops everything queued. Returns whether anything was playing."""
+        if self.handle_interruption != True:
+            return False
+        speaking = self.is_speaking()
+        fade = min(len(self.pcm_buffer), self.sample_rate * fade_ms // 1000)
+        tail = None
+        if fade:
+            ramp = np.linspace(1.0, 0.0, fade, dtype=np.float32)
+            tail = (self.pcm_buffer.peek(fade) * ramp).astype(np.int16)
         self.interrupt()
-        print(type(bytes))
-        self._process_audio_task_queue.put_nowait(bytes)
+        if tail is not None:
+            self.pcm_buffer.write(memoryview(tail.tobytes()))
+            self.pcm_buffer.pad(self.samples)
+        return speaking
 
-    def process_incoming_audio(self):
+    def add_new_bytes(self, bytes: Iterator[bytes], token: Optional[CancelToken] = None, interrupt: bool = True,
+                      turn: Optional[Turn] = None) -> CancelToken:
+        # interrupt=False queues the stream behind what is already playing
+        if interrupt:
+            self.interrupt()
+        token = token or self._token
+        self._utterances.put_nowait((token, bytes, turn))
+        return token
+
+    def stop(self):
+        super().stop()
+        self._token.cancel()
+        self._pipeline_task.cancel()
+
+    async def _run_pipeline(self):
         while True:
+            token, audio_data_stream, turn = await self._utterances.get()
+            if token.cancelled:
+                await close_stream(audio_data_stream)
+                continue
             try:
-                if (self._process_audio_task_queue.empty()):
-                    while True:
-                        if len(self.frame_buffer) > 0:
-                            time.sleep(0.5)
-                            continue
-                        print("Interviewer is not speaking")
-                        break
-            except Exception as e:
-                print("Error while updating chracter state")
+                await self._play(token, audio_data_stream, turn)
+            except Exception:
+                logger.exception("Error while process audio")
+            finally:
+                self._playing = False
 
-            try:
-                audio_data_stream = asyncio.run_coroutine_threadsafe(
-                   self._process_audio_task_queue.get(), self.loop
-                ).result()
-                print("sumit so->",type(audio_data_stream))
-                for audio_data in audio_data_stream:
-                    try:
-                        if self.skip_next_chunk:
-                            print("Skipping Next Chunk")
-                            self.frame_buffer.clear()
-                            self.skip_next_chunk = False
-                            break
-
-                        self.audio_data_buffer += audio_data
-                        while len(self.audio_data_buffer) > self.chunk_size:
-                            chunk = self.audio_data_buffer[: self.chunk_size]
-                            self.audio_data_buffer = self.audio_data_buffer[
-                                self.chunk_size :
-                            ]
-
-                            # bytes to av.AudioFrame
-                            audio_frame = build_audio_frame(chunk)
-                            
-                            # append frame into frame buffer
-                            self.frame_buffer.append(audio_frame)
-                            # print("Interviewer is Speaking")
-                    except Exception as e:
-                        print("Error while putting audio data stream", e)
-            except Exception as e:
-                traceback.print_exc()
-                print("Error while process audio", e)
+    async def _play(self, token: CancelToken, audio_data_stream, turn: Optional[Turn] = None):
+        async with aclosing(read_chunks(audio_data_stream, self.loop)) as chunks:
+            async for audio_data in chunks:
+                data = memoryview(audio_data)
+                while len(data) and not token.cancelled:
+                    consumed = self.pcm_buffer.write(data)
+                    data = data[consumed:]
+                    if turn is not None and not turn.audio_sent:
+                        self._turn = turn
+                        turn = None
+                    # an empty ring from here on is an underrun, not the wait for first audio
+                    self._playing = True
+                    if len(data):
+                        # ring is full, wait for recv() instead of reading further
+                        self._space_available.clear()
+                        await self._space_available.wait()
+                if token.cancelled:
+                    return
+        # play the tail of the utterance instead of leaving it for the next one
+        self.pcm_buffer.pad(self.samples)
 
     def next_timestamp(self):
         # Compute the next timestamp for the audio frame
@@ -129,32 +318,45 @@ class CustomAudioStreamTrack(AudioStreamTrack):
                 raise MediaStreamError
 
             if self._start is None:
-                self._start = time.time()
+                self._start = time.monotonic()
                 self._timestamp = 0
             else:
                 self._timestamp += self.samples
 
-            wait = self._start + (self._timestamp / self.sample_rate) - time.time()
+            wait = self._start + (self._timestamp / self.sample_rate) - time.monotonic()
 
             if wait > 0:
                 await asyncio.sleep(wait)
+            elif -wait > self.jitter_budget:
+                # the loop stalled, restart the clock instead of bursting frames to catch up
+                self.resyncs += 1
+                self._start = time.monotonic()
+                self._timestamp = 0
+            elif -wait > AUDIO_PTIME:
+                self.late_frames += 1
 
             pts, time_base = self.next_timestamp()
 
-            if len(self.frame_buffer) > 0:
-                frame = self.frame_buffer.pop(0)
+            samples = self.pcm_buffer.peek(self.samples)
+            if samples is not None:
+                # bytes to av.AudioFrame
+                frame = build_audio_frame(samples)
+                self.pcm_buffer.advance(self.samples)
+                self._space_available.set()
+                if self._turn is not None:
+                    self._turn.first_audio()
+                    self._turn = None
             else:
-                frame = AudioFrame(format="s16", layout="mono", samples=self.samples)
-                for p in frame.planes:
-                    p.update(bytes(p.buffer_size))
+                if self._playing:
+                    self.underruns += 1
+                frame = self._silence_frame
 
             frame.pts = pts
             frame.time_base = time_base
             frame.sample_rate = self.sample_rate
             return frame
-        except Exception as e:
-            traceback.print_exc()
-            print("error while creating tts->rtc frame", e)
+        except Exception:
+            logger.exception("error while creating tts->rtc frame")
 
 
 
@@ -0,0 +1,104 @@
+import asyncio
+import contextvars
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+RESET = "reset"
+
+
+class Command:
+    __slots__ = ("seq", "kind", "payload", "context")
+
+    def __init__(self, seq: int, kind: str, payload: dict):
+        self.seq = seq
+        self.kind = kind
+        self.payload = payload
+        # applied with the submitter's context vars, e.g. its latency trace
+        self.context = contextvars.copy_context()
+
+
+class CommandQueue:
+    """Applies one meeting's game commands one at a time, in arrival order.
+
+    Every command gets a sequence number and is run by `handler(command)`
+    from a single consumer task, so no two commands touch the game state
+    at once. A reset makes the commands queued before it obsolete: they
+    are dropped, the one being applied is cancelled, and resets queued
+    back to back are coalesced into one. Other commands submitted with
+    `coalesce` are dropped while one of the same kind is still queued.
+    """
+
+    def __init__(self, handler: Callable[[Command], Awaitable[None]]):
+        self.handler = handler
+        self.seq = 0
+        self.applied_seq = 0
+        self.applied = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._current: Optional[asyncio.Task] = None
+        self._consumer: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def submit(self, kind: str, payload: Optional[dict] = None, coalesce: bool = False) -> int:
+        if coalesce and any(c.kind == kind for c in self._queue):
+            self.dropped += 1
+            return self.seq
+        self.seq += 1
+        if kind == RESET:
+            self.dropped += len(self._queue)
+            self._queue.clear()
+            if self._current is not None and self._current.get_name() != RESET:
+                self._current.cancel()
+        self._queue.append(Command(self.seq, kind, payload or {}))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._wakeup.set()
+        if self._consumer is None:
+            self._consumer = asyncio.create_task(self._consume())
+        return self.seq
+
+    async def _consume(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            command = self._queue.popleft()
+            # its own task, so a reset can cancel it without stopping the consumer
+            self._current = asyncio.create_task(self.handler(command), name=command.kind, context=command.context)
+            try:
+                await self._current
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    # the consumer itself was cancelled, not just the command
+                    raise
+                self.dropped += 1
+                continue
+            except Exception:
+                logger.exception("Error applying %s command %d", command.kind, command.seq)
+            finally:
+                self._current = None
+            self.applied += 1
+            self.applied_seq = command.seq
+
+    def close(self):
+        self._queue.clear()
+        if self._current is not None:
+            self._current.cancel()
+        if self._consumer is not None:
+            self._consumer.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "commands_queued": len(self._queue),
+            "commands_max_queued": self.max_depth,
+            "commands_applied": self.applied,
+            "commands_dropped": self.dropped,
+            "command_seq": self.applied_seq,
+        }
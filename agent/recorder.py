@@ -0,0 +1,279 @@
+"""Opt-in recording of a session's inputs and vendor timings, for replay
+with `python -m bench.replay`.
+
+File layout, little endian:
+
+    header   b"GREC" u16 version, f64 wall clock start, u16 length + session id
+    chunk*   b"CHNK" u32 records, u32 stored bytes, u32 raw bytes, f64 first t,
+             then the zlib compressed records
+    index    b"INDX" u32 chunks, per chunk u64 offset, f64 first t, u32 records
+    trailer  u64 index offset, b"GEND"
+
+    record   f64 t (seconds since start), u8 kind, u16 stream, u32 length, payload
+
+Audio payloads are mono int16 at the STT rate with the peer's stream
+number, everything else is compact json. A file cut short by a crash has
+no index, the reader then scans the chunks up to the last complete one.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from agent import tracing
+
+logger = logging.getLogger(__name__)
+
+# directory recordings are written to, one file per session; empty disables recording
+SESSION_RECORD_DIR = os.getenv("SESSION_RECORD_DIR", "")
+# also record the players' speech as sent to STT, otherwise only the transcripts
+SESSION_RECORD_AUDIO = os.getenv("SESSION_RECORD_AUDIO", "true").lower() == "true"
+# records are compressed and written in chunks of about this size, or at least every second
+CHUNK_BYTES = 64 * 1024
+FLUSH_INTERVAL_S = 1.0
+
+MAGIC = b"GREC"
+VERSION = 1
+_HEADER = struct.Struct("<4sHd")
+_CHUNK = struct.Struct("<4sIIId")
+_RECORD = struct.Struct("<dBHI")
+_INDEX_ENTRY = struct.Struct("<QdI")
+_TRAILER = struct.Struct("<Q4s")
+
+# record kinds
+PEER = 1          # {"id", "name", "rate"}, stream is the number its audio is recorded under
+AUDIO = 2         # speech of a peer
+TRANSCRIPT = 3    # {"peer", "text", "stt_s"}
+PUBSUB_IN = 4     # message text as received
+PUBSUB_OUT = 5    # message text as published
+LLM = 6           # {"messages", "response", "first_token_s", "total_s", "stream"}
+TTS_REQUEST = 7   # {"id", "text", "cached"}
+TTS_CHUNK = 8     # {"id", "bytes"}
+SPAN = 9          # {"stage", "s"}, from agent.tracing
+
+KIND_NAMES = {PEER: "peer", AUDIO: "audio", TRANSCRIPT: "transcript", PUBSUB_IN: "pubsub_in",
+              PUBSUB_OUT: "pubsub_out", LLM: "llm", TTS_REQUEST: "tts_request", TTS_CHUNK: "tts_chunk",
+              SPAN: "span"}
+
+# one writer thread for all sessions, keeps each file's chunks in order
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recorder")
+
+
+class Record(NamedTuple):
+    t: float
+    kind: int
+    stream: int
+    payload: bytes
+
+    def json(self):
+        return json.loads(self.payload)
+
+
+class SessionRecorder:
+    """Timestamped log of one session, see the module docstring for the format.
+
+    Calls are cheap: records are packed into an in-memory chunk that is
+    compressed and written on the writer thread.
+    """
+
+    def __init__(self, path: str, session: str, audio: bool = SESSION_RECORD_AUDIO):
+        self.path = path
+        self.session = session
+        self.audio_enabled = audio
+        self.started = time.monotonic()
+        self.streams: Dict[str, int] = {}
+        self.records = 0
+        self.bytes_written = 0
+        self._chunk = bytearray()
+        self._chunk_records = 0
+        self._chunk_first_t = 0.0
+        self._last_flush = self.started
+        self._index: List[tuple] = []
+        self._tts_requests = 0
+        # published messages, their echo from pubsub is not an input
+        self._published = deque(maxlen=32)
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._file = open(path, "wb")
+        session_id = session.encode("utf-8")
+        self._file.write(_HEADER.pack(MAGIC, VERSION, time.time()) + struct.pack("<H", len(session_id)) + session_id)
+        self._offset = self._file.tell()
+        tracing.listen(session, self.span)
+
+    @classmethod
+    def create(cls, session: str) -> Optional["SessionRecorder"]:
+        """A recorder in SESSION_RECORD_DIR, or None when recording is off."""
+        if not SESSION_RECORD_DIR:
+            return None
+        os.makedirs(SESSION_RECORD_DIR, exist_ok=True)
+        name = f"{session}-{time.strftime('%Y%m%d-%H%M%S')}.grec"
+        try:
+            return cls(os.path.join(SESSION_RECORD_DIR, name), session)
+        except OSError as e:
+            logger.warning("Can't record session %s: %s", session, e)
+            return None
+
+    def _append(self, kind: int, payload: bytes, stream: int = 0):
+        if self._closed:
+            return
+        now = time.monotonic()
+        t = now - self.started
+        with self._lock:
+            if not self._chunk_records:
+                self._chunk_first_t = t
+            self._chunk += _RECORD.pack(t, kind, stream, len(payload))
+            self._chunk += payload
+            self._chunk_records += 1
+            self.records += 1
+            if len(self._chunk) >= CHUNK_BYTES or now - self._last_flush >= FLUSH_INTERVAL_S:
+                self._flush_locked(now)
+
+    def _json(self, kind: int, data, stream: int = 0):
+        self._append(kind, json.dumps(data, separators=(",", ":")).encode("utf-8"), stream)
+
+    def _flush_locked(self, now: float):
+        self._last_flush = now
+        if not self._chunk_records:
+            return
+        chunk, records, first_t = bytes(self._chunk), self._chunk_records, self._chunk_first_t
+        self._chunk = bytearray()
+        self._chunk_records = 0
+        _writer.submit(self._write_chunk, chunk, records, first_t)
+
+    def _write_chunk(self, chunk: bytes, records: int, first_t: float):
+        try:
+            stored = zlib.compress(chunk, 1)
+            self._file.write(_CHUNK.pack(b"CHNK", records, len(stored), len(chunk), first_t) + stored)
+            self._index.append((self._offset, first_t, records))
+            self._offset += _CHUNK.size + len(stored)
+            self.bytes_written = self._offset
+        except (OSError, ValueError) as e:
+            logger.warning("Recording %s failed: %s", self.path, e)
+
+    def _write_index(self):
+        try:
+            index_offset = self._offset
+            self._file.write(b"INDX" + struct.pack("<I", len(self._index)))
+            for entry in self._index:
+                self._file.write(_INDEX_ENTRY.pack(*entry))
+            self._file.write(_TRAILER.pack(index_offset, b"GEND"))
+            self._file.close()
+        except (OSError, ValueError) as e:
+            logger.warning("Recording %s failed: %s", self.path, e)
+
+    def peer(self, peer_id: str, name: str, sample_rate: int):
+        stream = self.streams.setdefault(peer_id, len(self.streams) + 1)
+        self._json(PEER, {"id": peer_id, "name": name, "rate": sample_rate}, stream)
+
+    def audio(self, peer_id: str, pcm: bytes):
+        if self.audio_enabled and peer_id in self.streams:
+            self._append(AUDIO, bytes(pcm), self.streams[peer_id])
+
+    def transcript(self, peer_name: str, text: str, speech_end: Optional[float]):
+        stt_s = time.monotonic() - speech_end if speech_end is not None else None
+        self._json(TRANSCRIPT, {"peer": peer_name, "text": text, "stt_s": stt_s})
+
+    def pubsub_in(self, message: str):
+        if message in self._published:
+            self._published.remove(message)
+            return
+        self._append(PUBSUB_IN, message.encode("utf-8"))
+
+    def pubsub_out(self, message: str):
+        self._published.append(message)
+        self._append(PUBSUB_OUT, message.encode("utf-8"))
+
+    def llm(self, messages: List[dict], response: str, started: float, first_token: Optional[float], stream: bool):
+        now = time.monotonic()
+        self._json(LLM, {
+            "messages": messages,
+            "response": response,
+            "first_token_s": first_token - started if first_token is not None else None,
+            "total_s": now - started,
+            "stream": stream,
+        })
+
+    def tts_request(self, text: str, cached: bool) -> int:
+        self._tts_requests += 1
+        self._json(TTS_REQUEST, {"id": self._tts_requests, "text": text, "cached": cached})
+        return self._tts_requests
+
+    def tts_chunk(self, request_id: int, size: int):
+        self._json(TTS_CHUNK, {"id": request_id, "bytes": size})
+
+    def span(self, stage: str, seconds: float):
+        self._json(SPAN, {"stage": stage, "s": seconds})
+
+    def close(self):
+        if self._closed:
+            return
+        with self._lock:
+            self._flush_locked(time.monotonic())
+            self._closed = True
+        tracing.unlisten(self.session)
+        _writer.submit(self._write_index)
+        logger.info("Recorded %d records of session %s to %s", self.records, self.session, self.path)
+
+
+class Recording:
+    """Reads a file written by SessionRecorder."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = f.read()
+        magic, version, self.wall_start = _HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a session recording")
+        offset = _HEADER.size
+        (length,) = struct.unpack_from("<H", self.data, offset)
+        self.session = self.data[offset + 2:offset + 2 + length].decode("utf-8")
+        self._first_chunk = offset + 2 + length
+        self.index = self._read_index()
+
+    def _read_index(self) -> List[tuple]:
+        """(offset, first t, records) per chunk, scanned if the file has no index."""
+        if len(self.data) >= self._first_chunk + _TRAILER.size:
+            index_offset, end = _TRAILER.unpack_from(self.data, len(self.data) - _TRAILER.size)
+            if end == b"GEND" and self.data[index_offset:index_offset + 4] == b"INDX":
+                (count,) = struct.unpack_from("<I", self.data, index_offset + 4)
+                start = index_offset + 8
+                return [_INDEX_ENTRY.unpack_from(self.data, start + i * _INDEX_ENTRY.size) for i in range(count)]
+        index = []
+        offset = self._first_chunk
+        while offset + _CHUNK.size <= len(self.data):
+            magic, records, stored, _, first_t = _CHUNK.unpack_from(self.data, offset)
+            if magic != b"CHNK" or offset + _CHUNK.size + stored > len(self.data):
+                break
+            index.append((offset, first_t, records))
+            offset += _CHUNK.size + stored
+        return index
+
+    @property
+    def complete(self) -> bool:
+        return self.data.endswith(b"GEND")
+
+    def records(self, since: float = 0.0) -> Iterator[Record]:
+        """All records in time order, starting with the chunk that covers `since`."""
+        chunks = self.index
+        start = 0
+        for i, (_, first_t, _) in enumerate(chunks):
+            if first_t <= since:
+                start = i
+        for offset, _, _ in chunks[start:]:
+            _, records, stored, _, _ = _CHUNK.unpack_from(self.data, offset)
+            raw = zlib.decompress(self.data[offset + _CHUNK.size:offset + _CHUNK.size + stored])
+            position = 0
+            for _ in range(records):
+                t, kind, stream, length = _RECORD.unpack_from(raw, position)
+                position += _RECORD.size
+                if t >= since:
+                    yield Record(t, kind, stream, raw[position:position + length])
+                position += length
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+from agent import tracing
+from agent.ai_agent import AIAgent
+
+logger = logging.getLogger(__name__)
+
+
+class SessionExistsError(Exception):
+    pass
+
+
+class SessionNotFoundError(Exception):
+    pass
+
+
+class SessionCapacityError(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, meeting_id: str, token: str, name: str):
+        self.meeting_id = meeting_id
+        self.token = token
+        self.name = name
+        self.agent: Optional[AIAgent] = None
+        self.task: Optional[asyncio.Task] = None
+        # set when the agent should leave (api call or meeting ended)
+        self.stopped = asyncio.Event()
+        self.state = "queued"
+        self.created_at = time.monotonic()
+        self.joined_at: Optional[float] = None
+
+    def status(self) -> dict:
+        now = time.monotonic()
+        status = {
+            "meeting_id": self.meeting_id,
+            "state": self.state,
+            "age_s": round(now - self.created_at, 1),
+            "uptime_s": round(now - self.joined_at, 1) if self.joined_at else 0.0,
+        }
+        if self.agent is not None:
+            status["load"] = self.agent.stats()
+        return status
+
+
+class SessionManager:
+    """Registry of running AI agents keyed by meeting id.
+
+    At most `max_sessions` agents are joined at once. When full, up to
+    `max_queued` further joins wait for a free slot; beyond that they are
+    rejected with SessionCapacityError.
+    """
+
+    def __init__(self, max_sessions: int, max_queued: int = 0):
+        self.max_sessions = max_sessions
+        self.max_queued = max_queued
+        self.sessions: Dict[str, Session] = {}
+        self._slots = asyncio.Semaphore(max_sessions)
+
+    def count(self, state: str) -> int:
+        return sum(1 for s in self.sessions.values() if s.state == state)
+
+    def join(self, meeting_id: str, token: str, name: str = "AI") -> Session:
+        if meeting_id in self.sessions:
+            raise SessionExistsError(meeting_id)
+
+        full = len(self.sessions) - self.count("queued") >= self.max_sessions
+        if full and self.count("queued") >= self.max_queued:
+            raise SessionCapacityError(meeting_id)
+
+        session = Session(meeting_id, token, name)
+        if not full:
+            session.state = "joining"
+        self.sessions[meeting_id] = session
+        session.task = asyncio.create_task(self._run(session))
+        return session
+
+    async def leave(self, meeting_id: str):
+        session = self.sessions.get(meeting_id)
+        if session is None:
+            raise SessionNotFoundError(meeting_id)
+        session.stopped.set()
+        await session.task
+
+    async def shutdown(self):
+        for session in list(self.sessions.values()):
+            session.stopped.set()
+        tasks = [s.task for s in self.sessions.values() if s.task]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def status(self) -> dict:
+        return {
+            "max_sessions": self.max_sessions,
+            "max_queued": self.max_queued,
+            "running": self.count("running"),
+            "queued": self.count("queued"),
+            "sessions": [s.status() for s in self.sessions.values()],
+        }
+
+    async def _acquire(self, session: Session) -> bool:
+        """Waits for a free slot, gives up when the session is left while
+        still queued. Returns whether the slot is held."""
+        slot = asyncio.ensure_future(self._slots.acquire())
+        stopped = asyncio.ensure_future(session.stopped.wait())
+        try:
+            await asyncio.wait((slot, stopped), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+            # cancel() is False once the slot was granted
+            held = not slot.cancel() and not slot.cancelled()
+            if held and (session.stopped.is_set() or asyncio.current_task().cancelling()):
+                self._slots.release()
+                held = False
+        return held
+
+    async def _join(self, session: Session) -> bool:
+        """Joins the meeting, gives up when the session is left meanwhile.
+        Returns whether it joined, raises what the join raised."""
+        join = asyncio.ensure_future(session.agent.join())
+        stopped = asyncio.ensure_future(session.stopped.wait())
+        try:
+            await asyncio.wait((join, stopped), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stopped.cancel()
+            if not join.done():
+                # a stalled join must not hold up leave()
+                join.cancel()
+                return False
+        join.result()
+        return True
+
+    async def _run(self, session: Session):
+        try:
+            if not await self._acquire(session):
+                # left while still waiting in the queue
+                return
+            try:
+                session.state = "joining"
+                try:
+                    session.agent = AIAgent(
+                        session.meeting_id,
+                        session.token,
+                        session.name,
+                        on_leave=session.stopped.set,
+                    )
+                    if await self._join(session):
+                        session.state = "running"
+                        session.joined_at = time.monotonic()
+                        # keep the session alive without polling
+                        await session.stopped.wait()
+                except Exception as ex:
+                    logger.exception("either joining or running session %s: %s", session.meeting_id, ex)
+                finally:
+                    session.state = "leaving"
+                    if session.agent is not None:
+                        session.agent.leave()
+            finally:
+                self._slots.release()
+        finally:
+            self.sessions.pop(session.meeting_id, None)
+            tracing.drop_session(session.meeting_id)
@@ -0,0 +1,107 @@
+import asyncio
+import contextvars
+import os
+from typing import Dict, Optional
+from game.board import Board, GameState
+from intelligence.intelligence import OpenAiIntelligence
+from tts.elevenlabs import ElevenLabsTTS
+
+SPECULATE_MOVES = os.getenv("SPECULATE_MOVES", "true").lower() == "true"
+# X replies prepared per turn, most likely (strongest) first
+SPECULATION_BRANCHES = int(os.getenv("SPECULATION_BRANCHES", "4"))
+# seconds after which unfinished branches are dropped
+SPECULATION_BUDGET_S = float(os.getenv("SPECULATION_BUDGET_S", "15"))
+
+
+class Branch:
+    """O's prepared answer to one possible X move."""
+
+    __slots__ = ("position", "task")
+
+    def __init__(self, position: int, task: asyncio.Task):
+        self.position = position
+        # resolves to (comment, rendered audio or None when tts had no slot in time)
+        self.task = task
+
+
+class MoveSpeculator:
+    """Prepares the agent's reply to X's likely moves while the player is
+    still thinking: the engine move, its comment and the rendered speech.
+
+    Branches are keyed by the board after X's move, take() hands out the
+    matching one and drops the rest.
+    """
+
+    def __init__(self, intelligence: OpenAiIntelligence, tts: ElevenLabsTTS,
+                 branches: int = SPECULATION_BRANCHES, budget_s: float = SPECULATION_BUDGET_S):
+        self.intelligence = intelligence
+        self.tts = tts
+        self.max_branches = branches
+        self.budget_s = budget_s
+        self.branches: Dict[Board, Branch] = {}
+        self._deadline: Optional[asyncio.TimerHandle] = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, game_state: GameState):
+        self.cancel()
+        board = game_state.board
+        if game_state.game_over or game_state.current_player != "X" or self.max_branches <= 0:
+            return
+
+        engine = self.intelligence.engine
+        scores = engine.move_scores(board)
+        candidates = sorted(board.free_positions(), key=lambda p: scores[p], reverse=True)
+        for x_position in candidates[:self.max_branches]:
+            after_x = board.play(x_position, "X")
+            if after_x.winner() or after_x.is_full():
+                # nothing to answer, the game is over
+                continue
+            position = engine.choose_move(after_x, self.intelligence.difficulty)
+            # a fresh context, so the branch's llm and tts spans are not
+            # recorded as the latency of the turn that started it
+            task = asyncio.create_task(self._prepare(after_x, position), context=contextvars.Context())
+            self.branches[after_x] = Branch(position, task)
+
+        loop = asyncio.get_running_loop()
+        self._deadline = loop.call_later(self.budget_s, self._drop_unfinished)
+
+    async def _prepare(self, board: Board, position: int):
+        comment = await self.intelligence.generate_move_comment(board, position)
+        audio = await self.tts.render(comment)
+        return comment, audio
+
+    def take(self, board: Board) -> Optional[Branch]:
+        branch = self.branches.pop(board, None)
+        if branch is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        self.cancel()
+        return branch
+
+    def _drop_unfinished(self):
+        for board, branch in list(self.branches.items()):
+            if not branch.task.done():
+                branch.task.cancel()
+                del self.branches[board]
+
+    def cancel(self):
+        if self._deadline is not None:
+            self._deadline.cancel()
+            self._deadline = None
+        for branch in self.branches.values():
+            branch.task.cancel()
+        self.branches.clear()
+
+    def stats(self) -> dict:
+        return {"speculation_hits": self.hits, "speculation_misses": self.misses}
+
+
+async def branch_result(branch: Branch):
+    """(comment, audio) of a branch, waiting for it if it is still being
+    prepared, or None if it failed or was dropped."""
+    await asyncio.wait([branch.task])
+    if branch.task.cancelled() or branch.task.exception() is not None:
+        return None
+    return branch.task.result()
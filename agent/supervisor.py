@@ -0,0 +1,342 @@
+import asyncio
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# worker processes, each one runs main:app with its own SessionManager
+WORKERS = int(os.getenv("WORKERS", "0")) or os.cpu_count() or 1
+# workers listen on consecutive local ports from here
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "9100"))
+HEALTH_INTERVAL_S = 2.0
+# failed health checks in a row before a worker is restarted
+HEALTH_FAILURES = 3
+# seconds a drained worker gets for its meetings to end before it is restarted anyway
+DRAIN_TIMEOUT_S = float(os.getenv("DRAIN_TIMEOUT_S", "600"))
+# samples of a metric family named after it, e.g. a histogram's buckets
+_SAMPLE_SUFFIXES = ("_bucket", "_sum", "_count", "_total", "_created")
+
+
+class Worker:
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        # meetings routed here, reconciled with the worker's own list on every health check
+        self.meetings = set()
+        self.healthy = False
+        self.draining = False
+        self.failures = 0
+        self.restarts = 0
+        self.started_at = 0.0
+        self.last_status: dict = {}
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.port)],
+            env=dict(os.environ, WORKER_INDEX=str(self.index)),
+        )
+        self.started_at = time.monotonic()
+        self.healthy = False
+        self.failures = 0
+        self.meetings.clear()
+
+    def stop(self, timeout: float = 30.0):
+        if self.process is None or self.process.poll() is not None:
+            return
+        # SIGTERM runs the worker's shutdown, its agents leave their meetings
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+    def accepting(self) -> bool:
+        return self.healthy and not self.draining
+
+    def status(self) -> dict:
+        return {
+            "index": self.index,
+            "port": self.port,
+            "pid": self.process.pid if self.process else None,
+            "healthy": self.healthy,
+            "draining": self.draining,
+            "restarts": self.restarts,
+            "meetings": len(self.meetings),
+            "uptime_s": round(time.monotonic() - self.started_at, 1),
+        }
+
+
+class Supervisor:
+    """Runs the agents in `workers` processes and routes each meeting to one.
+
+    Joins go to the least loaded healthy worker, leaves to the worker that
+    holds the meeting. Workers that stop answering health checks are
+    restarted; drain() stops new placements on a worker and restarts it
+    once its meetings are over.
+    """
+
+    def __init__(self, workers: int = WORKERS, base_port: int = WORKER_BASE_PORT):
+        self.workers = [Worker(i, base_port + i) for i in range(workers)]
+        self.placement: Dict[str, Worker] = {}
+        self.client: Optional[httpx.AsyncClient] = None
+        self._health_task: Optional[asyncio.Task] = None
+        self._drain_tasks = set()
+        # joins waiting for the worker's answer, not in its session list yet
+        self._joining = set()
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=2.0))
+        for worker in self.workers:
+            worker.start()
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def shutdown(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+        for task in list(self._drain_tasks):
+            task.cancel()
+        await asyncio.gather(*(asyncio.to_thread(w.stop) for w in self.workers))
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.gather(*(self._check(w) for w in self.workers))
+            await asyncio.sleep(HEALTH_INTERVAL_S)
+
+    async def _check(self, worker: Worker):
+        if worker.process is not None and worker.process.poll() is not None:
+            logger.error("worker %d exited with %s, restarting", worker.index, worker.process.returncode)
+            await self._restart(worker)
+            return
+        try:
+            response = await self.client.get(f"{worker.url}/sessions", timeout=HEALTH_INTERVAL_S)
+            response.raise_for_status()
+        except httpx.HTTPError:
+            worker.failures += 1
+            # a worker that is still starting up is not counted as failing yet
+            if worker.healthy and worker.failures >= HEALTH_FAILURES:
+                logger.error("worker %d failed %d health checks, restarting", worker.index, worker.failures)
+                await self._restart(worker)
+            return
+        worker.failures = 0
+        worker.healthy = True
+        worker.last_status = response.json()
+        live = {s["meeting_id"] for s in worker.last_status.get("sessions", ())}
+        # meetings that ended on their own are no longer placed here
+        keep = live | self._joining
+        for meeting_id in worker.meetings - keep:
+            if self.placement.get(meeting_id) is worker:
+                del self.placement[meeting_id]
+        worker.meetings &= keep
+        for meeting_id in live:
+            worker.meetings.add(meeting_id)
+            self.placement[meeting_id] = worker
+
+    async def _restart(self, worker: Worker):
+        for meeting_id in worker.meetings:
+            self.placement.pop(meeting_id, None)
+        worker.healthy = False
+        await asyncio.to_thread(worker.stop, 5.0)
+        worker.start()
+        worker.restarts += 1
+
+    def _candidates(self) -> List[Worker]:
+        return sorted((w for w in self.workers if w.accepting()), key=lambda w: len(w.meetings))
+
+    async def join(self, body: dict) -> httpx.Response:
+        meeting_id = body["meeting_id"]
+        if meeting_id in self.placement:
+            raise HTTPException(status_code=409, detail="AI agent already in this meeting")
+        response = None
+        self._joining.add(meeting_id)
+        try:
+            for worker in self._candidates():
+                # reserve the slot before awaiting, so concurrent joins spread out
+                worker.meetings.add(meeting_id)
+                self.placement[meeting_id] = worker
+                try:
+                    response = await self.client.post(f"{worker.url}/join-player", json=body)
+                except httpx.HTTPError:
+                    response = None
+                if response is not None and response.status_code < 400:
+                    return response
+                worker.meetings.discard(meeting_id)
+                self.placement.pop(meeting_id, None)
+                # only a full worker is worth skipping, other errors go back to the caller
+                if response is not None and response.status_code != 503:
+                    return response
+        finally:
+            self._joining.discard(meeting_id)
+        if response is not None:
+            return response
+        raise HTTPException(status_code=503, detail="No worker available, try again later")
+
+    async def leave(self, meeting_id: str) -> httpx.Response:
+        worker = self.placement.get(meeting_id)
+        if worker is None:
+            raise HTTPException(status_code=404, detail="No AI agent in this meeting")
+        response = await self.client.post(f"{worker.url}/leave-player", json={"meeting_id": meeting_id})
+        if response.status_code < 400 or response.status_code == 404:
+            worker.meetings.discard(meeting_id)
+            self.placement.pop(meeting_id, None)
+        return response
+
+    def drain(self, worker: Worker):
+        if worker.draining:
+            return
+        worker.draining = True
+        task = asyncio.create_task(self._drain(worker))
+        self._drain_tasks.add(task)
+        task.add_done_callback(self._drain_tasks.discard)
+
+    async def _drain(self, worker: Worker):
+        deadline = time.monotonic() + DRAIN_TIMEOUT_S
+        while worker.meetings and time.monotonic() < deadline:
+            await asyncio.sleep(HEALTH_INTERVAL_S)
+        logger.info("worker %d drained, restarting", worker.index)
+        await self._restart(worker)
+        worker.draining = False
+
+    async def status(self) -> dict:
+        workers = []
+        for worker in self.workers:
+            status = worker.status()
+            status["sessions"] = worker.last_status.get("sessions", [])
+            workers.append(status)
+        return {
+            "workers": workers,
+            "running": sum(w.last_status.get("running", 0) for w in self.workers),
+            "queued": sum(w.last_status.get("queued", 0) for w in self.workers),
+            "meetings": len(self.placement),
+        }
+
+    async def metrics(self) -> str:
+        """Metrics of all workers, with a worker label added to every sample.
+        Samples are grouped by metric family under a single HELP and TYPE
+        header, as the exposition format requires."""
+        responses = await asyncio.gather(
+            *(self.client.get(f"{w.url}/metrics") for w in self.workers if w.healthy),
+            return_exceptions=True,
+        )
+        # family name -> its header lines and the samples of every worker, in first seen order
+        families: Dict[str, Tuple[List[str], List[str]]] = {}
+        for worker, response in zip([w for w in self.workers if w.healthy], responses):
+            if isinstance(response, Exception) or response.status_code != 200:
+                continue
+            family = None
+            for line in response.text.splitlines():
+                if line.startswith("# HELP ") or line.startswith("# TYPE "):
+                    family = line.split(" ", 3)[2]
+                    headers = families.setdefault(family, ([], []))[0]
+                    if line not in headers:
+                        headers.append(line)
+                    continue
+                if not line or line.startswith("#"):
+                    continue
+                if "{" in line:
+                    name = line[:line.index("{")]
+                    sample = line.replace("{", f'{{worker="{worker.index}",', 1)
+                else:
+                    name, value = line.split(" ", 1)
+                    sample = f'{name}{{worker="{worker.index}"}} {value}'
+                if family is None or name != family and name not in (family + suffix for suffix in _SAMPLE_SUFFIXES):
+                    # a sample without a header of its own
+                    family = name
+                families.setdefault(family, ([], []))[1].append(sample)
+        lines = []
+        for headers, samples in families.values():
+            lines += headers
+            lines += samples
+        return "\n".join(lines) + "\n"
+
+    def worker(self, index: int) -> Worker:
+        if not 0 <= index < len(self.workers):
+            raise HTTPException(status_code=404, detail="No such worker")
+        return self.workers[index]
+
+
+class MeetingReqConfig(BaseModel):
+    meeting_id: str
+    token: str
+
+
+class LeaveReqConfig(BaseModel):
+    meeting_id: str
+
+
+supervisor = Supervisor()
+app = FastAPI()
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+def _forward(response: httpx.Response):
+    if response.status_code >= 400:
+        try:
+            detail = response.json().get("detail")
+        except (ValueError, AttributeError):
+            # not fastapi's json error, e.g. a plain text 500 or a proxy's error page
+            detail = response.text
+        raise HTTPException(status_code=response.status_code, detail=detail)
+    return response.json()
+
+
+@app.on_event("startup")
+async def startup():
+    await supervisor.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await supervisor.shutdown()
+
+
+@app.post("/join-player")
+async def join_player(req: MeetingReqConfig):
+    return _forward(await supervisor.join(req.dict()))
+
+
+@app.post("/leave-player")
+async def leave_player(req: LeaveReqConfig):
+    return _forward(await supervisor.leave(req.meeting_id))
+
+
+@app.get("/sessions")
+async def sessions():
+    return await supervisor.status()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(await supervisor.metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/workers")
+async def workers():
+    return [w.status() for w in supervisor.workers]
+
+
+@app.post("/workers/{index}/drain")
+async def drain_worker(index: int):
+    supervisor.drain(supervisor.worker(index))
+    return {"message": "Worker draining", "worker": index}
@@ -0,0 +1,142 @@
+import contextvars
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 3.0, 5.0, 10.0)
+
+# stages of a turn:
+#   stt              end of the player's speech -> final transcript
+#   llm_first_token  llm request sent -> first token (the whole response when not streamed)
+#   tts_first_byte   tts request sent -> first audio byte
+#   first_audio      start of the turn -> first non-silent frame sent
+#   turn             end of the player's speech -> first non-silent frame sent
+#   barge_in         start of the batch a player's speech was heard in -> the agent's
+#                    speech cut off (it fades out over the next frame)
+STAGES = ("stt", "llm_first_token", "tts_first_byte", "first_audio", "turn", "barge_in")
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += seconds
+        self.count += 1
+
+
+_lock = threading.Lock()
+# all sessions together, kept for the life of the process
+_stage_histograms: Dict[str, LatencyHistogram] = {}
+# per (session, stage), dropped when the session ends
+_session_histograms: Dict[Tuple[str, str], LatencyHistogram] = {}
+# listener(stage, seconds) of a session, e.g. its recorder
+_listeners: Dict[str, Callable[[str, float], None]] = {}
+
+
+def observe(session: str, stage: str, seconds: float):
+    with _lock:
+        for table, key in ((_stage_histograms, stage), (_session_histograms, (session, stage))):
+            histogram = table.get(key)
+            if histogram is None:
+                histogram = table[key] = LatencyHistogram()
+            histogram.observe(seconds)
+    listener = _listeners.get(session)
+    if listener is not None:
+        listener(stage, seconds)
+
+
+def listen(session: str, listener: Callable[[str, float], None]):
+    """Also passes every span of `session` to `listener(stage, seconds)`."""
+    _listeners[session] = listener
+
+
+def unlisten(session: str):
+    _listeners.pop(session, None)
+
+
+def drop_session(session: str):
+    with _lock:
+        for key in [key for key in _session_histograms if key[0] == session]:
+            del _session_histograms[key]
+    _listeners.pop(session, None)
+
+
+class Turn:
+    """One reply or move of the agent, from the player's speech (or move) to
+    the first audio the agent sends back."""
+
+    __slots__ = ("session", "kind", "started", "speech_end", "audio_sent")
+
+    def __init__(self, session: str, kind: str, speech_end: Optional[float] = None):
+        self.session = session
+        self.kind = kind
+        self.started = time.monotonic()
+        self.speech_end = speech_end
+        self.audio_sent = False
+        if speech_end is not None:
+            observe(session, "stt", self.started - speech_end)
+
+    def span(self, stage: str, start: float):
+        observe(self.session, stage, time.monotonic() - start)
+
+    def first_audio(self):
+        if self.audio_sent:
+            return
+        self.audio_sent = True
+        now = time.monotonic()
+        observe(self.session, "first_audio", now - self.started)
+        if self.speech_end is not None:
+            observe(self.session, "turn", now - self.speech_end)
+
+
+# turn of the running task, read by the llm and tts code to attach their spans
+current_turn: contextvars.ContextVar[Optional[Turn]] = contextvars.ContextVar("current_turn", default=None)
+
+
+def start_turn(session: str, kind: str, speech_end: Optional[float] = None) -> Turn:
+    """Starts a turn for the current task and the tasks it creates."""
+    turn = Turn(session, kind, speech_end)
+    current_turn.set(turn)
+    return turn
+
+
+def _format_histogram(name: str, labels: str, histogram: LatencyHistogram, lines: List[str]):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f"{name}_sum{{{labels}}} {histogram.total:.6f}")
+    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+
+def render_prometheus() -> str:
+    """Latency histograms in the Prometheus text exposition format."""
+    lines = [
+        "# HELP agent_stage_latency_seconds Latency of each stage of the agent's turns.",
+        "# TYPE agent_stage_latency_seconds histogram",
+    ]
+    with _lock:
+        for stage, histogram in sorted(_stage_histograms.items()):
+            _format_histogram("agent_stage_latency_seconds", f'stage="{stage}"', histogram, lines)
+        lines.append("# HELP agent_session_stage_latency_seconds Latency of each stage per running session.")
+        lines.append("# TYPE agent_session_stage_latency_seconds histogram")
+        for (session, stage), histogram in sorted(_session_histograms.items()):
+            labels = f'session="{escape_label(session)}",stage="{stage}"'
+            _format_histogram("agent_session_stage_latency_seconds", labels, histogram, lines)
+    return "\n".join(lines) + "\n"
+
+
+def escape_label(value: str) -> str:
+    """A Prometheus label value with backslashes, quotes and newlines escaped."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
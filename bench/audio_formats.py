@@ -0,0 +1,117 @@
+"""Compares audio output configurations: for each track rate and tts output
+format, the bytes downloaded, the CPU spent decoding and resampling into
+the track's rate, framing 20 ms frames and opus encoding them (the
+meeting's encoder resamples anything but 48 kHz), and the time to the
+first frame.
+
+    python -m bench.audio_formats [--seconds 10] [--link-kbps 1000] [--rates 16000,24000,48000] [--json]
+
+Time to first frame counts from the first byte of the tts response: the
+download of the chunks up to the first whole frame at --link-kbps, plus
+converting them. The fake speech comes from bench.fake_vendors, chunked
+the same way.
+"""
+import argparse
+import json
+import time
+
+from vsaiortc.codecs.opus import OpusEncoder
+
+from agent.audio_stream_track import AUDIO_PTIME, PcmRingBuffer, build_audio_frame
+from bench.fake_vendors import TTS_CHUNK_SECONDS, fake_speech
+from tts.audio_format import PcmConverter, negotiate_format
+
+FORMATS = ("pcm_16000", "pcm_22050", "pcm_24000", "pcm_44100", "ulaw_8000", "mp3_22050_32", "mp3_44100_64")
+RATES = (16000, 24000, 48000)
+
+
+def measure(rate: int, output_format: str, seconds: float, link_kbps: float) -> dict:
+    audio, bytes_per_s = fake_speech(seconds, output_format)
+    chunk_bytes = int(TTS_CHUNK_SECONDS * bytes_per_s) & ~1
+    converter = PcmConverter(output_format, rate)
+    samples = int(AUDIO_PTIME * rate)
+    ring = PcmRingBuffer(int(rate * (seconds + 1)))
+
+    first_frame_s = None
+    downloaded = 0
+    convert_s = 0.0
+    for start in range(0, len(audio), chunk_bytes):
+        chunk = audio[start:start + chunk_bytes]
+        downloaded += len(chunk)
+        started = time.thread_time()
+        ring.write(memoryview(converter.convert(chunk)))
+        convert_s += time.thread_time() - started
+        if first_frame_s is None and len(ring) >= samples:
+            first_frame_s = downloaded * 8 / (link_kbps * 1000) + convert_s
+    started = time.thread_time()
+    ring.write(memoryview(converter.flush()))
+    convert_s += time.thread_time() - started
+    ring.pad(samples)
+
+    encoder = OpusEncoder()
+    frames = len(ring) // samples
+    frame_s = encode_s = 0.0
+    for n in range(frames):
+        started = time.thread_time()
+        frame = build_audio_frame(ring.peek(samples))
+        ring.advance(samples)
+        frame.pts = n * samples
+        frame.sample_rate = rate
+        framed = time.thread_time()
+        encoder.encode(frame)
+        frame_s += framed - started
+        encode_s += time.thread_time() - framed
+
+    per_s = lambda s: round(1000 * s / seconds, 3)
+    total = convert_s + frame_s + encode_s
+    return {
+        "rate": rate,
+        "format": output_format,
+        "passthrough": converter.passthrough,
+        "kbps": round(len(audio) * 8 / seconds / 1000, 1),
+        "convert_ms_per_s": per_s(convert_s),
+        "frame_ms_per_s": per_s(frame_s),
+        "opus_ms_per_s": per_s(encode_s),
+        "total_ms_per_s": per_s(total),
+        # streams one core keeps up with in real time
+        "streams_per_core": round(seconds / total) if total else None,
+        "first_frame_ms": round(1000 * first_frame_s, 1) if first_frame_s is not None else None,
+    }
+
+
+def print_report(results: list):
+    print(f"{'rate':>6} {'format':<14}{'kbps':>7}{'convert':>9}{'frame':>8}{'opus':>8}{'total':>8}"
+          f"{'streams':>9}{'first frame':>13}")
+    print(f"{'':>6} {'':<14}{'':>7}{'ms/s':>9}{'ms/s':>8}{'ms/s':>8}{'ms/s':>8}{'per core':>9}{'ms':>13}")
+    for r in results:
+        name = r["format"] + ("*" if r["default"] else "")
+        print(f"{r['rate']:>6} {name:<14}{r['kbps']:>7}{r['convert_ms_per_s']:>9}{r['frame_ms_per_s']:>8}"
+              f"{r['opus_ms_per_s']:>8}{r['total_ms_per_s']:>8}{r['streams_per_core']:>9}{r['first_frame_ms']:>13}")
+    print("* format picked for the rate when TTS_OUTPUT_FORMAT is empty")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of the speech per configuration")
+    parser.add_argument("--link-kbps", type=float, default=1000.0, help="download speed from the tts api")
+    parser.add_argument("--rates", default=",".join(map(str, RATES)), help="track rates to compare")
+    parser.add_argument("--formats", default=",".join(FORMATS), help="tts output formats to compare")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = []
+    for rate in map(int, args.rates.split(",")):
+        default = negotiate_format(rate)
+        for output_format in args.formats.split(","):
+            result = measure(rate, output_format, args.seconds, args.link_kbps)
+            result["default"] = output_format == default
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
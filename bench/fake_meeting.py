@@ -0,0 +1,182 @@
+"""In-process stand-in for a VideoSDK meeting: pubsub between the agent and
+a scripted (or replayed) player, and the player's microphone as an audio track."""
+import asyncio
+import time
+from fractions import Fraction
+from typing import Callable, Dict, List
+
+import numpy as np
+from av import AudioFrame
+
+PLAYER_SAMPLE_RATE = 48000
+PLAYER_PTIME = 0.02
+
+
+class FakePubSub:
+    def __init__(self):
+        self.subscribers: Dict[str, List[Callable]] = {}
+
+    async def subscribe(self, pubsub_config):
+        self.subscribers.setdefault(pubsub_config["topic"], []).append(pubsub_config["cb"])
+
+    async def publish(self, pubsub_config):
+        self.deliver(pubsub_config["topic"], pubsub_config["message"])
+
+    def deliver(self, topic: str, message: str):
+        # every subscriber gets every message, the sender included, like the real pubsub
+        loop = asyncio.get_running_loop()
+        for cb in self.subscribers.get(topic, ()):
+            loop.call_soon(cb, {"message": message, "topic": topic, "timestamp": time.time()})
+
+
+class PlayerAudioTrack:
+    """48 kHz stereo microphone of the player: low background noise, and
+    louder noise while speak() is running."""
+
+    kind = "audio"
+
+    def __init__(self, seed: int = 0):
+        self.rng = np.random.default_rng(seed)
+        self.samples = int(PLAYER_SAMPLE_RATE * PLAYER_PTIME)
+        self._speaking_until = 0.0
+        self._start = None
+        self._timestamp = 0
+        self.speech_end = None
+
+    def speak(self, seconds: float):
+        now = time.monotonic()
+        self._speaking_until = now + seconds
+        self.speech_end = now + seconds
+
+    async def recv(self) -> AudioFrame:
+        if self._start is None:
+            self._start = time.monotonic()
+        self._timestamp += self.samples
+        wait = self._start + self._timestamp / PLAYER_SAMPLE_RATE - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        level = 4000 if time.monotonic() < self._speaking_until else 30
+        samples = (self.rng.standard_normal(self.samples * 2) * level).clip(-32768, 32767).astype(np.int16)
+        frame = AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="stereo")
+        frame.sample_rate = PLAYER_SAMPLE_RATE
+        frame.pts = self._timestamp
+        frame.time_base = Fraction(1, PLAYER_SAMPLE_RATE)
+        return frame
+
+
+class ReplayAudioTrack:
+    """Microphone that plays back recorded mono int16 speech fed to it with
+    feed(), and silence in between."""
+
+    kind = "audio"
+
+    def __init__(self, sample_rate: int):
+        self.sample_rate = sample_rate
+        self.samples = int(sample_rate * PLAYER_PTIME)
+        self._pending = bytearray()
+        self._start = None
+        self._timestamp = 0
+
+    def feed(self, pcm: bytes):
+        self._pending += pcm
+
+    async def recv(self) -> AudioFrame:
+        if self._start is None:
+            self._start = time.monotonic()
+        self._timestamp += self.samples
+        wait = self._start + self._timestamp / self.sample_rate - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        size = self.samples * 2
+        chunk = bytes(self._pending[:size])
+        del self._pending[:size]
+        samples = np.zeros(self.samples, dtype=np.int16)
+        samples[:len(chunk) // 2] = np.frombuffer(chunk, dtype=np.int16)
+        frame = AudioFrame.from_ndarray(samples.reshape(1, -1), format="s16", layout="mono")
+        frame.sample_rate = self.sample_rate
+        frame.pts = self._timestamp
+        frame.time_base = Fraction(1, self.sample_rate)
+        return frame
+
+
+class FakeStream:
+    def __init__(self, kind: str, track):
+        self.kind = kind
+        self.track = track
+
+
+class FakeParticipant:
+    def __init__(self, participant_id: str, display_name: str):
+        self.id = participant_id
+        self.display_name = display_name
+        self.listeners = []
+
+    def add_event_listener(self, listener):
+        self.listeners.append(listener)
+
+
+class FakeMeeting:
+    def __init__(self, meeting_id: str, agent_track, seed: int = 0, player: bool = True):
+        self.meeting_id = meeting_id
+        self.agent_track = agent_track
+        self.pubsub = FakePubSub()
+        self.listeners = []
+        self.joined = False
+        self.players = []
+        self.player = self.player_track = None
+        if player:
+            self.player = FakeParticipant(f"player-{meeting_id}", "Player")
+            self.player_track = PlayerAudioTrack(seed)
+            self.players.append((self.player, self.player_track))
+
+    def add_event_listener(self, listener):
+        self.listeners.append(listener)
+
+    def add_player(self, participant_id: str, display_name: str, track) -> FakeParticipant:
+        """A participant with `track` as microphone, joining now if the agent is in."""
+        participant = FakeParticipant(participant_id, display_name)
+        self.players.append((participant, track))
+        if self.joined:
+            self._announce(participant, track)
+        return participant
+
+    def _announce(self, participant: FakeParticipant, track):
+        for listener in self.listeners:
+            listener.on_participant_joined(participant)
+        for listener in participant.listeners:
+            listener.on_stream_enabled(FakeStream("audio", track))
+
+    async def async_join(self):
+        self.joined = True
+        for listener in self.listeners:
+            listener.on_meeting_joined({})
+        # the players are already in the meeting with their microphones on
+        for participant, track in self.players:
+            self._announce(participant, track)
+
+    def leave(self):
+        for listener in self.listeners:
+            listener.on_meeting_left({})
+
+
+class FakeVideoSDK:
+    """Replaces videosdk.VideoSDK in agent.ai_agent, see install()."""
+
+    meetings: Dict[str, FakeMeeting] = {}
+    # start meetings with a scripted player in them, replays add their own
+    default_player = True
+
+    @classmethod
+    def init_meeting(cls, meeting_id: str, custom_microphone_audio_track=None, **config) -> FakeMeeting:
+        meeting = FakeMeeting(meeting_id, custom_microphone_audio_track, seed=len(cls.meetings),
+                              player=cls.default_player)
+        cls.meetings[meeting_id] = meeting
+        return meeting
+
+
+def install():
+    """Points AIAgent at fake meetings instead of VideoSDK."""
+    from agent import ai_agent
+    ai_agent.VideoSDK = FakeVideoSDK
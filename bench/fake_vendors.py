@@ -0,0 +1,334 @@
+"""Local stand-ins for the OpenAI, ElevenLabs and Deepgram APIs.
+
+    python -m bench.fake_vendors [--port 8100] [--deepgram-port 8101] [--llm-latency 0.4] ...
+
+The http fakes (OpenAI chat completions, ElevenLabs voices and streaming
+tts) share one FastAPI app, the Deepgram live protocol is a websocket
+server. Latencies are configurable so hosts can be sized against the
+vendor numbers seen in production. With --replay a session recording
+supplies the answers and their latencies instead, see bench.replay.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict, deque
+from functools import lru_cache
+from typing import Optional
+
+import av
+import numpy as np
+import uvicorn
+import websockets
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# what the api answers with when the request names no output format
+TTS_DEFAULT_FORMAT = "mp3_44100_128"
+# spoken length of the fake speech per character of text
+TTS_SECONDS_PER_CHAR = 0.06
+TTS_CHUNK_SECONDS = 0.1
+
+LLM_REPLY = "Nice try, but I have seen that one before. Watch this, you will not like my next move."
+TRANSCRIPTS = (
+    "are you even trying",
+    "this is fun, I like this game",
+    "I think I have got you this time",
+    "how did you learn to play like that",
+)
+
+
+def _ulaw_encode(samples: np.ndarray) -> bytes:
+    sign = (samples < 0).astype(np.int32) << 7
+    magnitude = np.minimum(np.abs(samples.astype(np.int32)), 32635) + 0x84
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | exponent << 4 | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+
+def _mp3_encode(samples: np.ndarray, rate: int, bit_rate: int) -> bytes:
+    # a bare frame stream like the api's, no id3 tag or container
+    codec = av.CodecContext.create("libmp3lame", "w")
+    codec.sample_rate = rate
+    codec.layout = "mono"
+    codec.format = "s16p"
+    codec.bit_rate = bit_rate
+    codec.open()
+    out = []
+    for start in range(0, len(samples), codec.frame_size):
+        piece = np.zeros(codec.frame_size, dtype=np.int16)
+        piece[:len(samples) - start] = samples[start:start + codec.frame_size]
+        frame = av.AudioFrame.from_ndarray(piece.reshape(1, -1), format="s16p", layout="mono")
+        frame.sample_rate = rate
+        frame.pts = start
+        out += [bytes(packet) for packet in codec.encode(frame)]
+    out += [bytes(packet) for packet in codec.encode(None)]
+    return b"".join(out)
+
+
+@lru_cache(maxsize=256)
+def fake_speech(seconds: float, output_format: str) -> tuple:
+    """(audio, bytes per second) of a tone `seconds` long in an ElevenLabs
+    output format: pcm_<rate>, ulaw_<rate> or mp3_<rate>_<kbps>."""
+    from tts.audio_format import parse_format
+    codec, rate, bytes_per_s = parse_format(output_format)
+    t = np.arange(int(seconds * rate)) / rate
+    samples = (3000 * np.sin(2 * np.pi * 220 * t)).astype(np.int16)
+    if codec == "ulaw":
+        return _ulaw_encode(samples), bytes_per_s
+    if codec == "mp3":
+        return _mp3_encode(samples, rate, bytes_per_s * 8), bytes_per_s
+    return samples.tobytes(), bytes_per_s
+
+
+def messages_key(messages) -> str:
+    return hashlib.sha1(json.dumps(messages, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ReplayScript:
+    """LLM answers, tts latencies and transcripts of a session recording."""
+
+    def __init__(self, path: str):
+        from agent import recorder
+        # messages key -> (response, first token s, total s) in recorded order
+        self.llm = defaultdict(deque)
+        self.tts_latency = {}
+        self.transcripts = deque()
+        tts_requests = {}
+        for record in recorder.Recording(path).records():
+            if record.kind == recorder.LLM:
+                data = record.json()
+                self.llm[messages_key(data["messages"])].append(
+                    (data["response"], data["first_token_s"] or data["total_s"], data["total_s"]))
+            elif record.kind == recorder.TTS_REQUEST:
+                data = record.json()
+                tts_requests[data["id"]] = (data["text"], record.t)
+            elif record.kind == recorder.TTS_CHUNK:
+                data = record.json()
+                request = tts_requests.pop(data["id"], None)
+                if request is not None:
+                    self.tts_latency.setdefault(request[0], record.t - request[1])
+            elif record.kind == recorder.TRANSCRIPT:
+                self.transcripts.append(record.json()["text"])
+
+    def answer(self, messages) -> Optional[tuple]:
+        answers = self.llm.get(messages_key(messages))
+        if not answers:
+            return None
+        # the same prompt again gets the next recorded answer, the last one is kept
+        return answers.popleft() if len(answers) > 1 else answers[0]
+
+
+class VendorConfig:
+    def __init__(self, llm_latency=0.4, llm_token_interval=0.02, tts_latency=0.25,
+                 tts_realtime_factor=4.0, stt_latency=0.15, script: Optional[ReplayScript] = None):
+        # seconds to the first token, then between tokens
+        self.llm_latency = llm_latency
+        self.llm_token_interval = llm_token_interval
+        # seconds to the first audio byte, then audio is streamed this much faster than real time
+        self.tts_latency = tts_latency
+        self.tts_realtime_factor = tts_realtime_factor
+        # seconds from Finalize (or the end of speech) to the final transcript
+        self.stt_latency = stt_latency
+        self.script = script
+        self._sentence = 0
+
+    def next_transcript(self) -> str:
+        if self.script is not None and self.script.transcripts:
+            return self.script.transcripts.popleft()
+        self._sentence += 1
+        return TRANSCRIPTS[(self._sentence - 1) % len(TRANSCRIPTS)]
+
+
+def create_app(config: VendorConfig) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+        model = body.get("model", "gpt-3.5-turbo")
+        # parse_move prompts get a number back, everything else the canned reply
+        content = "-1" if "tic-tac-toe move" in body["messages"][-1]["content"] else LLM_REPLY
+        prompt_tokens = sum(len(m["content"]) // 4 + 4 for m in body["messages"])
+        latency, token_interval = config.llm_latency, config.llm_token_interval
+        answer = config.script.answer(body["messages"]) if config.script else None
+        if answer is not None:
+            content, latency, total = answer
+            token_interval = max(total - latency, 0.0) / max(len(content.split(" ")) - 1, 1)
+
+        if not body.get("stream"):
+            await asyncio.sleep(latency + token_interval * (len(content.split(" ")) - 1))
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 20, "total_tokens": prompt_tokens + 20},
+            })
+
+        async def events():
+            tokens = [word + " " for word in content.split(" ")]
+            await asyncio.sleep(latency)
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(token_interval)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk)}\n\n"
+            if body.get("stream_options", {}).get("include_usage"):
+                usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+                         "total_tokens": prompt_tokens + len(tokens)}
+                yield f"data: {json.dumps(dict(chunk, choices=[], usage=usage))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/v1/voices")
+    async def voices():
+        return {"voices": [{"voice_id": "fake-voice", "name": "Will", "category": "premade"}]}
+
+    @app.post("/v1/text-to-speech/{voice_id}/stream")
+    async def text_to_speech(voice_id: str, request: Request, output_format: str = TTS_DEFAULT_FORMAT):
+        body = await request.json()
+        audio_bytes, bytes_per_s = fake_speech(len(body.get("text", "")) * TTS_SECONDS_PER_CHAR, output_format)
+        chunk_bytes = int(TTS_CHUNK_SECONDS * bytes_per_s) & ~1
+
+        latency = config.tts_latency
+        if config.script is not None:
+            latency = config.script.tts_latency.get(body.get("text", ""), latency)
+
+        async def audio():
+            await asyncio.sleep(latency)
+            for start in range(0, len(audio_bytes), chunk_bytes):
+                if start:
+                    await asyncio.sleep(TTS_CHUNK_SECONDS / config.tts_realtime_factor)
+                yield audio_bytes[start:start + chunk_bytes]
+
+        return StreamingResponse(audio(), media_type="application/octet-stream")
+
+    return app
+
+
+def _result(transcript: str, start: float, duration: float, from_finalize: bool) -> str:
+    words = transcript.split()
+    step = duration / max(len(words), 1)
+    return json.dumps({
+        "type": "Results",
+        "channel_index": [0, 1],
+        "duration": duration,
+        "start": start,
+        "is_final": True,
+        "speech_final": not from_finalize,
+        "from_finalize": from_finalize,
+        "channel": {"alternatives": [{
+            "transcript": transcript,
+            "confidence": 0.98,
+            "words": [
+                {"word": w, "start": start + i * step, "end": start + (i + 1) * step, "confidence": 0.98}
+                for i, w in enumerate(words)
+            ],
+        }]},
+        "metadata": {
+            "request_id": "fake",
+            "model_uuid": "fake",
+            "model_info": {"name": "fake", "version": "1", "arch": "fake"},
+        },
+    })
+
+
+async def deepgram_session(websocket, config: VendorConfig, sample_rate: int = 16000):
+    """Deepgram live protocol for one stream. Audio is only measured, every
+    utterance (audio followed by Finalize or a pause) is transcribed to the
+    next canned (or recorded) sentence."""
+    received = 0.0  # seconds of audio so far
+    utterance_start = None
+    last_audio = 0.0
+
+    async def send_final(from_finalize: bool):
+        nonlocal utterance_start
+        if utterance_start is None:
+            if from_finalize:
+                # deepgram answers every finalize, with nothing new if need be
+                await websocket.send(_result("", received, 0.0, from_finalize))
+            return
+        start, duration = utterance_start, received - utterance_start
+        utterance_start = None
+        await asyncio.sleep(config.stt_latency)
+        await websocket.send(_result(config.next_transcript(), start, duration, from_finalize))
+
+    async def endpointing():
+        # a pause in the audio ends the utterance, like deepgram's own endpointing
+        while True:
+            await asyncio.sleep(0.1)
+            if utterance_start is not None and time.monotonic() - last_audio > 0.5:
+                await send_final(from_finalize=False)
+
+    endpoint_task = asyncio.create_task(endpointing())
+    try:
+        async for message in websocket:
+            if isinstance(message, bytes):
+                if utterance_start is None:
+                    utterance_start = received
+                    await websocket.send(json.dumps({"type": "SpeechStarted", "channel": [0], "timestamp": received}))
+                received += len(message) / 2 / sample_rate
+                last_audio = time.monotonic()
+                continue
+            kind = json.loads(message).get("type")
+            if kind == "Finalize":
+                await send_final(from_finalize=True)
+            elif kind == "CloseStream":
+                await send_final(from_finalize=True)
+                await websocket.send(json.dumps({
+                    "type": "Metadata", "transaction_key": "fake", "request_id": "fake",
+                    "sha256": "", "created": "", "duration": received, "channels": 1,
+                }))
+                break
+    except websockets.ConnectionClosed:
+        pass
+    finally:
+        endpoint_task.cancel()
+
+
+async def serve(port: int, deepgram_port: int, config: VendorConfig, host: str = "127.0.0.1"):
+    server = uvicorn.Server(uvicorn.Config(create_app(config), host=host, port=port, log_level="warning"))
+    async with websockets.serve(lambda ws: deepgram_session(ws, config), host, deepgram_port):
+        await server.serve()
+
+
+def main():
+    # the load test probes the ports before connecting, not a failed handshake worth logging
+    logging.getLogger("websockets.server").setLevel(logging.CRITICAL)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100, help="OpenAI and ElevenLabs http port")
+    parser.add_argument("--deepgram-port", type=int, default=8101)
+    parser.add_argument("--llm-latency", type=float, default=0.4)
+    parser.add_argument("--llm-token-interval", type=float, default=0.02)
+    parser.add_argument("--tts-latency", type=float, default=0.25)
+    parser.add_argument("--tts-realtime-factor", type=float, default=4.0)
+    parser.add_argument("--stt-latency", type=float, default=0.15)
+    parser.add_argument("--replay", help="session recording to take llm answers, latencies and transcripts from")
+    args = parser.parse_args()
+    config = VendorConfig(args.llm_latency, args.llm_token_interval, args.tts_latency,
+                          args.tts_realtime_factor, args.stt_latency,
+                          ReplayScript(args.replay) if args.replay else None)
+    asyncio.run(serve(args.port, args.deepgram_port, config, args.host))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+"""Offline load test: runs N concurrent scripted games against AIAgent, with
+fake vendors (bench.fake_vendors, started in a child process) and fake
+meetings (bench.fake_meeting), and reports latency percentiles, audio
+underruns, event loop lag, CPU and memory.
+
+    python -m bench.loadtest --games 20 --duration 120 [--json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+# seconds of silence on the agent's track after which it counts as done talking
+IDLE_AFTER_S = 0.4
+# longest wait for a move or for speech before it counts as a timeout
+RESPONSE_TIMEOUT_S = 15.0
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+def summarize(values: List[float]) -> dict:
+    ms = lambda v: None if v is None else round(v * 1000, 1)
+    return {
+        "count": len(values),
+        "p50_ms": ms(percentile(values, 0.5)),
+        "p90_ms": ms(percentile(values, 0.9)),
+        "p99_ms": ms(percentile(values, 0.99)),
+        "max_ms": ms(max(values) if values else None),
+    }
+
+
+class LoopLagMonitor:
+    """How late the event loop wakes a sleeping task, sampled every `interval`."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags: List[float] = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.monotonic() - started - self.interval))
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+
+class Results:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {"move": [], "move_audio": [], "reply_audio": []}
+        self.timeouts = 0
+        self.games = 0
+        self.errors = 0
+        self.agent_stats: List[dict] = []
+
+
+class ScriptedGame:
+    """One meeting: the player plays random legal moves as X and now and
+    then says something, timing the agent's answers."""
+
+    def __init__(self, index: int, args, results: Results):
+        self.meeting_id = f"bench-{index}"
+        self.args = args
+        self.results = results
+        self.rng = random.Random(index)
+        self.state = GameState()
+        self.o_moved = asyncio.Event()
+        self.last_audio_at = 0.0
+        self._audio = asyncio.Event()
+
+    def on_message(self, data):
+        message = json.loads(data["message"])
+        if message.get("type") == "move" and message.get("player") == "O":
+            self.state.apply_move(int(message["position"]), "O")
+            self.o_moved.set()
+
+    async def listen(self, track):
+        # stands in for the meeting's sender, which pulls a frame every ptime
+        while True:
+            frame = await track.recv()
+            if frame is not None and frame.to_ndarray().any():
+                self.last_audio_at = time.monotonic()
+                self._audio.set()
+
+    async def wait_for_audio(self, since: float) -> Optional[float]:
+        deadline = time.monotonic() + RESPONSE_TIMEOUT_S
+        while self.last_audio_at <= since:
+            self._audio.clear()
+            try:
+                await asyncio.wait_for(self._audio.wait(), deadline - time.monotonic())
+            except (asyncio.TimeoutError, ValueError):
+                self.results.timeouts += 1
+                return None
+        return self.last_audio_at - since
+
+    async def wait_idle(self):
+        deadline = time.monotonic() + RESPONSE_TIMEOUT_S
+        while time.monotonic() - self.last_audio_at < IDLE_AFTER_S and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    async def publish(self, meeting, message: dict):
+        await meeting.pubsub.publish({"topic": "GAME_MOVES", "message": json.dumps(message)})
+
+    async def run(self, deadline: float):
+        agent = AIAgent(self.meeting_id, "bench-token", "AI")
+        await agent.join()
+        meeting = FakeVideoSDK.meetings[self.meeting_id]
+        await meeting.pubsub.subscribe({"topic": "GAME_MOVES", "cb": self.on_message})
+        listener = asyncio.create_task(self.listen(agent.audio_track))
+        try:
+            while time.monotonic() < deadline:
+                await self.play_game(meeting, deadline)
+                if self.state.game_over:
+                    self.results.games += 1
+                await self.publish(meeting, {"type": "reset"})
+                self.state.reset()
+        except Exception as e:
+            self.results.errors += 1
+            print(f"{self.meeting_id}: {e!r}", file=sys.stderr)
+        finally:
+            self.results.agent_stats.append(agent.stats())
+            listener.cancel()
+            agent.leave()
+
+    async def play_game(self, meeting, deadline: float):
+        while not self.state.game_over and time.monotonic() < deadline:
+            await self.wait_idle()
+            if self.rng.random() < self.args.chat_rate:
+                meeting.player_track.speak(self.args.utterance)
+                await asyncio.sleep(self.args.utterance)
+                latency = await self.wait_for_audio(meeting.player_track.speech_end)
+                if latency is not None:
+                    self.results.latencies["reply_audio"].append(latency)
+                await self.wait_idle()
+
+            await asyncio.sleep(self.rng.uniform(*self.args.think))
+            position = self.rng.choice(self.state.board.free_positions())
+            self.state.apply_move(position, "X")
+            self.o_moved.clear()
+            started = time.monotonic()
+            await self.publish(meeting, {"type": "move", "position": position, "player": "X"})
+            if self.state.game_over:
+                return
+            try:
+                await asyncio.wait_for(self.o_moved.wait(), RESPONSE_TIMEOUT_S)
+            except asyncio.TimeoutError:
+                self.results.timeouts += 1
+                return
+            self.results.latencies["move"].append(time.monotonic() - started)
+            latency = await self.wait_for_audio(started)
+            if latency is not None:
+                self.results.latencies["move_audio"].append(latency)
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args) -> dict:
+    get_engine()
+    results = Results()
+    monitor = LoopLagMonitor()
+    monitor.start()
+    rss_before = rss_mb()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.monotonic()
+    deadline = started + args.duration
+
+    games = []
+    for i in range(args.games):
+        games.append(asyncio.create_task(ScriptedGame(i, args, results).run(deadline)))
+        # stagger joins like real traffic
+        await asyncio.sleep(args.ramp / max(args.games, 1))
+    await asyncio.gather(*games)
+
+    wall = time.monotonic() - started
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (usage.ru_utime - usage_before.ru_utime) + (usage.ru_stime - usage_before.ru_stime)
+    monitor.stop()
+
+    return {
+        "games_concurrent": args.games,
+        "games_played": results.games,
+        "duration_s": round(wall, 1),
+        "latency": {name: summarize(values) for name, values in results.latencies.items()},
+        "timeouts": results.timeouts,
+        "errors": results.errors,
+        "audio": {
+            "underruns": sum(s.get("underruns", 0) for s in results.agent_stats),
+            "late_frames": sum(s.get("late_frames", 0) for s in results.agent_stats),
+            "resyncs": sum(s.get("resyncs", 0) for s in results.agent_stats),
+        },
+        "speech": {
+            "superseded": sum(s.get("tts_superseded", 0) for s in results.agent_stats),
+            "expired": sum(s.get("tts_expired", 0) for s in results.agent_stats),
+            "slot_wait_ms": get_tts_scheduler().stats()["mean_wait_ms"],
+        },
+        "loop_lag": summarize(monitor.lags),
+        "cpu_percent": round(100 * cpu / wall, 1),
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_mb(), 1),
+                   "peak": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)},
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['games_concurrent']} concurrent games, {report['games_played']} played "
+          f"in {report['duration_s']} s, {report['timeouts']} timeouts, {report['errors']} errors")
+    print(f"{'latency':<14}{'count':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    rows = dict(report["latency"], loop_lag=report["loop_lag"])
+    for name, s in rows.items():
+        cells = [s[k] if s[k] is not None else "-" for k in ("p50_ms", "p90_ms", "p99_ms", "max_ms")]
+        print(f"{name:<14}{s['count']:>7}" + "".join(f"{c:>10}" for c in cells))
+    audio = report["audio"]
+    print(f"audio: {audio['underruns']} underruns, {audio['late_frames']} late frames, {audio['resyncs']} resyncs")
+    speech = report["speech"]
+    print(f"speech: {speech['superseded']} utterances superseded, {speech['expired']} expired, "
+          f"{speech['slot_wait_ms']} ms mean wait for a tts slot")
+    rss = report["rss_mb"]
+    print(f"cpu {report['cpu_percent']}% of one core, rss {rss['before']} -> {rss['after']} MB (peak {rss['peak']} MB)")
+
+
+def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"fake vendor on port {port} did not start")
+
+
+def use_fake_vendors(vendor_port: int, deepgram_port: int):
+    # must be set before the agent modules are imported, they read it at import
+    os.environ.update({
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{vendor_port}/v1",
+        "OPENAI_API_KEY": "bench",
+        "ELEVENLABS_BASE_URL": f"http://127.0.0.1:{vendor_port}",
+        "ELEVENLABS_API_KEY": "bench",
+        "DEEPGRAM_URL": f"ws://127.0.0.1:{deepgram_port}",
+        "DEEPGRAM_API_KEY": "bench",
+    })
+    # every phrase goes through the fake tts instead of the disk cache
+    os.environ.setdefault("TTS_CACHE_MAX_MB", "0")
+
+
+def start_fake_vendors(vendor_port: int, deepgram_port: int, vendor_args: List[str]) -> subprocess.Popen:
+    # separate process, so the fakes don't compete with the agent for the event loop
+    vendors = subprocess.Popen([
+        sys.executable, "-m", "bench.fake_vendors",
+        "--port", str(vendor_port), "--deepgram-port", str(deepgram_port), *vendor_args,
+    ])
+    try:
+        wait_for_port(vendor_port)
+        wait_for_port(deepgram_port)
+    except RuntimeError:
+        vendors.terminate()
+        raise
+    return vendors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--games", type=int, default=10, help="concurrent meetings")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds to play")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which the meetings join")
+    parser.add_argument("--chat-rate", type=float, default=0.3, help="chance the player talks before a move")
+    parser.add_argument("--utterance", type=float, default=1.2, help="seconds the player talks")
+    parser.add_argument("--think", type=float, nargs=2, default=(0.5, 2.0), help="player think time range")
+    parser.add_argument("--vendor-port", type=int, default=8100)
+    parser.add_argument("--deepgram-port", type=int, default=8101)
+    parser.add_argument("--external-vendors", action="store_true",
+                        help="use fakes that are already running instead of starting them")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args, vendor_args = parser.parse_known_args()
+
+    use_fake_vendors(args.vendor_port, args.deepgram_port)
+    vendors = None
+    if args.external_vendors:
+        wait_for_port(args.vendor_port)
+        wait_for_port(args.deepgram_port)
+    else:
+        vendors = start_fake_vendors(args.vendor_port, args.deepgram_port, vendor_args)
+    try:
+        global AIAgent, FakeVideoSDK, GameState, get_engine, get_tts_scheduler
+        from agent.ai_agent import AIAgent
+        from bench.fake_meeting import FakeVideoSDK, install
+        from game.board import GameState
+        from game.engine import get_engine
+        from tts.elevenlabs import get_tts_scheduler
+        install()
+
+        report = asyncio.run(run(args))
+    finally:
+        if vendors is not None:
+            vendors.terminate()
+            vendors.wait()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
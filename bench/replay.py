@@ -0,0 +1,175 @@
+"""Replays a session recording (see agent.recorder) through the agent:
+recorded pubsub messages and speech go into GameEventHandler, DeepgramSTT
+and CustomAudioStreamTrack, the fakes of bench.fake_vendors answer with
+the recorded LLM replies, TTS latencies and transcripts. Reports each
+turn stage's latency next to the recorded one.
+
+    python -m bench.replay recording.grec [--speed 4] [--json]
+
+Speech plays in real time. With --speed, stretches of more than IDLE_GAP_S
+without any recorded event are shortened by that factor.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from bench.loadtest import start_fake_vendors, summarize, use_fake_vendors
+
+# idle time kept as recorded before --speed shortens the rest, covers endpointing and hangovers
+IDLE_GAP_S = 1.0
+# longest wait after the last record for the agent to finish talking
+SETTLE_TIMEOUT_S = 15.0
+
+
+async def wait_settled(agent):
+    handler = agent.event_handler
+    deadline = time.monotonic() + SETTLE_TIMEOUT_S
+    # give the last input a moment to start a reply
+    await asyncio.sleep(IDLE_GAP_S)
+    while time.monotonic() < deadline:
+        busy = handler.reply_tasks or handler.utterance_tasks or len(handler.commands) or handler.tts.queued() or agent.audio_track.is_speaking()
+        if not busy:
+            return
+        await asyncio.sleep(0.1)
+
+
+async def drain(track):
+    # stands in for the meeting's sender, which pulls a frame every ptime
+    while True:
+        await track.recv()
+
+
+async def replay(recording, speed: float) -> dict:
+    get_engine()
+    records = list(recording.records())
+    kinds = Counter(recorder.KIND_NAMES.get(r.kind, str(r.kind)) for r in records)
+    has_audio = kinds["audio"] > 0
+    recorded: Dict[str, List[float]] = defaultdict(list)
+    replayed: Dict[str, List[float]] = defaultdict(list)
+    for record in records:
+        if record.kind == recorder.SPAN:
+            span = record.json()
+            recorded[span["stage"]].append(span["s"])
+
+    FakeVideoSDK.default_player = False
+    agent = AIAgent(recording.session, "replay-token", "AI")
+    await agent.join()
+    tracing.listen(recording.session, lambda stage, seconds: replayed[stage].append(seconds))
+    meeting = FakeVideoSDK.meetings[recording.session]
+    handler = agent.event_handler
+    sender = asyncio.create_task(drain(agent.audio_track))
+    tracks = {}
+
+    started = time.monotonic()
+    clock = previous = 0.0
+    for record in records:
+        gap = record.t - previous
+        previous = record.t
+        if gap > IDLE_GAP_S:
+            gap = IDLE_GAP_S + (gap - IDLE_GAP_S) / speed
+        clock += gap
+        delay = started + clock - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if record.kind == recorder.PEER:
+            peer = record.json()
+            tracks[record.stream] = ReplayAudioTrack(peer.get("rate", 16000))
+            meeting.add_player(peer["id"], peer["name"], tracks[record.stream])
+        elif record.kind == recorder.AUDIO and record.stream in tracks:
+            tracks[record.stream].feed(record.payload)
+        elif record.kind == recorder.PUBSUB_IN:
+            meeting.pubsub.deliver(handler.pubsub_topic, record.payload.decode("utf-8"))
+        elif record.kind == recorder.TRANSCRIPT and not has_audio:
+            # no speech was recorded, the transcript stands in for it
+            transcript = record.json()
+            speech_end = time.monotonic() - (transcript["stt_s"] or 0.0)
+            handler.handle_transcript(transcript["peer"], transcript["text"], speech_end)
+
+    await wait_settled(agent)
+    wall = time.monotonic() - started
+    stats = agent.stats()
+    sender.cancel()
+    agent.leave()
+    tracing.unlisten(recording.session)
+
+    stages = {}
+    for stage in tracing.STAGES:
+        stages[stage] = {
+            "recorded": dict(summarize(recorded[stage]), total_ms=round(1000 * sum(recorded[stage]), 1)),
+            "replayed": dict(summarize(replayed[stage]), total_ms=round(1000 * sum(replayed[stage]), 1)),
+        }
+    return {
+        "session": recording.session,
+        "complete": recording.complete,
+        "recorded_s": round(records[-1].t if records else 0.0, 1),
+        "replayed_s": round(wall, 1),
+        "speed": speed,
+        "records": dict(kinds),
+        "stages": stages,
+        "agent": stats,
+    }
+
+
+def print_report(report: dict):
+    note = "" if report["complete"] else " (cut short, no index)"
+    print(f"session {report['session']}{note}: {report['recorded_s']} s recorded, "
+          f"replayed in {report['replayed_s']} s at speed {report['speed']}")
+    print("records: " + ", ".join(f"{count} {kind}" for kind, count in sorted(report["records"].items())))
+    print(f"{'stage':<16}{'recorded':>26}{'replayed':>26}")
+    print(f"{'':<16}" + f"{'count':>7}{'p50 ms':>9}{'p90 ms':>10}" * 2)
+    for stage, sides in report["stages"].items():
+        cells = []
+        for side in ("recorded", "replayed"):
+            s = sides[side]
+            cells += [s["count"], s["p50_ms"] if s["p50_ms"] is not None else "-",
+                      s["p90_ms"] if s["p90_ms"] is not None else "-"]
+        print(f"{stage:<16}{cells[0]:>7}{cells[1]:>9}{cells[2]:>10}{cells[3]:>7}{cells[4]:>9}{cells[5]:>10}")
+    print("time spent per stage (recorded -> replayed): " + ", ".join(
+        f"{stage} {sides['recorded']['total_ms']} -> {sides['replayed']['total_ms']} ms"
+        for stage, sides in report["stages"].items() if sides["recorded"]["count"] or sides["replayed"]["count"]
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0, help="shorten idle stretches by this factor")
+    parser.add_argument("--vendor-port", type=int, default=8100)
+    parser.add_argument("--deepgram-port", type=int, default=8101)
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    args, vendor_args = parser.parse_known_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    use_fake_vendors(args.vendor_port, args.deepgram_port)
+    # the replay itself is not recorded
+    os.environ["SESSION_RECORD_DIR"] = ""
+    vendors = start_fake_vendors(args.vendor_port, args.deepgram_port,
+                                 ["--replay", args.recording, *vendor_args])
+    try:
+        global AIAgent, FakeVideoSDK, ReplayAudioTrack, get_engine, recorder, tracing
+        from agent import recorder, tracing
+        from agent.ai_agent import AIAgent
+        from bench.fake_meeting import FakeVideoSDK, ReplayAudioTrack, install
+        from game.engine import get_engine
+        install()
+
+        recording = recorder.Recording(args.recording)
+        report = asyncio.run(replay(recording, args.speed))
+    finally:
+        vendors.terminate()
+        vendors.wait()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -34,10 +34,29 @@ const MeetingView: React.FC<MeetingViewProps> = ({
   const { participants, localParticipant } = useMeeting();
   const [gameState, setGameState] = React.useState<GameState>(initialGameState);
   const [aiJoined, setAiJoined] = React.useState(false);
+  // version of the last message from the AI agent, a skipped one asks for a snapshot
+  const lastVersion = React.useRef<number | null>(null);
 
   const { publish } = usePubSub("GAME_MOVES", {
     onMessageReceived: (data) => {
       const message = JSON.parse(data.message);
+      if (typeof message.v === "number") {
+        if (
+          lastVersion.current === null &&
+          message.type !== "state" &&
+          message.v !== 1
+        ) {
+          // joined mid game, a delta can't be applied without the board it follows
+          publish(JSON.stringify({ type: "resync" }), { persist: false });
+          return;
+        }
+        const missed =
+          lastVersion.current !== null && message.v > lastVersion.current + 1;
+        lastVersion.current = message.v;
+        if (missed && message.type !== "state") {
+          publish(JSON.stringify({ type: "resync" }), { persist: false });
+        }
+      }
       switch (message.type) {
         case "move":
           if (!gameState.isGameOver) {
@@ -54,6 +73,17 @@ const MeetingView: React.FC<MeetingViewProps> = ({
           }));
           break;
 
+        case "state":
+          setGameState({
+            board: message.board
+              .split("")
+              .map((cell: string) => (cell === "." ? null : cell)),
+            currentPlayer: message.next,
+            winner: message.winner,
+            isGameOver: message.over,
+          });
+          break;
+
         case "reset":
           setGameState(initialGameState);
           break;
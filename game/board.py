@@ -0,0 +1,206 @@
+from typing import List, Optional, Sequence, Tuple
+
+FULL = 0x1FF
+LINES = (
+    (0, 1, 2), (3, 4, 5), (6, 7, 8),  # rows
+    (0, 3, 6), (1, 4, 7), (2, 5, 8),  # columns
+    (0, 4, 8), (2, 4, 6),  # diagonals
+)
+WIN_MASKS = tuple(sum(1 << p for p in line) for line in LINES)
+
+# WINNING[mask] tells if the cells in mask contain a full line
+WINNING = bytes(any(mask & w == w for w in WIN_MASKS) for mask in range(512))
+
+# BASE3[mask] is mask read as a base-3 number, so a board's ternary index is
+# BASE3[x] + 2 * BASE3[o]
+BASE3 = tuple(sum(3 ** p for p in range(9) if mask >> p & 1) for mask in range(512))
+
+# the 8 symmetries of the square as position permutations: new[p] = old[perm[p]]
+_SYMMETRIES = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8),  # identity
+    (6, 3, 0, 7, 4, 1, 8, 5, 2),  # rotate 90
+    (8, 7, 6, 5, 4, 3, 2, 1, 0),  # rotate 180
+    (2, 5, 8, 1, 4, 7, 0, 3, 6),  # rotate 270
+    (2, 1, 0, 5, 4, 3, 8, 7, 6),  # mirror left-right
+    (6, 7, 8, 3, 4, 5, 0, 1, 2),  # mirror top-bottom
+    (0, 3, 6, 1, 4, 7, 2, 5, 8),  # main diagonal
+    (8, 5, 2, 7, 4, 1, 6, 3, 0),  # anti diagonal
+)
+# SYMMETRY_MASKS[k][mask] is mask transformed by symmetry k
+SYMMETRY_MASKS = tuple(
+    tuple(sum(1 << p for p in range(9) if mask >> perm[p] & 1) for mask in range(512))
+    for perm in _SYMMETRIES
+)
+# SYMMETRY_POSITIONS[k][p] is where position p ends up under symmetry k
+SYMMETRY_POSITIONS = tuple(
+    tuple(perm.index(p) for p in range(9)) for perm in _SYMMETRIES
+)
+
+PLAYERS = ("X", "O")
+
+
+class Board:
+    """Immutable tic-tac-toe board as two 9 bit masks, one per player.
+
+    Position p (0-8, row major) is bit p. Boards hash and compare by value,
+    so they can key caches and tables directly.
+    """
+
+    __slots__ = ("x", "o")
+
+    def __init__(self, x: int = 0, o: int = 0):
+        self.x = x
+        self.o = o
+
+    @classmethod
+    def from_list(cls, cells: Sequence[Optional[str]]) -> "Board":
+        x = o = 0
+        for p, cell in enumerate(cells):
+            if cell == "X":
+                x |= 1 << p
+            elif cell == "O":
+                o |= 1 << p
+        return cls(x, o)
+
+    def to_list(self) -> List[Optional[str]]:
+        return [self[p] for p in range(9)]
+
+    def __getitem__(self, position: int) -> Optional[str]:
+        bit = 1 << position
+        if self.x & bit:
+            return "X"
+        if self.o & bit:
+            return "O"
+        return None
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Board) and self.x == other.x and self.o == other.o
+
+    def __hash__(self) -> int:
+        return self.key
+
+    def __repr__(self) -> str:
+        return f"Board({''.join(c or '.' for c in self.to_list())})"
+
+    @property
+    def key(self) -> int:
+        """18 bit integer that identifies the board."""
+        return self.x | self.o << 9
+
+    @property
+    def index(self) -> int:
+        """Ternary index in [0, 3**9), empty=0, X=1, O=2 per cell."""
+        return BASE3[self.x] + 2 * BASE3[self.o]
+
+    @property
+    def occupied(self) -> int:
+        return self.x | self.o
+
+    def is_free(self, position: int) -> bool:
+        return not self.occupied >> position & 1
+
+    def free_positions(self) -> List[int]:
+        occupied = self.occupied
+        return [p for p in range(9) if not occupied >> p & 1]
+
+    def to_move(self) -> str:
+        # X always starts
+        return "X" if bin(self.x).count("1") == bin(self.o).count("1") else "O"
+
+    def play(self, position: int, player: str) -> "Board":
+        bit = 1 << position
+        if player == "X":
+            return Board(self.x | bit, self.o)
+        return Board(self.x, self.o | bit)
+
+    def winner(self) -> Optional[str]:
+        if WINNING[self.x]:
+            return "X"
+        if WINNING[self.o]:
+            return "O"
+        return None
+
+    def is_full(self) -> bool:
+        return self.occupied == FULL
+
+    def is_draw(self) -> bool:
+        return self.is_full() and self.winner() is None
+
+    def transform(self, symmetry: int) -> "Board":
+        table = SYMMETRY_MASKS[symmetry]
+        return Board(table[self.x], table[self.o])
+
+    def canonical(self) -> Tuple["Board", int]:
+        """Smallest equivalent board under rotation and reflection, and the
+        symmetry that maps this board onto it."""
+        best_key, best_symmetry = self.key, 0
+        for symmetry in range(1, 8):
+            table = SYMMETRY_MASKS[symmetry]
+            key = table[self.x] | table[self.o] << 9
+            if key < best_key:
+                best_key, best_symmetry = key, symmetry
+        return Board(best_key & FULL, best_key >> 9), best_symmetry
+
+
+def map_position(position: int, symmetry: int) -> int:
+    """Position on the transformed board of `position` on the original one."""
+    return SYMMETRY_POSITIONS[symmetry][position]
+
+
+def unmap_position(position: int, symmetry: int) -> int:
+    """Inverse of map_position."""
+    return _SYMMETRIES[symmetry][position]
+
+
+class GameState:
+    """Mutable state of one game, serialized in the GAME_MOVES pubsub shape."""
+
+    __slots__ = ("board", "current_player", "winner", "game_over")
+
+    def __init__(self, board: Optional[Board] = None, current_player: str = "X",
+                 winner: Optional[str] = None, game_over: bool = False):
+        self.board = board or Board()
+        self.current_player = current_player
+        self.winner = winner
+        self.game_over = game_over
+
+    def reset(self):
+        self.board = Board()
+        self.current_player = "X"
+        self.winner = None
+        self.game_over = False
+
+    def apply_move(self, position: int, player: str) -> bool:
+        """Plays the move if it is legal, returns whether it was applied."""
+        if self.game_over or player != self.current_player:
+            return False
+        if not 0 <= position <= 8 or not self.board.is_free(position):
+            return False
+        self.board = self.board.play(position, player)
+        self.current_player = "O" if player == "X" else "X"
+        winner = self.board.winner()
+        if winner or self.board.is_full():
+            self.winner = winner
+            self.game_over = True
+        return True
+
+    def snapshot(self) -> "GameState":
+        # boards are immutable, so a shallow copy is a full snapshot
+        return GameState(self.board, self.current_player, self.winner, self.game_over)
+
+    def to_dict(self) -> dict:
+        return {
+            "board": self.board.to_list(),
+            "current_player": self.current_player,
+            "winner": self.winner,
+            "game_over": self.game_over,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "GameState":
+        return cls(
+            Board.from_list(data["board"]),
+            data.get("current_player", "X"),
+            data.get("winner"),
+            data.get("game_over", False),
+        )
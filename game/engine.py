@@ -0,0 +1,136 @@
+import array
+import os
+import random
+import zlib
+from typing import List, Optional
+from game.board import Board
+
+STATES = 3 ** 9
+# score slot of an occupied cell or a finished game
+ILLEGAL = -128
+EXACT, LOWER, UPPER = 0, 1, 2
+
+# chance of playing a sub-optimal move
+DIFFICULTY_MISTAKE_RATE = {"easy": 0.6, "medium": 0.25, "hard": 0.0}
+
+ENGINE_TABLE_PATH = os.getenv("ENGINE_TABLE_PATH", "")
+
+
+def _negamax(board: Board, player: str, alpha: int, beta: int, tt: dict) -> int:
+    """Score of `board` for `player` to move: a win scores higher the
+    earlier it happens, a draw is 0."""
+    empties = 9 - bin(board.occupied).count("1")
+    if board.winner() is not None:
+        # the previous move won
+        return -(empties + 1)
+    if empties == 0:
+        return 0
+
+    key = board.key
+    entry = tt.get(key)
+    if entry is not None:
+        value, flag = entry
+        if flag == EXACT:
+            return value
+        if flag == LOWER:
+            alpha = max(alpha, value)
+        else:
+            beta = min(beta, value)
+        if alpha >= beta:
+            return value
+
+    alpha_start = alpha
+    opponent = "O" if player == "X" else "X"
+    best = -STATES
+    for position in board.free_positions():
+        score = -_negamax(board.play(position, player), opponent, -beta, -alpha, tt)
+        if score > best:
+            best = score
+        alpha = max(alpha, score)
+        if alpha >= beta:
+            break
+
+    if best <= alpha_start:
+        tt[key] = (best, UPPER)
+    elif best >= beta:
+        tt[key] = (best, LOWER)
+    else:
+        tt[key] = (best, EXACT)
+    return best
+
+
+class Engine:
+    """Tic-tac-toe engine backed by a table of move scores for every position.
+
+    The table holds 9 int8 scores per ternary board index (Board.index), from
+    the point of view of the player to move, so a lookup is a slice.
+    """
+
+    def __init__(self, table: array.array):
+        self.table = table
+
+    @classmethod
+    def build(cls) -> "Engine":
+        table = array.array("b", [ILLEGAL]) * (STATES * 9)
+        tt: dict = {}
+        seen = set()
+        stack = [Board()]
+        while stack:
+            board = stack.pop()
+            if board in seen:
+                continue
+            seen.add(board)
+            if board.winner() is not None or board.is_full():
+                continue
+            player = board.to_move()
+            opponent = "O" if player == "X" else "X"
+            index = board.index
+            for position in board.free_positions():
+                child = board.play(position, player)
+                table[index * 9 + position] = -_negamax(child, opponent, -STATES, STATES, tt)
+                stack.append(child)
+        return cls(table)
+
+    @classmethod
+    def load(cls, path: str) -> "Engine":
+        table = array.array("b")
+        with open(path, "rb") as f:
+            table.frombytes(zlib.decompress(f.read()))
+        return cls(table)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(zlib.compress(self.table.tobytes(), 9))
+
+    def move_scores(self, board: Board) -> List[int]:
+        start = board.index * 9
+        return self.table[start:start + 9].tolist()
+
+    def choose_move(self, board: Board, difficulty: str = "hard", rng: random.Random = random) -> Optional[int]:
+        scores = self.move_scores(board)
+        legal = [p for p in range(9) if scores[p] != ILLEGAL]
+        if not legal:
+            return None
+        best_score = max(scores[p] for p in legal)
+        best = [p for p in legal if scores[p] == best_score]
+        worse = [p for p in legal if scores[p] != best_score]
+        if worse and rng.random() < DIFFICULTY_MISTAKE_RATE.get(difficulty, 0.0):
+            return rng.choice(worse)
+        return rng.choice(best)
+
+
+_engine: Optional[Engine] = None
+
+
+def get_engine() -> Engine:
+    """Shared engine, loaded from ENGINE_TABLE_PATH when set (and written
+    there on first build), otherwise built in memory."""
+    global _engine
+    if _engine is None:
+        if ENGINE_TABLE_PATH and os.path.exists(ENGINE_TABLE_PATH):
+            _engine = Engine.load(ENGINE_TABLE_PATH)
+        else:
+            _engine = Engine.build()
+            if ENGINE_TABLE_PATH:
+                _engine.save(ENGINE_TABLE_PATH)
+    return _engine
@@ -0,0 +1,61 @@
+import json
+from functools import lru_cache
+from typing import Optional
+
+from game.board import GameState
+
+# message types the agent publishes on GAME_MOVES
+DELTA = "move"
+SNAPSHOT = "state"
+# sent by a client that missed a version, answered with a snapshot
+RESYNC = "resync"
+
+
+@lru_cache(maxsize=8192)
+def _status(current_player: str, winner: Optional[str], game_over: bool) -> str:
+    return f'"next":"{current_player}","winner":{json.dumps(winner)},"over":{json.dumps(game_over)}'
+
+
+@lru_cache(maxsize=8192)
+def _board(x: int, o: int) -> str:
+    # one character per square, row by row from the top left, "." when free
+    return "".join("X" if x >> p & 1 else "O" if o >> p & 1 else "." for p in range(9))
+
+
+class StateSync:
+    """Versioned GAME_MOVES messages of one meeting's game.
+
+    Every message the agent publishes carries the next version `v`, so a
+    client that sees a version skipped knows it missed one and can send
+    {"type": "resync"} for a snapshot. A move is published as a single
+    delta with the status it leads to; snapshots hold the whole board as a
+    9 character string. Encodings of statuses and boards are cached, a
+    message is put together without json.dumps.
+    """
+
+    def __init__(self, state: GameState):
+        self.state = state
+        self.version = 0
+        self.deltas = 0
+        self.snapshots = 0
+
+    def _status(self) -> str:
+        state = self.state
+        return _status(state.current_player, state.winner, state.game_over)
+
+    def delta(self, position: int, player: str) -> str:
+        """Message for a move already applied to the state."""
+        self.version += 1
+        self.deltas += 1
+        marks = bin(self.state.board.occupied).count("1")
+        return (f'{{"type":"{DELTA}","position":{position},"player":"{player}",'
+                f'"v":{self.version},"n":{marks},{self._status()}}}')
+
+    def snapshot(self) -> str:
+        self.version += 1
+        self.snapshots += 1
+        board = self.state.board
+        return f'{{"type":"{SNAPSHOT}","v":{self.version},"board":"{_board(board.x, board.o)}",{self._status()}}}'
+
+    def stats(self) -> dict:
+        return {"state_version": self.version, "state_deltas": self.deltas, "state_snapshots": self.snapshots}
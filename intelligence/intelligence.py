@@ -1,24 +1,249 @@
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+from agent.tracing import current_turn
+from game.board import Board, GameState, map_position
+from game.engine import get_engine
+from intelligence.memory import ConversationMemory
+from intelligence.response_cache import ResponseCache, normalize_text
+from typing import AsyncIterable, AsyncIterator, Callable, List, Optional, Union
+import asyncio
 import dotenv
+import os
+import sys
+import time
 
 dotenv.load_dotenv()
-    
+
+# shared by every meeting in the process
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+# llm requests in flight at once, further calls wait for a slot
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+# seconds a call may take, including the wait for a slot and the whole stream
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "10"))
+
+# llm answers kept for reuse across meetings, 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "4096"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "3600"))
+# different answers collected per prompt before cached ones are reused, picked at random
+RESPONSE_CACHE_VARIETY = int(os.getenv("RESPONSE_CACHE_VARIETY", "3"))
+# only utterances this short are answered from the cache, longer ones depend on the conversation
+RESPONSE_CACHE_MAX_WORDS = int(os.getenv("RESPONSE_CACHE_MAX_WORDS", "5"))
+
+# easy, medium or hard (perfect play)
+AI_DIFFICULTY = os.getenv("AI_DIFFICULTY", "hard")
+
+SENTENCE_END = ".!?"
+CLAUSE_END = ",;:"
+# clauses shorter than this are kept with the next one, tiny tts fragments sound choppy
+MIN_CLAUSE_CHARS = 40
+
+WIN_COMMENT = "Huh, I knew you were such a loser."
+LOSS_COMMENT = "Better luck next time!"
+DRAW_COMMENT = "It's a draw!"
+MOVE_COMMENT = "Making my move."
+# fixed lines that are spoken again and again, pre-rendered by the tts warm-up
+CANNED_COMMENTS = (WIN_COMMENT, LOSS_COMMENT, DRAW_COMMENT, MOVE_COMMENT)
+
+# first message of every chat prompt, kept byte for byte the same so the
+# provider can reuse its cached prefix; anything that changes goes after it
+CHAT_SYSTEM_PROMPT = (
+    "You are an AI playing tic-tac-toe as O against a human player X, talking with them over voice. "
+    "Reply in one or two short spoken sentences, competitive and playful. "
+    "Never use markdown, lists or emojis, and don't use the player's name. "
+    "The board is given as a list of 9 squares, row by row from the top left."
+)
+
+
+def _find_boundary(text: str, start: int) -> Optional[int]:
+    # a boundary needs following whitespace, so "3.5" or "e.g" are not split
+    for i in range(start, len(text) - 1):
+        if not text[i + 1].isspace():
+            continue
+        if text[i] in SENTENCE_END:
+            return i + 1
+        if text[i] in CLAUSE_END and i >= MIN_CLAUSE_CHARS:
+            return i + 1
+    return None
+
+
+async def split_sentences(tokens: AsyncIterable[str]) -> AsyncIterator[str]:
+    """Regroup a token stream into sentence or clause sized fragments for tts."""
+    buffer = ""
+    scanned = 0
+    async for token in tokens:
+        buffer += token
+        while True:
+            cut = _find_boundary(buffer, scanned)
+            if cut is None:
+                scanned = max(len(buffer) - 1, 0)
+                break
+            fragment, buffer, scanned = buffer[:cut].strip(), buffer[cut:], 0
+            if fragment:
+                yield fragment
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def _once(text: str) -> AsyncIterator[str]:
+    yield text
+
+
+_async_client: Optional[AsyncOpenAI] = None
+# the http library the installed openai is built on (httpx, or httpx2 in newer
+# releases), pool limits have to be of its own Limits type
+_http = sys.modules[DefaultAsyncHttpxClient.__mro__[1].__module__]
+_llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_async_client() -> AsyncOpenAI:
+    """Process wide client, so all meetings share one keep-alive connection pool."""
+    global _async_client
+    if _async_client is None:
+        _async_client = AsyncOpenAI(
+            http_client=DefaultAsyncHttpxClient(
+                limits=_http.Limits(
+                    max_connections=LLM_MAX_CONNECTIONS,
+                    max_keepalive_connections=LLM_MAX_CONNECTIONS,
+                    keepalive_expiry=60,
+                ),
+            ),
+            timeout=Timeout(LLM_TIMEOUT_S, connect=5.0),
+            max_retries=1,
+        )
+    return _async_client
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    global _response_cache
+    if _response_cache is None and RESPONSE_CACHE_SIZE > 0:
+        _response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_S, RESPONSE_CACHE_VARIETY)
+    return _response_cache
+
+
 class OpenAiIntelligence:
-    def __init__(self):
+    def __init__(self, difficulty=AI_DIFFICULTY, timeout=LLM_TIMEOUT_S):
         self.game_moves = []
-        self.openai_client = OpenAI()
-        
+        self.openai_client = get_async_client()
+        self.engine = get_engine()
+        self.cache = get_response_cache()
+        # agent.recorder.SessionRecorder of the meeting, when it is recorded
+        self.recorder = None
+        self.difficulty = difficulty
+        self.timeout = timeout
+
+    @staticmethod
+    def _messages(prompt: Union[str, List[dict]]) -> List[dict]:
+        if isinstance(prompt, str):
+            return [{"role": "user", "content": prompt}]
+        return prompt
+
+    @staticmethod
+    def _report_usage(usage, on_usage: Optional[Callable[[int, int], None]]):
+        if usage is None or on_usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        on_usage(usage.prompt_tokens, getattr(details, "cached_tokens", None) or 0)
+
+    async def _complete(self, prompt, temperature, timeout=None, on_usage=None) -> str:
+        """One chat completion, raises asyncio.TimeoutError past the deadline.
+        `prompt` is a user message or a list of messages."""
+        async with asyncio.timeout(timeout or self.timeout):
+            async with _llm_slots:
+                started = time.monotonic()
+                response = await self.openai_client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=self._messages(prompt),
+                    temperature=temperature
+                )
+        turn = current_turn.get()
+        if turn is not None:
+            turn.span("llm_first_token", started)
+        self._report_usage(response.usage, on_usage)
+        content = response.choices[0].message.content.strip()
+        if self.recorder is not None:
+            self.recorder.llm(self._messages(prompt), content, started, time.monotonic(), stream=False)
+        return content
+
+    async def _stream(self, prompt, temperature, timeout=None, on_usage=None) -> AsyncIterator[str]:
+        """Token stream of a chat completion. The deadline covers the whole
+        stream but not the time the caller spends between tokens."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        async with asyncio.timeout_at(deadline):
+            await _llm_slots.acquire()
+        turn = current_turn.get()
+        started = time.monotonic()
+        first_token = None
+        tokens = []
+        try:
+            async with asyncio.timeout_at(deadline):
+                stream = await self.openai_client.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    messages=self._messages(prompt),
+                    temperature=temperature,
+                    stream=True,
+                    # the last chunk then carries the token counts of the request
+                    **({"stream_options": {"include_usage": True}} if on_usage else {})
+                )
+            try:
+                while True:
+                    try:
+                        async with asyncio.timeout_at(deadline):
+                            chunk = await stream.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    self._report_usage(getattr(chunk, "usage", None), on_usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if first_token is None:
+                            first_token = time.monotonic()
+                            if turn is not None:
+                                turn.span("llm_first_token", started)
+                        if self.recorder is not None:
+                            tokens.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+        finally:
+            _llm_slots.release()
+            if self.recorder is not None:
+                self.recorder.llm(self._messages(prompt), "".join(tokens), started, first_token, stream=True)
+
+    async def _cached_stream(self, key, prompt, temperature, variety=None, on_usage=None) -> AsyncIterator[str]:
+        """_stream through the response cache: a cached answer comes back as
+        one piece, a complete new answer is stored for the next caller."""
+        if self.cache is None or key is None:
+            async for token in self._stream(prompt, temperature, on_usage=on_usage):
+                yield token
+            return
+        answer = await self.cache.wait(key, variety)
+        if answer is not None:
+            yield answer
+            return
+        self.cache.claim(key)
+        tokens = []
+        complete = False
+        try:
+            async for token in self._stream(prompt, temperature, on_usage=on_usage):
+                tokens.append(token)
+                yield token
+            complete = True
+        finally:
+            # a reply cut off by a barge-in or timeout is not reused
+            self.cache.fill(key, "".join(tokens).strip() if complete else None)
+
+    async def _cached_complete(self, key, prompt, temperature, variety=None, on_usage=None) -> str:
+        if self.cache is None or key is None:
+            return await self._complete(prompt, temperature, on_usage=on_usage)
+        return await self.cache.get(key, lambda: self._complete(prompt, temperature, on_usage=on_usage), variety)
+
     # parse move 
-    def parse_move(self, text):
-        prompt = f"""Determine if the user's message is a tic-tac-toe move. If yes, output the position (0-8). 
+    async def parse_move(self, text):
+        prompt = f"""Determine if the user's message is a tic-tac-toe move. If yes, output the position (0-8, row by row from the top left; players who say a number count squares from 1). 
         User: "{text}". Respond ONLY with the position number or -1 if not a move."""
-        response = self.openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.0
-        )
+        # the answer only depends on the words, one is enough
+        response = await self._cached_complete(("parse", normalize_text(text)), prompt, temperature=0.0, variety=1)
         try:
-            move = int(response.choices[0].message.content.strip())
+            move = int(response)
             if 0 <= move <= 8:
                 return move
             else:
@@ -27,17 +252,60 @@ class OpenAiIntelligence:
             return -1
 
 
-    def generate_chat_response(self, text, game_state=None):
+    def _chat_prompt(self, text, game_state=None, memory: Optional[ConversationMemory] = None) -> List[dict]:
+        # fixed system prompt first, then the summary and recent turns, which
+        # only grow at the end, and last what is new in this turn
+        messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+        if memory is not None:
+            messages.extend(memory.messages())
         if game_state:
-            prompt = f"""You are an AI playing tic-tac-toe. Current board: {game_state['board']}. Respond to: "{text}". Keep it short and competitive."""
+            messages.append({"role": "user", "content": f"Current board: {game_state.board.to_list()}\n{text}"})
         else:
-            prompt = f"""You are an AI playing tic-tac-toe. Respond conversationally to: "{text}". Keep it short."""
-        response = self.openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7
-        )
-        return response.choices[0].message.content.strip()
+            messages.append({"role": "user", "content": text})
+        return messages
+
+    def _chat_key(self, text, game_state=None):
+        words = normalize_text(text)
+        if not words or len(words.split()) > RESPONSE_CACHE_MAX_WORDS:
+            return None
+        # the raw board, as the prompt has it: a reply may name squares, and
+        # those differ between rotations of a position
+        board = game_state.board.key if game_state else None
+        return ("chat", board, words)
+
+    async def generate_chat_response(self, text, game_state=None, memory: Optional[ConversationMemory] = None):
+        on_usage = memory.record_usage if memory is not None else None
+        reply = await self._cached_complete(self._chat_key(text, game_state), self._chat_prompt(text, game_state, memory),
+                                            temperature=0.7, on_usage=on_usage)
+        if memory is not None:
+            memory.add("user", text)
+            memory.add("assistant", reply)
+        return reply
+
+    async def stream_chat_response(self, text, game_state=None, memory: Optional[ConversationMemory] = None) -> AsyncIterator[str]:
+        """Same as generate_chat_response, but yields sentences as they are generated."""
+        on_usage = memory.record_usage if memory is not None else None
+        spoken = []
+        try:
+            tokens = self._cached_stream(self._chat_key(text, game_state), self._chat_prompt(text, game_state, memory),
+                                         temperature=0.7, on_usage=on_usage)
+            async for fragment in split_sentences(tokens):
+                spoken.append(fragment)
+                yield fragment
+        finally:
+            # a reply cut off by a barge-in is remembered as far as it got
+            if memory is not None:
+                memory.add("user", text)
+                memory.add("assistant", " ".join(spoken))
+
+    async def summarize_conversation(self, summary: str, turns: List[dict]) -> str:
+        """Folds `turns` into the running `summary` of a conversation."""
+        lines = "\n".join(f"{'Player' if t['role'] == 'user' else 'AI'}: {t['content']}" for t in turns)
+        prompt = f"""Summary of a voice chat so far: "{summary or 'nothing yet'}"
+        Newer lines of the chat:
+        {lines}
+        Write an updated summary in at most three short sentences, keeping what the player said about themselves and any running jokes. Respond ONLY with the summary."""
+        return await self._complete(prompt, temperature=0.0)
         
     # def generate_server_response(self, game_state):
     #     # Get current game state from server
@@ -69,54 +337,58 @@ class OpenAiIntelligence:
     #     }
     #     return ai_move
 
-    def check_winner(self, board):
-        winning_combinations = [
-            [0, 1, 2], [3, 4, 5], [6, 7, 8],  # Rows
-            [0, 3, 6], [1, 4, 7], [2, 5, 8],  # Columns
-            [0, 4, 8], [2, 4, 6]              # Diagonals
-        ]
-        for combo in winning_combinations:
-            if board[combo[0]] == board[combo[1]] == board[combo[2]] and board[combo[0]] is not None:
-                return board[combo[0]]  # Returns 'X' or 'O' depending on who won
-        if None not in board:
-            return 'draw'
-        return None
-
-    def generate_server_response(self, game_state):
-        board = game_state["board"]
-        available_positions = [str(i) for i, val in enumerate(board) if val is None]
-        
-        if not available_positions:
-            return {"type": "game_over", "winner": None}
-        
-        winner = self.check_winner(board)
-        if winner:
-            if winner == 'O':
-                return {"type": "game_over", "winner": "O", "comment": "Huh, I knew you were such a loser."}
-            elif winner == 'X':
-                return {"type": "game_over", "winner": "X", "comment": "Better luck next time!"}
-            else:
-                return {"type": "game_over", "winner": None, "comment": "It's a draw!"}
+    def generate_server_move(self, game_state: GameState):
+        """Picks O's move with the local engine, no llm request involved."""
+        board = game_state.board
         
-        ai_position, ai_comment = self._get_ai_move(board, available_positions)
-        ai_move = {
+        winner = board.winner()
+        if winner == 'O':
+            return {"type": "game_over", "winner": "O", "comment": WIN_COMMENT}
+        elif winner == 'X':
+            return {"type": "game_over", "winner": "X", "comment": LOSS_COMMENT}
+        elif board.is_full():
+            return {"type": "game_over", "winner": None, "comment": DRAW_COMMENT}
+
+        return {
             "type": "move",
-            "position": int(ai_position),
+            "position": self.engine.choose_move(board, self.difficulty),
             "player": "O",
-            "comment": ai_comment
         }
+
+    async def generate_server_response(self, game_state: GameState):
+        ai_move = self.generate_server_move(game_state)
+        if ai_move["type"] == "move":
+            ai_move["comment"] = await self.generate_move_comment(game_state.board, ai_move["position"])
         return ai_move
-     
-    def _get_ai_move(self, board, available_positions):
-        
-            # Check if AI can win in the next move
-        for pos in available_positions:
-            board_copy = board.copy()
-            board_copy[int(pos)] = 'O'
-            if self.check_winner(board_copy) == 'O':
-                return pos, "Huh, I knew you were such a loser."
-
-        x_positions = [i for i, pos in enumerate(board) if pos == "X"]
+
+    def _winning_comment(self, board: Board, position):
+        if board.play(position, 'O').winner() == 'O':
+            return WIN_COMMENT
+        return None
+
+    async def generate_move_comment(self, board, position):
+        comment = self._winning_comment(board, position)
+        if comment:
+            return comment
+        key, prompt = self._comment_prompt(board, position)
+        return await self._cached_complete(key, prompt, temperature=0.7) or MOVE_COMMENT
+
+    async def stream_move_comment(self, board, position) -> AsyncIterator[str]:
+        comment = self._winning_comment(board, position)
+        if comment:
+            yield comment
+            return
+        key, prompt = self._comment_prompt(board, position)
+        async for fragment in split_sentences(self._cached_stream(key, prompt, temperature=0.7)):
+            yield fragment
+
+    def _comment_prompt(self, board: Board, position):
+        """Cache key and prompt of a move comment. Both are built from the
+        canonical board, so rotations and reflections of a position share
+        their comments."""
+        board, symmetry = board.canonical()
+        position = map_position(position, symmetry)
+        x_positions = [i for i in range(9) if board[i] == "X"]
     
         prompt = f"""
         Current tic-tac-toe board (0-8 positions):
@@ -125,41 +397,19 @@ class OpenAiIntelligence:
         {board[6]}|{board[7]}|{board[8]}
 
         Player X has moved to positions: {x_positions}
-        Available positions: {available_positions}
+        You are player 'O' and you are now taking position {position}.
         
         You are player 'O', a highly competitive AI in a tic-tac-toe game. Your goal is not only to win but also to unnerve your opponent with strategic commentary. Analyze X's moves and:
         1. Make a comment that subtly undermines their strategy.
-        2. Create your own winning line if possible. Announce your move with confidence and a hint of superiority.
-        3. Take strategic positions (center, corners) if no immediate threats. Make a comment that suggests you're thinking several steps ahead.
+        2. Announce your move with confidence and a hint of superiority.
+        3. Make a comment that suggests you're thinking several steps ahead.
         
-        Return your move and a brief comment separated by a '|'. Example: '4|Just as I planned.'
-        Only use positions from {available_positions}.
+        Return only the brief comment. Example: 'Just as I planned.'
         
         Attributes of comment - 
         1. A short, psychologically charged comment that feels human and subtly undermines your opponent.
         2. Include playful words or phrases"
         3. keep it short and don't use client's name
-        4. When you won say, Huh I know are you sucha loser
+        4. don't name squares by number or side, only as center, corner or edge
         """
-        
-        response = self.openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
-        )
-        
-        ai_response = response.choices[0].message.content.strip()
-        if '|' in ai_response:
-            ai_position, ai_comment = ai_response.split('|', 1)
-            ai_position = ai_position.strip()
-            ai_comment = ai_comment.strip()
-        else:
-            ai_position = ai_response
-            ai_comment = "Making my move."
-        
-        # Validate position
-        if ai_position not in available_positions:
-            ai_position = available_positions[0]
-            ai_comment = "Let me try again."
-        
-        return ai_position, ai_comment
\ No newline at end of file
+        return ("comment", board.key, position), prompt
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import os
+from collections import deque
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# tokens of recent turns kept verbatim in the prompt, older ones are summarized
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "600"))
+# turns always kept verbatim, even over the budget
+MIN_RECENT_TURNS = 2
+SUMMARY_MAX_CHARS = 600
+
+
+def estimate_tokens(text: str) -> int:
+    # about 4 characters per token for english, plus the per-message overhead
+    return len(text) // 4 + 4
+
+
+class ConversationMemory:
+    """Recent turns of one meeting's conversation under a token budget.
+
+    When the turns go over the budget, the oldest ones are folded into a
+    running summary by `summarize(summary, turns)`. They stay in the prompt
+    until the new summary is ready, so nothing is lost while it is written.
+    """
+
+    def __init__(self, summarize: Optional[Callable[[str, List[dict]], Awaitable[str]]] = None,
+                 budget_tokens: int = MEMORY_TOKEN_BUDGET):
+        self.summarize = summarize
+        self.budget_tokens = budget_tokens
+        self.summary = ""
+        self.turns = deque()
+        self._tokens = 0
+        self._compaction: Optional[asyncio.Task] = None
+
+        self.prompt_turns = 0
+        self.prompt_tokens_last = 0
+        self.prompt_tokens_max = 0
+        self.prompt_tokens_total = 0
+        self.cached_tokens_total = 0
+        self.compactions = 0
+
+    def add(self, role: str, text: str):
+        text = text.strip()
+        if not text:
+            return
+        self.turns.append({"role": role, "content": text})
+        self._tokens += estimate_tokens(text)
+        if self._tokens > self.budget_tokens and self._compaction is None:
+            self._compaction = asyncio.create_task(self._compact())
+
+    def messages(self) -> List[dict]:
+        """Summary and recent turns, to go between the fixed system prompt
+        and the new user message."""
+        messages = []
+        if self.summary:
+            messages.append({"role": "system", "content": f"Earlier in this conversation: {self.summary}"})
+        messages.extend(self.turns)
+        return messages
+
+    async def _compact(self):
+        try:
+            while self._tokens > self.budget_tokens and len(self.turns) > MIN_RECENT_TURNS:
+                # fold the oldest turns until the rest fit in half the budget
+                count, tokens = 0, self._tokens
+                while tokens > self.budget_tokens // 2 and len(self.turns) - count > MIN_RECENT_TURNS:
+                    tokens -= estimate_tokens(self.turns[count]["content"])
+                    count += 1
+                old = [self.turns[i] for i in range(count)]
+                summary = await self._summarize(old)
+                for _ in range(count):
+                    self._tokens -= estimate_tokens(self.turns.popleft()["content"])
+                self.summary = summary
+                self.compactions += 1
+        finally:
+            self._compaction = None
+
+    async def _summarize(self, turns: List[dict]) -> str:
+        if self.summarize is not None:
+            try:
+                return (await self.summarize(self.summary, turns))[:SUMMARY_MAX_CHARS]
+            except Exception as e:
+                logger.warning("Conversation summary failed, truncating instead: %s", e)
+        # keep the most recent part of what would have been summarized
+        text = " ".join([self.summary] + [f"{t['role']}: {t['content']}" for t in turns]).strip()
+        return text[-SUMMARY_MAX_CHARS:]
+
+    def record_usage(self, prompt_tokens: int, cached_tokens: int = 0):
+        self.prompt_turns += 1
+        self.prompt_tokens_last = prompt_tokens
+        self.prompt_tokens_max = max(self.prompt_tokens_max, prompt_tokens)
+        self.prompt_tokens_total += prompt_tokens
+        self.cached_tokens_total += cached_tokens
+        logger.info("Chat prompt tokens %d (%d cached), %d turns in memory", prompt_tokens, cached_tokens, len(self.turns))
+
+    def close(self):
+        if self._compaction is not None:
+            self._compaction.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "memory_turns": len(self.turns),
+            "memory_tokens": self._tokens,
+            "memory_compactions": self.compactions,
+            "prompt_tokens_last": self.prompt_tokens_last,
+            "prompt_tokens_max": self.prompt_tokens_max,
+            "prompt_tokens_avg": round(self.prompt_tokens_total / self.prompt_turns) if self.prompt_turns else 0,
+            "cached_prompt_tokens": self.cached_tokens_total,
+        }
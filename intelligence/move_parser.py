@@ -0,0 +1,186 @@
+import re
+from typing import Optional, Tuple
+
+# common mis-transcriptions, mapped to the word the player meant
+_ALIASES = {
+    "centre": "center", "senter": "center", "sentre": "center",
+    "centered": "center", "central": "center",
+    "mid": "middle", "midle": "middle", "meddle": "middle", "medal": "middle",
+    "lift": "left", "lef": "left", "laughed": "left",
+    "write": "right", "rite": "right", "wright": "right", "rights": "right",
+    "tap": "top", "tab": "top", "tops": "top", "upper": "top",
+    "button": "bottom", "botton": "bottom", "bottoms": "bottom", "lower": "bottom",
+    "corder": "corner", "coroner": "corner",
+    "won": "one", "tree": "three", "fore": "four", "nein": "nine",
+}
+
+_NUMBERS = {
+    "zero": 0, "one": 1, "two": 2, "three": 3, "four": 4,
+    "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9,
+}
+_ORDINALS = {
+    "first": 1, "1st": 1, "second": 2, "2nd": 2, "third": 3, "3rd": 3,
+    "fourth": 4, "4th": 4, "fifth": 5, "5th": 5, "sixth": 6, "6th": 6,
+    "seventh": 7, "7th": 7, "eighth": 8, "8th": 8, "ninth": 9, "9th": 9,
+    "last": 3,
+}
+_ROWS = {"top": 0, "bottom": 2}
+_COLUMNS = {"left": 0, "right": 2}
+# middle and center are a row or a column depending on the other word
+_MIDDLE = ("middle", "center")
+
+# words that say the utterance is about placing a mark
+_MOVE_CUES = {
+    "square", "position", "cell", "spot", "box", "place", "put", "go",
+    "take", "play", "mark", "corner", "row", "column", "number", "move",
+}
+
+# stands in for a dropped filler word, so neighbours don't read across it
+_FILLER = "_"
+
+# words an ordinal has to stand next to to name a square
+_SQUARES = {"square", "box", "spot", "cell"}
+
+_WORD = re.compile(r"[a-z0-9]+|[,.;:!?]")
+_CLAUSE_END = {",", ".", ";", ":", "!", "?"}
+
+
+def _tokens(text: str):
+    """Words of the transcript, without a filler "right" ("all right",
+    "right, the center", "right in the middle"), which names no column."""
+    words = []
+    clause_start = True
+    for w in _WORD.findall(text.lower()):
+        if w in _CLAUSE_END:
+            clause_start = True
+            continue
+        w = _ALIASES.get(w, w)
+        if w == "right" and (clause_start or (words and words[-1] == "all")):
+            words.append(_FILLER)
+        else:
+            words.append(w)
+        clause_start = False
+    return words
+
+
+def parse_spoken_move(text: str) -> Tuple[Optional[int], bool]:
+    """Reads a board position (0-8, row major) out of a transcript.
+
+    Returns (position, confident): (p, True) for a clear move, (None, True)
+    when the utterance is not a move at all, and (None, False) when it looks
+    like a move but can't be resolved locally. Squares are numbered 1-9 when
+    spoken, as players count them.
+    """
+    words = _tokens(text)
+    filler = _FILLER in words
+    words = [w for w in words if w != _FILLER] if filler else words
+    if not words:
+        return (None, False) if filler else (None, True)
+    cues = sum(1 for w in words if w in _MOVE_CUES)
+
+    # "row 2 column 3", "third row first column", "left column middle row"
+    row = col = None
+    used = set()
+    for i, w in enumerate(words):
+        if w in ("row", "column"):
+            found = _index(words, i)
+            if found is not None:
+                n, j = found
+                used.update((i, j))
+                if w == "row":
+                    row = n
+                else:
+                    col = n
+    if row is not None or col is not None:
+        # a row or a column alone is not a square, unless the rest says
+        # which one ("top row middle")
+        rest = [w for i, w in enumerate(words) if i not in used]
+        if row is None:
+            row = next((_ROWS[w] if w in _ROWS else 1 for w in rest if w in _ROWS or w in _MIDDLE), None)
+        if col is None:
+            col = next((_COLUMNS[w] if w in _COLUMNS else 1 for w in rest if w in _COLUMNS or w in _MIDDLE), None)
+        if row is not None and col is not None:
+            return row * 3 + col, True
+        return None, False
+
+    # "top left", "middle right", "center", "bottom corner"
+    rows = {_ROWS[w] for w in words if w in _ROWS}
+    cols = {_COLUMNS[w] for w in words if w in _COLUMNS}
+    if len(rows) > 1 or len(cols) > 1:
+        # "top ... no, bottom left", "left, I mean right"
+        return None, False
+    row = next(iter(rows), None)
+    col = next(iter(cols), None)
+    middle = any(w in _MIDDLE for w in words)
+    if row is not None and col is not None:
+        return row * 3 + col, True
+    if row is not None or col is not None:
+        if middle:
+            # "top middle" or "middle left"
+            return (row if row is not None else 1) * 3 + (col if col is not None else 1), True
+        # "top", "the left one", "bottom corner": which cell is unclear
+        return None, False
+    if middle and (cues or len(words) <= 3):
+        return 4, True
+
+    # "square 5", "number five", "the fifth square", "7"
+    numbers = [n for i, n in enumerate(_number(w) for w in words)
+               if n is not None and _counts(words, i)]
+    # an ordinal is a square only next to one ("the fifth square"), not in
+    # "can you go first" or "the second one"
+    ordinals = [_ORDINALS[w] for i, w in enumerate(words)
+                if w in _ORDINALS and w != "last" and _names_square(words, i)]
+    loose = any(w in _ORDINALS for w in words)
+    candidates = numbers or ordinals
+    if len(candidates) == 1 and (cues or len(words) <= 2):
+        n = candidates[0]
+        if 1 <= n <= 9:
+            return n - 1, True
+        # squares are spoken 1-9, "square zero" is not one of them
+        return None, False
+    if (candidates or loose) and (cues or len(words) <= 2):
+        return None, False
+    if cues >= 2 or (filler and cues):
+        return None, False
+    return None, True
+
+
+def _index(words, i) -> Optional[Tuple[int, int]]:
+    """0-2 index of the row or column named by words[i], with where it was
+    found: a number after it ("row 2", "column number three"), or an
+    ordinal or side before it ("second row", "left column")."""
+    j = i + 1
+    if j < len(words) and words[j] == "number":
+        j += 1
+    if j < len(words):
+        n = _number(words[j])
+        if n is not None and 1 <= n <= 3:
+            return n - 1, j
+    j = i - 1
+    if j >= 0:
+        w = words[j]
+        n = _ORDINALS.get(w)
+        if n is not None and 1 <= n <= 3:
+            return n - 1, j
+        if w in ("top", "left"):
+            return 0, j
+        if w in _MIDDLE:
+            return 1, j
+        if w in ("bottom", "right"):
+            return 2, j
+    return None
+
+
+def _number(word: str) -> Optional[int]:
+    if word.isdigit() and len(word) == 1:
+        return int(word)
+    return _NUMBERS.get(word)
+
+
+def _counts(words, i) -> bool:
+    # "one" is only a square in "square one" or on its own, not in "that one"
+    return words[i] != "one" or len(words) == 1 or (i > 0 and words[i - 1] in _MOVE_CUES)
+
+
+def _names_square(words, i) -> bool:
+    return any(0 <= j < len(words) and words[j] in _SQUARES for j in (i - 1, i + 1))
@@ -0,0 +1,119 @@
+import asyncio
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+_NOT_WORD = re.compile(r"[^\w\s]+")
+
+
+def normalize_text(text: str) -> str:
+    """Lower case without punctuation or repeated spaces, so "Nice move!"
+    and "nice move" share an entry."""
+    return " ".join(_NOT_WORD.sub(" ", text.lower()).split())
+
+
+class ResponseCache:
+    """In-memory cache of llm answers, shared by all meetings in the process.
+
+    Every key keeps up to `variety` different answers; until it has them a
+    lookup misses so the next caller asks the llm again, after that callers
+    get one of them at random. Entries expire `ttl_s` after their first
+    answer and are evicted least recently used first past `max_entries`.
+
+    A key being asked for already is claimed, concurrent callers wait for
+    that answer instead of sending the same request.
+    """
+
+    def __init__(self, max_entries: int, ttl_s: float, variety: int = 1, rng: random.Random = random):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self.variety = max(variety, 1)
+        self.rng = rng
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        # key -> (created, answers), oldest first
+        self._entries: "OrderedDict[Hashable, Tuple[float, List[str]]]" = OrderedDict()
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def lookup(self, key: Hashable, variety: Optional[int] = None) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl_s:
+            del self._entries[key]
+            entry = None
+        if entry is None or len(entry[1]) < (variety or self.variety):
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self.rng.choice(entry[1])
+
+    def pending(self, key: Hashable) -> Optional[asyncio.Future]:
+        """The answer of a request for `key` still in flight, resolves to
+        None if that request failed or was cut off."""
+        future = self._pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+        return future
+
+    def claim(self, key: Hashable):
+        self.misses += 1
+        self._pending[key] = asyncio.get_running_loop().create_future()
+
+    def fill(self, key: Hashable, answer: Optional[str]):
+        """Ends the claim on `key`, storing `answer` unless it is empty."""
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(answer or None)
+        if not answer or self.max_entries <= 0:
+            return
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl_s:
+            entry = self._entries[key] = (time.monotonic(), [])
+        if answer not in entry[1]:
+            entry[1].append(answer)
+            # keep the newest answers if the variety was lowered
+            del entry[1][:-self.variety]
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def wait(self, key: Hashable, variety: Optional[int] = None) -> Optional[str]:
+        """A cached answer, or the answer of a request already in flight.
+        None means the caller has to ask and must claim() the key before
+        its next await."""
+        while True:
+            answer = self.lookup(key, variety)
+            if answer is not None:
+                return answer
+            future = self.pending(key)
+            if future is None:
+                return None
+            # shielded, a cancelled waiter must not cancel the others' answer
+            answer = await asyncio.shield(future)
+            if answer is not None:
+                return answer
+
+    async def get(self, key: Hashable, factory: Callable[[], Awaitable[str]], variety: Optional[int] = None) -> str:
+        """A cached answer for `key`, or the one of `factory()`."""
+        answer = await self.wait(key, variety)
+        if answer is not None:
+            return answer
+        self.claim(key)
+        try:
+            answer = await factory()
+        finally:
+            self.fill(key, answer)
+        return answer
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -1,8 +1,28 @@
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, BackgroundTasks
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from agent.ai_agent import AIAgent
-import asyncio
+from agent.session_manager import (
+    SessionManager,
+    SessionExistsError,
+    SessionNotFoundError,
+    SessionCapacityError,
+)
+from agent import tracing
+from game.engine import get_engine
+from intelligence.intelligence import get_response_cache
+from tts.elevenlabs import get_tts_scheduler
+import dotenv
+import logging
+import os
+
+dotenv.load_dotenv()
+
+# DEBUG also logs every tts request and speaking rate update
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
 
 port = 8000
 app = FastAPI()
@@ -15,27 +35,30 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-ai_agent = None
+# max agents joined at once, and how many extra joins may wait for a slot
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "50"))
+MAX_QUEUED_SESSIONS = int(os.getenv("MAX_QUEUED_SESSIONS", "0"))
+# worker processes when run as `python main.py`, 1 serves everything from this
+# process, 0 starts one per CPU core (see agent/supervisor.py)
+WORKERS = int(os.getenv("WORKERS", "1"))
+
+session_manager = SessionManager(max_sessions=MAX_SESSIONS, max_queued=MAX_QUEUED_SESSIONS)
 
 class MeetingReqConfig(BaseModel):
     meeting_id: str
     token: str
-    
-async def server_operations(req:MeetingReqConfig):
-    # join ai agent
-    # keep server alive
-    global ai_agent
-    ai_agent = AIAgent(req.meeting_id, req.token, "AI")
-    
-    try:
-        await ai_agent.join()
-        while True:
-            await asyncio.sleep(0.1)
-            # print("Server is running is background")
-    except Exception as ex:
-        print(f"[ERROR]: either joining or running bg tasks: {ex}")
-    finally:
-        ai_agent.leave()
+
+class LeaveReqConfig(BaseModel):
+    meeting_id: str
+
+@app.on_event("startup")
+async def startup():
+    # build (or load) the move table before the first game needs it
+    get_engine()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await session_manager.shutdown()
     
 @app.get("/test")
 async def test():
@@ -44,11 +67,85 @@ async def test():
 
 # join ai agent
 @app.post("/join-player")
-async def join_player(req: MeetingReqConfig, bg_tasks: BackgroundTasks):
-    bg_tasks.add_task(server_operations, req)
-    return {"message": "AI agent joined"}
+async def join_player(req: MeetingReqConfig):
+    try:
+        session = session_manager.join(req.meeting_id, req.token, "AI")
+    except SessionExistsError:
+        raise HTTPException(status_code=409, detail="AI agent already in this meeting")
+    except SessionCapacityError:
+        raise HTTPException(status_code=503, detail="Server is at capacity, try again later")
+    if session.state == "queued":
+        return {"message": "AI agent queued", "state": session.state}
+    return {"message": "AI agent joined", "state": session.state}
+
+# remove ai agent from meeting
+@app.post("/leave-player")
+async def leave_player(req: LeaveReqConfig):
+    try:
+        await session_manager.leave(req.meeting_id)
+    except SessionNotFoundError:
+        raise HTTPException(status_code=404, detail="No AI agent in this meeting")
+    return {"message": "AI agent left"}
+
+@app.get("/sessions")
+async def sessions():
+    return session_manager.status()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    lines = ["# HELP agent_sessions Sessions by state.", "# TYPE agent_sessions gauge"]
+    for state in ("queued", "joining", "running", "leaving"):
+        lines.append(f'agent_sessions{{state="{state}"}} {session_manager.count(state)}')
+    lines += ["# HELP agent_command_queue_depth Game commands waiting to be applied per session.",
+              "# TYPE agent_command_queue_depth gauge"]
+    dropped = 0
+    speech_dropped = {"superseded": 0, "expired": 0}
+    for meeting_id, session in session_manager.sessions.items():
+        handler = session.agent.event_handler if session.agent is not None else None
+        if handler is not None:
+            lines.append(f'agent_command_queue_depth{{session="{tracing.escape_label(meeting_id)}"}} {len(handler.commands)}')
+            dropped += handler.commands.dropped
+            speech_dropped["superseded"] += handler.tts.superseded
+            speech_dropped["expired"] += handler.tts.expired
+    lines += ["# HELP agent_commands_dropped Game commands made obsolete by a reset, in running sessions.",
+              "# TYPE agent_commands_dropped gauge",
+              f"agent_commands_dropped {dropped}"]
+    lines += ["# HELP agent_tts_dropped Utterances dropped before synthesis, in running sessions.",
+              "# TYPE agent_tts_dropped gauge"]
+    for reason, count in speech_dropped.items():
+        lines.append(f'agent_tts_dropped{{reason="{reason}"}} {count}')
+    tts = get_tts_scheduler().stats()
+    lines += ["# HELP agent_tts_requests_in_flight TTS requests holding a vendor slot.",
+              "# TYPE agent_tts_requests_in_flight gauge",
+              f"agent_tts_requests_in_flight {tts['in_flight']}",
+              "# HELP agent_tts_requests_waiting TTS requests waiting for a vendor slot.",
+              "# TYPE agent_tts_requests_waiting gauge",
+              f"agent_tts_requests_waiting {tts['waiting']}",
+              "# HELP agent_tts_requests_total TTS requests by priority and whether they got a slot in time.",
+              "# TYPE agent_tts_requests_total counter"]
+    for outcome in ("granted", "expired"):
+        for priority, count in tts[outcome].items():
+            lines.append(f'agent_tts_requests_total{{priority="{priority}",result="{outcome}"}} {count}')
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        lines += ["# HELP agent_llm_cache_requests_total LLM requests by response cache outcome.",
+                  "# TYPE agent_llm_cache_requests_total counter"]
+        for result in ("hits", "misses", "coalesced"):
+            lines.append(f'agent_llm_cache_requests_total{{result="{result}"}} {stats[result]}')
+        lines += ["# HELP agent_llm_cache_entries Prompts with cached answers.",
+                  "# TYPE agent_llm_cache_entries gauge",
+                  f"agent_llm_cache_entries {stats['entries']}"]
+    return PlainTextResponse(
+        tracing.render_prometheus() + "\n".join(lines) + "\n",
+        media_type="text/plain; version=0.0.4",
+    )
 
 # runnning the server on port : 8000
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("main:app", host="127.0.0.1", port=8000)
+    if WORKERS == 1:
+        uvicorn.run("main:app", host="127.0.0.1", port=8000)
+    else:
+        # the supervisor routes meetings to worker processes running main:app
+        uvicorn.run("agent.supervisor:app", host="127.0.0.1", port=8000)
@@ -1,8 +1,8 @@
 import asyncio
 from videosdk.stream import MediaStreamTrack
-import traceback
-from typing import Dict, List
-import numpy as np
+import logging
+import time
+from typing import Dict, List, Optional
 
 from deepgram import (
     DeepgramClient,
@@ -13,7 +13,8 @@ from deepgram import (
 )
 from dotenv import load_dotenv
 import os
-from asyncio.log import logger
+from stt.ingest import AudioIngest
+from stt.vad import VoiceActivityGate, SPEECH_START, SPEECH_END
 
 LEARNING_RATE = 0.1
 LENGTH_THRESHOLD = 5
@@ -21,43 +22,107 @@ SMOOTHING_FACTOR = 3
 BASE_WPM = 150.0
 VAD_THRESHOLD_MS = 25
 UTTERANCE_CUTOFF_MS = 300
+# audio is sent to deepgram as mono linear16 at this rate, in batches of STT_BATCH_MS
+STT_SAMPLE_RATE = int(os.getenv("STT_SAMPLE_RATE", "16000"))
+STT_BATCH_MS = int(os.getenv("STT_BATCH_MS", "40"))
+# only send audio while the peer is talking, keepalives in between
+STT_LOCAL_VAD = os.getenv("STT_LOCAL_VAD", "true").lower() == "true"
+KEEPALIVE_INTERVAL_S = 4.0
+# another deepgram endpoint (on-prem or the bench fakes), e.g. ws://127.0.0.1:8101
+DEEPGRAM_URL = os.getenv("DEEPGRAM_URL", "")
+# silence after a final transcript that closes the turn for a BASE_WPM speaker,
+# scaled by each peer's learned speaking rate and clamped to the bounds
+ENDPOINT_MS = int(os.getenv("STT_ENDPOINT_MS", "700"))
+MIN_ENDPOINT_MS = 250
+MAX_ENDPOINT_MS = 1500
+# a turn waiting for deepgram's answer to a finalize is closed without it after this
+FINALIZE_TIMEOUT_S = 1.0
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+
+class PeerTranscript:
+    """Transcript state and learned speaking rate of one peer, only touched
+    on the event loop."""
+
+    __slots__ = ("peer_name", "buffer", "words", "wpm", "speed_coefficient",
+                 "finalize_called", "finalize_at", "last_words_at", "last_voice_at",
+                 "speech_started_at")
+
+    def __init__(self, peer_name: str):
+        self.peer_name = peer_name
+        self.buffer = ""
+        self.words = []
+        self.wpm = BASE_WPM
+        self.speed_coefficient = 1.0
+        self.finalize_called = False
+        self.finalize_at = 0.0
+        # monotonic time words (interim or final) last came in for the buffer
+        self.last_words_at = 0.0
+        # monotonic time of the last batch the local VAD heard speech in
+        self.last_voice_at: Optional[float] = None
+        # when deepgram heard speech start, without the local VAD, until its end is reported
+        self.speech_started_at: Optional[float] = None
+
+    def endpoint_s(self) -> float:
+        ms = ENDPOINT_MS / self.speed_coefficient
+        return min(MAX_ENDPOINT_MS, max(MIN_ENDPOINT_MS, ms)) / 1000
+
+    def clear(self):
+        self.buffer = ""
+        self.words = []
+        self.finalize_called = False
+        self.last_voice_at = None
+
+
 class DeepgramSTT:
-    def __init__(self, callback):
+    def __init__(self, callback, on_speech=None, local_vad: bool = STT_LOCAL_VAD):
         self.callback = callback
+        # on_speech(peer_id, peer_name, event) with event SPEECH_START or SPEECH_END
+        self.on_speech = on_speech
+        self.local_vad = local_vad
         self.deepgram_connections: Dict[str, ListenWebSocketClient] = {}
-        self.finalize_called: Dict[str, bool] = {}
+        self.peers: Dict[str, PeerTranscript] = {}
+        self.ingests: Dict[str, AudioIngest] = {}
+        self.vads: Dict[str, VoiceActivityGate] = {}
         self.vad_threshold_ms: int = VAD_THRESHOLD_MS
         self.utterance_cutoff_ms: int = UTTERANCE_CUTOFF_MS
         self.model = "nova-2"
-        self.speed_coefficient: float = 1.0
-        self.wpm_0 = BASE_WPM * self.speed_coefficient
-        self.wpm = self.wpm_0
-        self.speed_coefficient = self.speed_coefficient
         self.language = "en-US"
-        self.buffer = ""
-        self.words_buffer = []
-        
+        # agent.recorder.SessionRecorder of the meeting, when it is recorded
+        self.recorder = None
+
         # Initialize Deepgram Client with keepalive
         self.client = DeepgramClient(
             api_key=os.getenv("DEEPGRAM_API_KEY"),
-            config=DeepgramClientOptions(options={"keepalive": True}),
+            config=DeepgramClientOptions(url=DEEPGRAM_URL, options={"keepalive": True}),
         )
 
     def start(self, peer_id: str, peer_name: str, track):
+        self.loop = asyncio.get_event_loop()
+
+        # deepgram calls back on its own thread, peer state is handled on the loop
         def on_transcript(connection, result, **kwargs):
-            self._handle_transcript(peer_id=peer_id, peer_name=peer_name, result=result)
+            self.loop.call_soon_threadsafe(self._handle_transcript, peer_id, result)
 
         def on_error(connection, error, **kwargs):
-            print(f"Deepgram error for {peer_id}: {error}")
+            logger.error("Deepgram error for %s: %s", peer_id, error)
 
         def on_close(connection, close, **kwargs):
-            print(f"Deepgram connection closed for {peer_id}")
+            logger.info("Deepgram connection closed for %s", peer_id)
+            self.loop.call_soon_threadsafe(self._forget_peer, peer_id)
         
+        def on_speech_started(connection, speech_started, **kwargs):
+            # deepgram's own onset, only needed when audio is not gated locally
+            if peer_id not in self.vads:
+                self.loop.call_soon_threadsafe(
+                    self._on_speech_event, peer_id, peer_name, SPEECH_START, connection
+                )
+
         def on_open(connection, open, **kwargs):
-            print(f"Deepgram connection opened fro {peer_id}")
+            logger.info("Deepgram connection opened for %s", peer_id)
 
         # Configure live transcription options
         options = LiveOptions(
@@ -65,16 +130,16 @@ class DeepgramSTT:
             language=self.language,
             smart_format=True,
             encoding="linear16",
-            channels=2,
-            sample_rate=48000,
+            channels=1,
+            sample_rate=STT_SAMPLE_RATE,
             interim_results=True,
             vad_events=True,
             filler_words=True,
             punctuate=True,
-            endpointing=int(self.vad_threshold_ms * (1 / self.speed_coefficient)),
-            utterance_end_ms=max(
-                int(self.utterance_cutoff_ms * (1 / self.speed_coefficient)), 1000
-            ),
+            # short, so final transcripts come in at every pause; the turn is
+            # closed on our side per speaker, see _check_endpoint
+            endpointing=self.vad_threshold_ms,
+            utterance_end_ms=max(self.utterance_cutoff_ms, 1000),
             no_delay=True,
         )
 
@@ -84,71 +149,174 @@ class DeepgramSTT:
         dg_connection.on(LiveTranscriptionEvents.Transcript, on_transcript)
         dg_connection.on(LiveTranscriptionEvents.Close, on_close)
         dg_connection.on(LiveTranscriptionEvents.Error, on_error)
+        dg_connection.on(LiveTranscriptionEvents.SpeechStarted, on_speech_started)
         dg_connection.start(options)
 
         self.deepgram_connections[peer_id] = dg_connection
-        self.finalize_called[peer_id] = False
+        peer = self.peers[peer_id] = PeerTranscript(peer_name)
+        self.ingests[peer_id] = AudioIngest(STT_SAMPLE_RATE, STT_BATCH_MS)
+        if self.local_vad:
+            self.vads[peer_id] = VoiceActivityGate(
+                STT_SAMPLE_RATE, STT_BATCH_MS, hangover_ms=int(peer.endpoint_s() * 1000)
+            )
 
         # Start audio processing task
-        asyncio.create_task(self._process_audio(peer_id, track))
+        asyncio.create_task(self._process_audio(peer_id, peer_name, track))
     
-    async def _process_audio(self, peer_id: str, track: MediaStreamTrack):
+    async def _process_audio(self, peer_id: str, peer_name: str, track: MediaStreamTrack):
         try:
+            ingest = self.ingests[peer_id]
+            vad = self.vads.get(peer_id)
+            peer = self.peers[peer_id]
+            last_sent = time.monotonic()
             while True:
                 frame = await track.recv()
-                audio_data = frame.to_ndarray()
-                pcm_frame = audio_data.flatten().astype(np.int16).tobytes()
-                
-                if peer_id in self.deepgram_connections:
-                    self.deepgram_connections[peer_id].send(pcm_frame)
-        except Exception as e:
-            print(f"Audio processing error for {peer_id}: {e}")
-            traceback.print_exc()
+                # downmix, resample and batch before sending
+                batches = ingest.push(frame)
+
+                connection = self.deepgram_connections.get(peer_id)
+                if connection is None:
+                    continue
+                for batch in batches:
+                    event = None
+                    if vad is not None:
+                        batch_list, event = vad.process(batch)
+                    else:
+                        batch_list = [batch]
+                    for pcm in batch_list:
+                        connection.send(pcm)
+                        if self.recorder is not None:
+                            self.recorder.audio(peer_id, pcm)
+                    if batch_list:
+                        last_sent = time.monotonic()
+                    if vad is not None and vad.voiced:
+                        peer.last_voice_at = time.monotonic()
+                    if event is not None:
+                        self._on_speech_event(peer_id, peer_name, event, connection)
+
+                self._check_endpoint(peer_id, peer, vad, connection)
+
+                if time.monotonic() - last_sent > KEEPALIVE_INTERVAL_S:
+                    # silence is not sent, keep the connection open instead
+                    connection.keep_alive()
+                    last_sent = time.monotonic()
+        except Exception:
+            logger.exception("Audio processing error for %s", peer_id)
         finally:
             self._cleanup(peer_id)
 
-    def update_speed_coefficient(self, wpm: int, message: str):
-        if wpm is not None:
+    def _check_endpoint(self, peer_id: str, peer: PeerTranscript, vad, connection):
+        """Ends the turn once no words came in for the peer's learned endpoint
+        time, so fast talkers get their answer sooner and slow ones can
+        pause. Deepgram's own endpointing only marks finals."""
+        now = time.monotonic()
+        if (vad is None and peer.speech_started_at is not None and not peer.buffer
+                and now - max(peer.speech_started_at, peer.last_words_at) >= MAX_ENDPOINT_MS / 1000):
+            # deepgram heard speech start but no words came of it
+            self._speech_ended(peer_id, peer)
+        if not peer.buffer:
+            return
+        if peer.finalize_called:
+            if now - peer.finalize_at >= FINALIZE_TIMEOUT_S:
+                self._end_turn(peer_id, peer)
+            return
+        if vad is not None and vad.speaking:
+            return
+        if now - peer.last_words_at >= peer.endpoint_s():
+            self._finalize(peer, connection)
+
+    @staticmethod
+    def _finalize(peer: PeerTranscript, connection):
+        # the answer to the finalize flushes deepgram's pending words and ends the turn
+        peer.finalize_called = True
+        peer.finalize_at = time.monotonic()
+        connection.finalize()
+
+    def _on_speech_event(self, peer_id, peer_name, event, connection):
+        peer = self.peers.get(peer_id)
+        if event == SPEECH_START:
+            if peer is not None:
+                peer.finalize_called = False
+                if peer_id not in self.vads:
+                    peer.speech_started_at = time.monotonic()
+        elif event == SPEECH_END and peer is not None:
+            # no trailing silence reaches deepgram, so ask for the final transcript now
+            self._finalize(peer, connection)
+        self._notify(peer_id, peer_name, event)
+
+    def _speech_ended(self, peer_id: str, peer: PeerTranscript):
+        # deepgram only reports speech starting, without the local VAD the end
+        # of the turn (or of a noise without words) is the end of the speech
+        peer.speech_started_at = None
+        self._notify(peer_id, peer.peer_name, SPEECH_END)
+
+    def _notify(self, peer_id, peer_name, event):
+        if self.on_speech is not None:
+            try:
+                self.on_speech(peer_id, peer_name, event)
+            except Exception:
+                logger.exception("Error in speech event callback")
+
+    def is_voiced(self, peer_id: str) -> bool:
+        """Whether the peer's latest audio was speech. Without the local VAD,
+        whether deepgram transcribed any words since it heard speech start,
+        so a cough or a noise is not taken for talking."""
+        vad = self.vads.get(peer_id)
+        if vad is None:
+            peer = self.peers.get(peer_id)
+            return (peer is not None and peer.speech_started_at is not None
+                    and peer.last_words_at >= peer.speech_started_at)
+        return vad.voiced
+
+    def update_speed_coefficient(self, peer_id: str, wpm: int, message: str):
+        peer = self.peers.get(peer_id)
+        if wpm is not None and peer is not None:
             length = len(message.strip().split())
             p_t = min(
                 1,
                 LEARNING_RATE
                 * ((length + SMOOTHING_FACTOR) / (LENGTH_THRESHOLD + SMOOTHING_FACTOR)),
             )
-            self.wpm = self.wpm * (1 - p_t) + wpm * p_t
-            self.speed_coefficient = self.wpm / BASE_WPM
-            logger.info(f"Set speed coefficient to {self.speed_coefficient}")
+            peer.wpm = peer.wpm * (1 - p_t) + wpm * p_t
+            peer.speed_coefficient = peer.wpm / BASE_WPM
+            # the VAD hangover follows the same rate, it closes the turn when enabled
+            vad = self.vads.get(peer_id)
+            if vad is not None:
+                vad.set_hangover(int(peer.endpoint_s() * 1000))
+            logger.debug("Set speed coefficient of %s to %.2f", peer_id, peer.speed_coefficient)
             
-    def produce_text(self, text: str, peer_name: str, is_final: bool = False):
+    def produce_text(self, text: str, peer_name: str, is_final: bool = False, speech_end: Optional[float] = None):
         try:
             if is_final and text:
                 # Schedule the async callback to run in the existing loop:
-                self.callback(peer_name, text)
+                self.callback(peer_name, text, speech_end)
         except RuntimeError:
             # This catches the “no running event loop” scenario in case
             # the code is invoked outside of any running loop. You may
             # need to initialize your own loop or handle differently.
-            print("No running event loop. Make sure to run in an async context.")
-        except Exception as e:
-            print("Error while producing text", e)
-
-    def is_endpoint(self, deepgram_response):
-        is_endpoint = (deepgram_response.channel.alternatives[0].transcript) and (
-            deepgram_response.speech_final
-        )
-        return is_endpoint
+            logger.error("No running event loop. Make sure to run in an async context.")
+        except Exception:
+            logger.exception("Error while producing text")
 
     def calculate_duration(self, words: List[dict]) -> float:
         if len(words) == 0:
             return 0.0
         return words[-1]["end"] - words[0]["start"]
         
-    def _handle_transcript(self, peer_id, peer_name, result):
+    def _handle_transcript(self, peer_id, result):
         try:
+            peer = self.peers.get(peer_id)
+            if peer is None:
+                return
             top_choice = result.channel.alternatives[0]
 
             if len(top_choice.transcript) == 0:
-                return
+                # a finalize with nothing new still closes a pending turn
+                if not (peer.finalize_called and peer.buffer):
+                    return
+            else:
+                # the peer is still talking, the endpoint clock starts over
+                peer.last_words_at = time.monotonic()
 
             # Check for transcript, confidentce and
             if (
@@ -160,48 +328,65 @@ class DeepgramSTT:
                 words = top_choice.words
                 if words:
                     # Add words to buffer
-                    self.words_buffer.extend(words)
-
-                self.buffer = f"{self.buffer} {top_choice.transcript}"
-                
+                    peer.words.extend(words)
 
-            if (self.buffer and self.is_endpoint(result)) or self.finalize_called[peer_id]:
+                peer.buffer = f"{peer.buffer} {top_choice.transcript}"
 
-                duration_seconds = self.calculate_duration(self.words_buffer)
-                # print("Duration seconds", duration_seconds)
+            # speech_final alone does not end the turn, see _check_endpoint
+            if peer.buffer and peer.finalize_called:
+                self._end_turn(peer_id, peer)
 
-                if duration_seconds is not None:
-                    wpm = (
-                        60 * len(self.buffer.split()) / duration_seconds
-                        if duration_seconds
-                        else None
-                    )
-                    print("WPM", wpm)
-                    if wpm is not None:
-                        self.update_speed_coefficient(wpm=wpm, message=self.buffer)
+        except Exception:
+            logger.exception("Error while transcript processing")
 
-                self.produce_text(self.buffer, peer_name=peer_name, is_final=True)
-                self.buffer = ""
-                self.words_buffer = []
+    def _end_turn(self, peer_id: str, peer: PeerTranscript):
+        duration_seconds = self.calculate_duration(peer.words)
 
-            if top_choice.transcript and top_choice.confidence > 0.0:
-                if not result.is_final:
-                    interim_message = f"{self.buffer} {top_choice.transcript}"
-                else:
-                    interim_message = self.buffer
+        if duration_seconds is not None:
+            wpm = (
+                60 * len(peer.buffer.split()) / duration_seconds
+                if duration_seconds
+                else None
+            )
+            logger.debug("WPM %s", wpm)
+            if wpm is not None:
+                self.update_speed_coefficient(peer_id, wpm=wpm, message=peer.buffer)
 
-                # if interim_message:
-                #     self.produce_text(interim_message, peer_name=peer_name,is_final=False)
+        self.produce_text(peer.buffer, peer_name=peer.peer_name, is_final=True, speech_end=peer.last_voice_at)
+        peer.clear()
+        if peer.speech_started_at is not None:
+            self._speech_ended(peer_id, peer)
 
-        except Exception as e:
-            print("Error while transcript processing", e)
+    def _forget_peer(self, peer_id: str):
+        if peer_id not in self.deepgram_connections:
+            self.peers.pop(peer_id, None)
 
     def stop(self, peer_id: str):
         self._cleanup(peer_id)
 
+    def stats(self) -> dict:
+        stats = {peer_id: ingest.stats() for peer_id, ingest in self.ingests.items()}
+        for peer_id, vad in self.vads.items():
+            if peer_id in stats:
+                stats[peer_id]["vad"] = vad.stats()
+        for peer_id, peer in self.peers.items():
+            if peer_id in stats:
+                stats[peer_id]["wpm"] = round(peer.wpm)
+                stats[peer_id]["endpoint_ms"] = round(peer.endpoint_s() * 1000)
+        return stats
+
     def _cleanup(self, peer_id: str):
         if peer_id in self.deepgram_connections:
-            self.finalize_called[peer_id] = True
+            peer = self.peers.get(peer_id)
             connection = self.deepgram_connections.pop(peer_id)
-            connection.finalize()
+            ingest = self.ingests.pop(peer_id, None)
+            self.vads.pop(peer_id, None)
+            tail = ingest.flush() if ingest else None
+            if tail:
+                connection.send(tail)
+            if peer is not None:
+                # flush whatever the finalize returns
+                self._finalize(peer, connection)
+            else:
+                connection.finalize()
             connection.finish()
\ No newline at end of file
@@ -0,0 +1,117 @@
+import time
+from math import gcd
+from typing import Optional
+import numpy as np
+from av import AudioFrame
+
+
+class PolyphaseResampler:
+    """Rational resampler (windowed-sinc low-pass, polyphase form) for mono
+    float32 audio. Keeps filter history between calls, so frames can be fed
+    one at a time without clicks at their boundaries."""
+
+    def __init__(self, in_rate: int, out_rate: int, taps_per_phase: int = 16):
+        g = gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.taps = taps_per_phase
+
+        n_taps = taps_per_phase * self.up
+        # cutoff in cycles per sample of the upsampled signal
+        cutoff = 0.5 / max(self.up, self.down)
+        t = np.arange(n_taps) - (n_taps - 1) / 2
+        h = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(n_taps, 8.0)
+        h *= self.up / h.sum()
+        # phases[p, k] = h[p + k * up], applied to x[i], x[i-1], ...
+        self.phases = h.reshape(taps_per_phase, self.up).T.astype(np.float32)
+
+        self._history = np.zeros(taps_per_phase - 1, dtype=np.float32)
+        # upsampled index of the next output, relative to the next input block
+        self._next = 0
+        self._offsets = np.arange(taps_per_phase)
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        if self.up == self.down:
+            return x
+        buf = np.concatenate((self._history, x))
+        total = len(x) * self.up
+        count = max(0, -(-(total - self._next) // self.down))
+        m = self._next + np.arange(count) * self.down
+        base = m // self.up + (self.taps - 1)
+        windows = buf[base[:, None] - self._offsets[None, :]]
+        y = np.einsum("nk,nk->n", windows, self.phases[m % self.up])
+        self._next = self._next + count * self.down - total
+        self._history = buf[len(buf) - (self.taps - 1):]
+        return y
+
+
+class AudioIngest:
+    """Turns WebRTC frames of one peer into mono int16 at `out_rate` and
+    hands them out in batches of `batch_ms`."""
+
+    def __init__(self, out_rate: int, batch_ms: int):
+        self.out_rate = out_rate
+        self.batch_samples = out_rate * batch_ms // 1000
+        self._batch = np.zeros(self.batch_samples, dtype=np.int16)
+        self._fill = 0
+        self._resampler: Optional[PolyphaseResampler] = None
+        self._in_rate = 0
+
+        # what the raw 48 kHz stereo frames would have cost, against what is sent
+        self.frames = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_s = 0.0
+
+    def push(self, frame: AudioFrame) -> list:
+        """Returns the batches completed by this frame as bytes."""
+        started = time.thread_time()
+        data = frame.to_ndarray()
+        channels = len(frame.layout.channels)
+        self.frames += 1
+        self.bytes_in += frame.samples * channels * 2
+
+        if frame.sample_rate != self._in_rate:
+            self._in_rate = frame.sample_rate
+            self._resampler = PolyphaseResampler(frame.sample_rate, self.out_rate)
+
+        # downmix, packed frames interleave the channels in a single row
+        if frame.format.is_planar:
+            mono = data.mean(axis=0, dtype=np.float32)
+        else:
+            mono = data.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+        if data.dtype.kind == "f":
+            mono *= 32767.0
+
+        samples = self._resampler.process(mono)
+        np.clip(samples, -32768, 32767, out=samples)
+
+        batches = []
+        pos = 0
+        while pos < len(samples):
+            take = min(len(samples) - pos, self.batch_samples - self._fill)
+            self._batch[self._fill:self._fill + take] = samples[pos:pos + take]
+            self._fill += take
+            pos += take
+            if self._fill == self.batch_samples:
+                batches.append(self._batch.tobytes())
+                self._fill = 0
+        self.bytes_out += sum(len(b) for b in batches)
+        self.cpu_s += time.thread_time() - started
+        return batches
+
+    def flush(self) -> Optional[bytes]:
+        if not self._fill:
+            return None
+        batch = self._batch[:self._fill].tobytes()
+        self._fill = 0
+        self.bytes_out += len(batch)
+        return batch
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "bytes_in": self.bytes_in,
+            "bytes_sent": self.bytes_out,
+            "cpu_ms": round(self.cpu_s * 1000, 1),
+        }
@@ -0,0 +1,95 @@
+from collections import deque
+from typing import List, Optional, Tuple
+import numpy as np
+
+# speech is energy this far above the tracked noise floor, and at least VAD_MIN_DB
+VAD_MARGIN_DB = 12.0
+VAD_MIN_DB = -50.0
+# 10 ms blocks above the threshold needed in a batch to count as speech
+VAD_MIN_VOICED_BLOCKS = 2
+# audio still sent after the last voiced batch, and sent ahead of the first one
+VAD_HANGOVER_MS = 600
+VAD_PREROLL_MS = 320
+
+SPEECH_START = "speech_start"
+SPEECH_END = "speech_end"
+
+
+class VoiceActivityGate:
+    """Energy based voice activity detection on batches of mono int16 audio.
+
+    process() returns the batches that should be sent upstream: nothing while
+    the peer is silent, the buffered pre-roll plus the batch at speech onset,
+    and everything until the hangover after the last voiced batch has passed.
+    """
+
+    def __init__(self, sample_rate: int, batch_ms: int,
+                 margin_db: float = VAD_MARGIN_DB, min_db: float = VAD_MIN_DB,
+                 hangover_ms: int = VAD_HANGOVER_MS, preroll_ms: int = VAD_PREROLL_MS):
+        self.block = sample_rate // 100
+        self.margin_db = margin_db
+        self.min_db = min_db
+        self.batch_ms = batch_ms
+        self.set_hangover(hangover_ms)
+        self.preroll = deque(maxlen=max(1, -(-preroll_ms // batch_ms)))
+        self.noise_db = -60.0
+        self.speaking = False
+        # whether the last batch was voiced, speaking stays set during the hangover
+        self.voiced = False
+        self._quiet = 0
+
+        self.batches_in = 0
+        self.batches_sent = 0
+        self.onsets = 0
+
+    def set_hangover(self, hangover_ms: int):
+        self.hangover_batches = max(1, -(-hangover_ms // self.batch_ms))
+
+    def _energy_db(self, samples: np.ndarray) -> np.ndarray:
+        n = len(samples) // self.block * self.block
+        blocks = samples[:n].reshape(-1, self.block).astype(np.float32) * (1 / 32768)
+        return 10 * np.log10(np.einsum("ij,ij->i", blocks, blocks) / self.block + 1e-10)
+
+    def process(self, batch: bytes) -> Tuple[List[bytes], Optional[str]]:
+        self.batches_in += 1
+        energy_db = self._energy_db(np.frombuffer(batch, dtype=np.int16))
+        threshold = max(self.min_db, self.noise_db + self.margin_db)
+        voiced = np.count_nonzero(energy_db > threshold) >= VAD_MIN_VOICED_BLOCKS
+        self.voiced = voiced
+
+        if not voiced and len(energy_db):
+            # follow the background level, quickly down and slowly up
+            level = float(np.median(energy_db))
+            rate = 0.3 if level < self.noise_db else 0.02
+            self.noise_db += rate * (level - self.noise_db)
+
+        if voiced:
+            self._quiet = 0
+            if not self.speaking:
+                self.speaking = True
+                self.onsets += 1
+                out = list(self.preroll) + [batch]
+                self.preroll.clear()
+                self.batches_sent += len(out)
+                return out, SPEECH_START
+            self.batches_sent += 1
+            return [batch], None
+
+        if self.speaking:
+            self._quiet += 1
+            self.batches_sent += 1
+            if self._quiet >= self.hangover_batches:
+                self.speaking = False
+                return [batch], SPEECH_END
+            return [batch], None
+
+        self.preroll.append(batch)
+        return [], None
+
+    def stats(self) -> dict:
+        return {
+            "batches_in": self.batches_in,
+            "batches_sent": self.batches_sent,
+            "onsets": self.onsets,
+            "noise_db": round(self.noise_db, 1),
+        }
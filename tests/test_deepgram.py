@@ -0,0 +1,88 @@
+from types import SimpleNamespace
+
+from stt import deepgram
+from stt.deepgram import DeepgramSTT, PeerTranscript
+
+
+class Connection:
+    def __init__(self):
+        self.finalized = 0
+
+    def finalize(self):
+        self.finalized += 1
+
+
+def result(transcript, is_final=True, speech_final=False):
+    words = [{"word": w, "start": i * 0.4, "end": (i + 1) * 0.4} for i, w in enumerate(transcript.split())]
+    alternative = SimpleNamespace(transcript=transcript, confidence=0.9 if transcript else 0.0, words=words)
+    return SimpleNamespace(channel=SimpleNamespace(alternatives=[alternative]),
+                           is_final=is_final, speech_final=speech_final)
+
+
+def stt():
+    turns = []
+    s = DeepgramSTT.__new__(DeepgramSTT)
+    s.callback = lambda peer_name, text, speech_end: turns.append(text.strip())
+    s.peers = {"p": PeerTranscript("peer")}
+    s.vads = {}
+    s.recorder = None
+    return s, turns
+
+
+def test_speech_final_alone_does_not_end_the_turn():
+    s, turns = stt()
+    peer, connection = s.peers["p"], Connection()
+    s._handle_transcript("p", result("I think", speech_final=True))
+    assert turns == []
+    # still within the peer's endpoint time
+    s._check_endpoint("p", peer, None, connection)
+    assert connection.finalized == 0
+
+    peer.last_words_at -= peer.endpoint_s()
+    s._check_endpoint("p", peer, None, connection)
+    assert connection.finalized == 1
+    s._handle_transcript("p", result("I will win", speech_final=True))
+    assert turns == ["I think I will win"]
+
+
+def test_unanswered_finalize_ends_the_turn():
+    s, turns = stt()
+    peer, connection = s.peers["p"], Connection()
+    s._handle_transcript("p", result("your move"))
+    peer.last_words_at -= peer.endpoint_s()
+    s._check_endpoint("p", peer, None, connection)
+    peer.finalize_at -= deepgram.FINALIZE_TIMEOUT_S
+    s._check_endpoint("p", peer, None, connection)
+    assert turns == ["your move"]
+
+
+
+def test_speech_end_without_local_vad():
+    s, turns = stt()
+    events = []
+    s.on_speech = lambda peer_id, peer_name, event: events.append(event)
+    peer, connection = s.peers["p"], Connection()
+    s._on_speech_event("p", "peer", deepgram.SPEECH_START, connection)
+    s._handle_transcript("p", result("hello"))
+    peer.last_words_at -= peer.endpoint_s()
+    s._check_endpoint("p", peer, None, connection)
+    s._handle_transcript("p", result(""))
+    assert turns == ["hello"]
+    assert events == [deepgram.SPEECH_START, deepgram.SPEECH_END]
+
+    # a noise deepgram took for speech, without any words
+    s._on_speech_event("p", "peer", deepgram.SPEECH_START, connection)
+    peer.speech_started_at -= deepgram.MAX_ENDPOINT_MS / 1000
+    peer.last_words_at = 0.0
+    s._check_endpoint("p", peer, None, connection)
+    assert events[-1] == deepgram.SPEECH_END
+
+
+def test_voiced_without_local_vad_needs_words():
+    s, turns = stt()
+    s.on_speech = None
+    s._on_speech_event("p", "peer", deepgram.SPEECH_START, Connection())
+    # deepgram heard something, a cough until it turns into words
+    assert not s.is_voiced("p")
+    s._handle_transcript("p", result("wait", is_final=False))
+    assert s.is_voiced("p")
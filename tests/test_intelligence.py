@@ -0,0 +1,60 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+import uvicorn
+
+from bench.fake_vendors import LLM_REPLY, VendorConfig, create_app
+from game.board import GameState
+from intelligence import intelligence
+
+
+@pytest.fixture(scope="module")
+def fake_openai():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    config = VendorConfig(llm_latency=0.0, llm_token_interval=0.0)
+    server = uvicorn.Server(uvicorn.Config(create_app(config), host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not server.started and time.monotonic() < deadline:
+        time.sleep(0.05)
+    yield f"http://127.0.0.1:{port}/v1"
+    server.should_exit = True
+    thread.join(timeout=5)
+
+
+@pytest.fixture
+def llm(fake_openai, monkeypatch):
+    monkeypatch.setenv("OPENAI_BASE_URL", fake_openai)
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    # a client of its own, pointed at the fake
+    monkeypatch.setattr(intelligence, "_async_client", None)
+    monkeypatch.setattr(intelligence, "_response_cache", None)
+    monkeypatch.setattr(intelligence, "RESPONSE_CACHE_SIZE", 0)
+    return intelligence.OpenAiIntelligence()
+
+
+def test_chat_response_from_fake_vendor(llm):
+    reply = asyncio.run(llm.generate_chat_response("are you even trying", GameState()))
+    assert reply == LLM_REPLY
+
+
+def test_streamed_chat_response_from_fake_vendor(llm):
+    async def collect():
+        return [fragment async for fragment in llm.stream_chat_response("are you even trying", GameState())]
+
+    assert " ".join(asyncio.run(collect())) == LLM_REPLY
+
+
+def test_chat_key_tells_rotations_apart():
+    llm = intelligence.OpenAiIntelligence.__new__(intelligence.OpenAiIntelligence)
+    corner, other_corner = GameState(), GameState()
+    corner.apply_move(0, "X")
+    other_corner.apply_move(8, "X")
+    assert corner.board.canonical()[0] == other_corner.board.canonical()[0]
+    assert llm._chat_key("where should I go", corner) != llm._chat_key("where should I go", other_corner)
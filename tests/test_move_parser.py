@@ -0,0 +1,52 @@
+import pytest
+
+from intelligence.move_parser import parse_spoken_move
+
+
+@pytest.mark.parametrize("text, position", [
+    ("top left", 0),
+    ("center", 4),
+    ("middle right", 5),
+    ("square 5", 4),
+    ("the fifth square", 4),
+    ("7", 6),
+    ("row 2 column 3", 5),
+    ("third row first column", 6),
+    ("left column middle row", 3),
+    ("bottom row middle", 7),
+    ("column number one row number three", 6),
+    # "right" as a filler names no column
+    ("all right, top left", 0),
+    ("right, center please", 4),
+    ("right in the middle", 4),
+    ("top right", 2),
+])
+def test_moves(text, position):
+    assert parse_spoken_move(text) == (position, True)
+
+
+@pytest.mark.parametrize("text", [
+    # a row or a column alone is not a square
+    "second row",
+    "third column",
+    "row three",
+    "the first row please",
+    # ordinals in ordinary chat
+    "can you go first",
+    "I am going to go in the second one",
+    # which corner is unclear
+    "bottom corner",
+    # conflicting sides
+    "top left, no, top right",
+    # squares are spoken 1-9
+    "zero",
+    "0",
+    "square zero",
+])
+def test_left_to_the_llm(text):
+    assert parse_spoken_move(text) == (None, False)
+
+
+@pytest.mark.parametrize("text", ["hello there", "you are pretty good at this", "I went first last time", "all right"])
+def test_not_a_move(text):
+    assert parse_spoken_move(text) == (None, True)
@@ -0,0 +1,26 @@
+import os
+
+from tts.pcm_cache import PcmCache
+
+
+def test_interleaved_records_of_one_key(tmp_path):
+    cache = PcmCache(str(tmp_path), 1 << 20)
+    key = PcmCache.key("hello", "voice", "model", "pcm_24000", None)
+    # two streams of the same phrase read on one reader thread in turn
+    first = cache.record(key, [b"ab", b"cd"])
+    second = cache.record(key, [b"ab", b"cd"])
+    assert next(first) == b"ab"
+    assert next(second) == b"ab"
+    assert list(first) == [b"cd"]
+    assert list(second) == [b"cd"]
+    assert bytes(cache.get(key)) == b"abcd"
+    assert os.listdir(tmp_path) == [key]
+
+
+def test_files_named_by_format(tmp_path):
+    cache = PcmCache(str(tmp_path), 1 << 20)
+    for output_format in ("pcm_24000", "ulaw_8000", "mp3_44100_64"):
+        cache.put(PcmCache.key("hello", "voice", "model", output_format, None), b"audio")
+    assert sorted(name.rpartition(".")[2] for name in os.listdir(tmp_path)) == ["mp3", "pcm", "ulaw"]
+    # entries survive a restart
+    assert PcmCache(str(tmp_path), 1 << 20).stats()["entries"] == 3
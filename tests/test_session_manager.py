@@ -0,0 +1,66 @@
+import asyncio
+
+from agent import session_manager
+from agent.session_manager import SessionManager
+
+
+def test_leave_queued_session():
+    async def run():
+        manager = SessionManager(max_sessions=0, max_queued=1)
+        session = manager.join("meeting", "token")
+        await asyncio.sleep(0)
+        assert session.state == "queued"
+        async with asyncio.timeout(1):
+            await manager.leave("meeting")
+        assert manager.sessions == {}
+        # the queue slot is free again
+        assert manager.join("meeting", "token").state == "queued"
+        await manager.shutdown()
+        assert manager.sessions == {}
+
+    asyncio.run(run())
+
+
+class StalledAgent:
+    left = False
+
+    def __init__(self, meeting_id, token, name, on_leave=None):
+        pass
+
+    async def join(self):
+        await asyncio.sleep(3600)
+
+    def leave(self):
+        StalledAgent.left = True
+
+
+def test_leave_while_joining(monkeypatch):
+    monkeypatch.setattr(session_manager, "AIAgent", StalledAgent)
+
+    async def run():
+        manager = SessionManager(max_sessions=1)
+        session = manager.join("meeting", "token")
+        await asyncio.sleep(0.01)
+        assert session.state == "joining"
+        async with asyncio.timeout(1):
+            await manager.leave("meeting")
+        assert manager.sessions == {}
+        assert StalledAgent.left
+
+    asyncio.run(run())
+
+
+def test_agent_that_fails_to_start_is_logged(monkeypatch, caplog):
+    def broken(*args, **kwargs):
+        raise RuntimeError("no audio device")
+
+    monkeypatch.setattr(session_manager, "AIAgent", broken)
+
+    async def run():
+        manager = SessionManager(max_sessions=1)
+        manager.join("meeting", "token")
+        await asyncio.sleep(0.01)
+        assert manager.sessions == {}
+
+    asyncio.run(run())
+    assert "no audio device" in caplog.text
@@ -0,0 +1,30 @@
+import asyncio
+from types import SimpleNamespace
+
+from agent.speculation import MoveSpeculator
+from agent.tracing import current_turn, start_turn
+from game.board import GameState
+from game.engine import get_engine
+
+
+def test_branches_are_not_part_of_the_turn():
+    turns = []
+
+    async def generate_move_comment(board, position):
+        turns.append(current_turn.get())
+        return "nice"
+
+    async def render(comment):
+        return None
+
+    async def run():
+        intelligence = SimpleNamespace(engine=get_engine(), difficulty="hard",
+                                       generate_move_comment=generate_move_comment)
+        speculator = MoveSpeculator(intelligence, SimpleNamespace(render=render), branches=2)
+        start_turn("test", "move")
+        speculator.start(GameState())
+        await asyncio.gather(*(branch.task for branch in speculator.branches.values()))
+        speculator.cancel()
+
+    asyncio.run(run())
+    assert turns == [None, None]
@@ -0,0 +1,56 @@
+import asyncio
+import json
+
+from agent.ai_agent import GameEventHandler
+from agent.command_queue import CommandQueue
+from game.board import GameState
+from game.sync import StateSync
+
+
+class SlowParser:
+    async def parse_move(self, text):
+        await asyncio.sleep(0.05)
+        return 4
+
+
+def handler():
+    h = GameEventHandler.__new__(GameEventHandler)
+    h.session_id = "test"
+    h.recorder = None
+    h.speculator = None
+    h.game_state = GameState()
+    h.sync = StateSync(h.game_state)
+    h.commands = CommandQueue(h.apply_command)
+    h.openai_client = SlowParser()
+    h.reply_tasks = set()
+    h.utterance_tasks = set()
+    h.spoken_moves = h.llm_move_parses = 0
+    h.published = []
+
+    async def publish_message(message):
+        h.published.append(json.loads(message))
+
+    async def generate_ai_move():
+        pass
+
+    h.publish_message = publish_message
+    h.generate_ai_move = generate_ai_move
+    return h
+
+
+def test_barge_in_keeps_spoken_move():
+    async def run():
+        h = handler()
+        h.start_utterance(h.handle_utterance("put my mark in that box"))
+        await asyncio.sleep(0.01)
+        # a barge-in cuts off replies while the move is being read
+        for task in list(h.reply_tasks):
+            task.cancel()
+        await asyncio.gather(*h.utterance_tasks)
+        await asyncio.sleep(0.01)
+        assert h.game_state.board[4] == "X"
+        assert h.published == [{"type": "move", "position": 4, "player": "X", "v": 1, "n": 1,
+                                "next": "O", "winner": None, "over": False}]
+        h.commands.close()
+
+    asyncio.run(run())
@@ -0,0 +1,61 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from agent.supervisor import Supervisor, _forward
+
+WORKER_METRICS = """# HELP agent_sessions Sessions by state.
+# TYPE agent_sessions gauge
+agent_sessions{state="running"} 1
+# HELP agent_stage_latency_seconds Latency of each stage of the agent's turns.
+# TYPE agent_stage_latency_seconds histogram
+agent_stage_latency_seconds_bucket{stage="turn",le="+Inf"} 2
+agent_stage_latency_seconds_count{stage="turn"} 2
+# HELP agent_commands_dropped Game commands made obsolete by a reset, in running sessions.
+# TYPE agent_commands_dropped gauge
+agent_commands_dropped 0
+"""
+
+
+class Client:
+    async def get(self, url):
+        return SimpleNamespace(status_code=200, text=WORKER_METRICS)
+
+
+def test_metrics_grouped_by_family():
+    supervisor = Supervisor(workers=2)
+    for worker in supervisor.workers:
+        worker.healthy = True
+    supervisor.client = Client()
+    lines = asyncio.run(supervisor.metrics()).splitlines()
+    assert lines == [
+        "# HELP agent_sessions Sessions by state.",
+        "# TYPE agent_sessions gauge",
+        'agent_sessions{worker="0",state="running"} 1',
+        'agent_sessions{worker="1",state="running"} 1',
+        "# HELP agent_stage_latency_seconds Latency of each stage of the agent's turns.",
+        "# TYPE agent_stage_latency_seconds histogram",
+        'agent_stage_latency_seconds_bucket{worker="0",stage="turn",le="+Inf"} 2',
+        'agent_stage_latency_seconds_count{worker="0",stage="turn"} 2',
+        'agent_stage_latency_seconds_bucket{worker="1",stage="turn",le="+Inf"} 2',
+        'agent_stage_latency_seconds_count{worker="1",stage="turn"} 2',
+        "# HELP agent_commands_dropped Game commands made obsolete by a reset, in running sessions.",
+        "# TYPE agent_commands_dropped gauge",
+        'agent_commands_dropped{worker="0"} 0',
+        'agent_commands_dropped{worker="1"} 0',
+    ]
+
+
+def test_forward_plain_text_error():
+    response = httpx.Response(502, text="Bad Gateway")
+    with pytest.raises(HTTPException) as error:
+        _forward(response)
+    assert (error.value.status_code, error.value.detail) == (502, "Bad Gateway")
+
+    response = httpx.Response(409, json={"detail": "AI agent already in this meeting"})
+    with pytest.raises(HTTPException) as error:
+        _forward(response)
+    assert (error.value.status_code, error.value.detail) == (409, "AI agent already in this meeting")
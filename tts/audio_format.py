@@ -0,0 +1,168 @@
+import time
+from typing import Iterable, Iterator, Optional, Tuple
+
+import av
+import numpy as np
+
+from stt.ingest import PolyphaseResampler
+
+# rates the tts api serves raw pcm at
+PCM_RATES = (16000, 22050, 24000, 44100)
+CODECS = ("pcm", "ulaw", "mp3")
+
+
+def parse_format(output_format: str) -> Tuple[str, int, int]:
+    """(codec, sample rate, bytes per second) of an ElevenLabs output format
+    such as pcm_24000, ulaw_8000 or mp3_44100_64."""
+    parts = output_format.split("_")
+    if len(parts) < 2 or parts[0] not in CODECS or not parts[1].isdigit():
+        raise ValueError(f"Unsupported tts output format {output_format!r}")
+    codec, rate = parts[0], int(parts[1])
+    if codec == "pcm":
+        return codec, rate, rate * 2
+    if codec == "ulaw":
+        return codec, rate, rate
+    if len(parts) < 3 or not parts[2].isdigit():
+        raise ValueError(f"mp3 output format needs a bit rate: {output_format!r}")
+    return codec, rate, int(parts[2]) * 1000 // 8
+
+
+def negotiate_format(track_rate: int, requested: str = "") -> str:
+    """The requested output format, otherwise pcm at the track's rate. A
+    rate the api has no pcm for gets the next higher one, or the highest
+    that divides it (pcm_24000 for 48 kHz)."""
+    if requested:
+        parse_format(requested)
+        return requested
+    higher = [rate for rate in PCM_RATES if rate >= track_rate]
+    divisors = [rate for rate in PCM_RATES if track_rate % rate == 0]
+    return f"pcm_{min(higher) if higher else max(divisors or PCM_RATES)}"
+
+
+def _ulaw_table() -> np.ndarray:
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    magnitude = (((codes & 0x0F) << 3) + 0x84) << exponent
+    return np.where(codes & 0x80, 0x84 - magnitude, magnitude - 0x84).astype(np.float32)
+
+
+_ULAW = _ulaw_table()
+
+
+class PcmConverter:
+    """Turns one tts stream in `output_format` into mono int16 pcm at
+    `rate`, the format the audio track plays.
+
+    Decoder and resampler state is kept between chunks, so the stream can
+    be cut anywhere (even mid sample or mid mp3 frame) without clicks.
+    Pcm at the track's rate passes through untouched.
+    """
+
+    def __init__(self, output_format: str, rate: int):
+        self.output_format = output_format
+        self.codec, self.in_rate, self.bytes_per_s = parse_format(output_format)
+        self.rate = rate
+        self._carry = b""
+        self._decoder = av.CodecContext.create("mp3", "r") if self.codec == "mp3" else None
+        self._resampler: Optional[PolyphaseResampler] = None
+        self._resampler_rate = 0
+        self.cpu_s = 0.0
+
+    @property
+    def passthrough(self) -> bool:
+        return self.codec == "pcm" and self.in_rate == self.rate
+
+    def _decode(self, chunk) -> Iterator[Tuple[np.ndarray, int]]:
+        """Float32 mono samples at int16 scale, with their rate."""
+        if self.codec == "mp3":
+            for packet in self._decoder.parse(bytes(chunk) if chunk is not None else None):
+                try:
+                    frames = self._decoder.decode(packet)
+                except av.InvalidDataError:
+                    # id3 tags and other non-audio data between frames
+                    continue
+                for frame in frames:
+                    yield self._mono(frame), frame.sample_rate
+            if chunk is None:
+                for frame in self._decoder.decode(None):
+                    yield self._mono(frame), frame.sample_rate
+            return
+        if chunk is None:
+            return
+        if self.codec == "ulaw":
+            yield _ULAW[np.frombuffer(chunk, dtype=np.uint8)], self.in_rate
+            return
+        data = self._carry + bytes(chunk) if self._carry else chunk
+        usable = len(data) & ~1
+        self._carry = bytes(data[usable:])
+        yield np.frombuffer(data, dtype=np.int16, count=usable // 2).astype(np.float32), self.in_rate
+
+    @staticmethod
+    def _mono(frame) -> np.ndarray:
+        data = frame.to_ndarray()
+        channels = len(frame.layout.channels)
+        if frame.format.is_planar:
+            mono = data.mean(axis=0, dtype=np.float32)
+        else:
+            mono = data.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+        if data.dtype.kind == "f":
+            mono *= 32767.0
+        return mono
+
+    def _resample(self, samples: np.ndarray, rate: int) -> np.ndarray:
+        if rate == self.rate:
+            return samples
+        if rate != self._resampler_rate:
+            self._resampler = PolyphaseResampler(rate, self.rate)
+            self._resampler_rate = rate
+        return self._resampler.process(samples)
+
+    def convert(self, chunk) -> bytes:
+        """Pcm for the next chunk of the stream, may be empty."""
+        if self.passthrough:
+            return chunk
+        started = time.thread_time()
+        out = [self._resample(samples, rate) for samples, rate in self._decode(chunk)]
+        pcm = self._pack(out)
+        self.cpu_s += time.thread_time() - started
+        return pcm
+
+    def flush(self) -> bytes:
+        """What the decoder and resampler still hold at the end of the stream."""
+        if self.passthrough:
+            return b""
+        started = time.thread_time()
+        out = [self._resample(samples, rate) for samples, rate in self._decode(None)]
+        if self._resampler is not None:
+            # pushes the last input samples through the filter
+            out.append(self._resampler.process(np.zeros(self._resampler.taps, dtype=np.float32)))
+        pcm = self._pack(out)
+        self.cpu_s += time.thread_time() - started
+        return pcm
+
+    @staticmethod
+    def _pack(out) -> bytes:
+        if not out:
+            return b""
+        samples = np.concatenate(out) if len(out) > 1 else out[0]
+        return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+    def stream(self, chunks: Iterable) -> Iterator[bytes]:
+        """Converts a blocking chunk iterator, meant to run on a reader
+        thread. Large chunks (audio from the cache) are converted 100 ms at
+        a time so playback can start before all of it is done."""
+        piece = max(self.bytes_per_s // 10 & ~1, 2)
+        try:
+            for chunk in chunks:
+                view = memoryview(chunk)
+                for start in range(0, len(view), piece):
+                    pcm = self.convert(view[start:start + piece])
+                    if pcm:
+                        yield pcm
+            tail = self.flush()
+            if tail:
+                yield tail
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
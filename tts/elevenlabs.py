@@ -1,50 +1,395 @@
 from elevenlabs import ElevenLabs, VoiceSettings
 from videosdk.stream import MediaStreamTrack
+from agent.audio_stream_track import AUDIO_SAMPLE_RATE, read_chunks, close_stream
+from agent.tracing import current_turn
+from tts.audio_format import PcmConverter, negotiate_format
+from tts.pcm_cache import PcmCache
+from tts.scheduler import CHAT, PREPARE, PRIORITY_NAMES, TTS_DEADLINE_S, TtsScheduler
+from typing import List, Optional
 import os
 import asyncio
+import bisect
+from functools import partial
+import logging
+import time
+
+logger = logging.getLogger(__name__)
 
 api_key=os.getenv("ELEVENLABS_API_KEY")
+# another api endpoint, e.g. the bench fakes
+base_url = os.getenv("ELEVENLABS_BASE_URL") or None
+
+MODEL = "eleven_turbo_v2_5"
+VOICE = "Will"
+# format requested from the api, e.g. pcm_16000, ulaw_8000 or mp3_22050_32 to
+# download less; empty picks pcm at the audio track's rate. Anything else is
+# decoded and resampled locally.
+OUTPUT_FORMAT = os.getenv("TTS_OUTPUT_FORMAT", "")
+VOICE_SETTINGS = VoiceSettings(
+    stability=0.71, 
+    similarity_boost=0.5, 
+    style=0.0, 
+    use_speaker_boost=True
+)
+
+# rendered phrases are kept on disk, TTS_CACHE_MAX_MB=0 disables the cache
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_MB", "256")) * 1024 * 1024
+_pcm_cache: Optional[PcmCache] = None
+# shared by all meetings, see tts.scheduler
+_tts_scheduler: Optional[TtsScheduler] = None
+# chunks read ahead for a queued utterance while the previous one is playing
+PREFETCH_CHUNKS = 8
+
+
+class PrefetchedStream:
+    """Starts reading a tts byte stream right away, holding at most
+    `max_chunks` until the audio track gets to it."""
+
+    def __init__(self, stream, loop: asyncio.AbstractEventLoop, max_chunks: int = PREFETCH_CHUNKS, on_first_chunk=None,
+                 on_chunk=None, on_done=None):
+        self._chunks = asyncio.Queue(maxsize=max_chunks)
+        self._on_first_chunk = on_first_chunk
+        # on_chunk(size) for every chunk as it arrives
+        self._on_chunk = on_chunk
+        # on_done(stream) once it is read to the end, failed or was closed
+        self._on_done = on_done
+        self._task = loop.create_task(self._fill(stream, loop))
+        self._task.add_done_callback(lambda _: self._done())
+
+    async def _fill(self, stream, loop):
+        try:
+            async for chunk in read_chunks(stream, loop):
+                if self._on_first_chunk is not None:
+                    self._on_first_chunk()
+                    self._on_first_chunk = None
+                if self._on_chunk is not None:
+                    self._on_chunk(len(chunk))
+                await self._chunks.put(chunk)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error while prefetching tts audio")
+        self._done()
+        await self._chunks.put(None)
+
+    def _done(self):
+        if self._on_done is not None:
+            on_done, self._on_done = self._on_done, None
+            on_done(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        chunk = await self._chunks.get()
+        if chunk is None:
+            raise StopAsyncIteration
+        return chunk
+
+    def cancel(self):
+        self._task.cancel()
+
+    async def aclose(self):
+        self.cancel()
+
+
+class Utterance:
+    __slots__ = ("seq", "text", "priority", "interrupt", "audio", "reply", "deadline", "turn")
+
+    def __init__(self, seq: int, text: str, priority: int, interrupt: bool, audio, reply: int, turn):
+        self.seq = seq
+        self.text = text
+        self.priority = priority
+        self.interrupt = interrupt
+        self.audio = audio
+        # the reply it is part of, replies start with an interrupting utterance
+        self.reply = reply
+        self.deadline = time.monotonic() + TTS_DEADLINE_S
+        self.turn = turn
+
 
 # tts/elevenlabs.py
 class ElevenLabsTTS:
+    """Speech of one meeting.
+
+    Utterances wait in `pending`, move commentary ahead of small talk, and
+    are synthesized one at a time with slots from the process-wide
+    TtsScheduler. A new reply drops what is queued of older replies of the
+    same or lower priority, and an utterance that could not be started
+    before its deadline is dropped with the rest of its reply.
+    """
+
     def __init__(self, output_track: MediaStreamTrack):
-        self.elevenlabs_client = ElevenLabs(api_key=api_key)
-        self.model = "eleven_turbo_v2_5"
+        self.elevenlabs_client = ElevenLabs(api_key=api_key, base_url=base_url)
+        self.model = MODEL
+        self.voice = VOICE
+        self.output_format = negotiate_format(output_track.sample_rate, OUTPUT_FORMAT)
+        self.voice_settings = VOICE_SETTINGS
+        self.cache = get_pcm_cache()
+        self.scheduler = get_tts_scheduler()
         self.output_track = output_track
-        self.queue = asyncio.Queue()
+        # ordered by (priority, seq)
+        self.pending: List[Utterance] = []
+        self._wakeup = asyncio.Event()
+        self._seq = 0
+        self._reply = 0
+        # per priority, replies numbered below this are stale
+        self._stale_below = dict.fromkeys(PRIORITY_NAMES, 0)
+        # utterance being synthesized and its wait for a slot
+        self._current: Optional[Utterance] = None
+        self._acquiring: Optional[asyncio.Future] = None
+        # priority of the speech last handed to the track
+        self._track_priority = None
+        # streams still holding a scheduler slot
+        self._streams = set()
+        self.superseded = 0
+        self.expired = 0
         self.loop = asyncio.get_event_loop()
+        # agent.recorder.SessionRecorder of the meeting, when it is recorded
+        self.recorder = None
         self.processing_task = asyncio.create_task(self.process_queue())
 
+    def queued(self) -> int:
+        """Utterances not yet handed to the track."""
+        return len(self.pending) + (self._current is not None)
+
+    def _stale(self, utterance: Utterance) -> bool:
+        return utterance.reply < self._stale_below[utterance.priority]
+
+    def _drop_stale(self) -> int:
+        kept = [u for u in self.pending if not self._stale(u)]
+        dropped = len(self.pending) - len(kept)
+        self.pending = kept
+        if self._current is not None and self._stale(self._current) and self._acquiring is not None:
+            self._acquiring.cancel()
+        return dropped
+
+    def _expire(self, utterance: Utterance):
+        # the rest of the reply would make no sense without it
+        stale_below = self._stale_below[utterance.priority]
+        self._stale_below[utterance.priority] = max(stale_below, utterance.reply + 1)
+        self.expired += 1 + self._drop_stale()
+
     async def process_queue(self):
         while True:
-            text = await self.queue.get()
+            if not self.pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            utterance = self._current = self.pending.pop(0)
+            try:
+                await self._synthesize(utterance)
+            except Exception:
+                logger.exception("Error while synthesizing speech")
+            finally:
+                self._current = None
+
+    async def _synthesize(self, utterance: Utterance):
+        if self._stale(utterance):
+            self.superseded += 1
+            return
+        if time.monotonic() > utterance.deadline:
+            self._expire(utterance)
+            return
+        text = utterance.text
+        audio = utterance.audio
+        if audio is None and self.cache:
+            audio = self.cache.get(self.cache_key(text))
+        if audio is not None:
+            if self.recorder is not None:
+                self.recorder.tts_request(text, cached=True)
+            self._play(utterance, self._playable([audio]))
+            return
+
+        self._acquiring = asyncio.ensure_future(self.scheduler.acquire(self, utterance.priority, utterance.deadline))
+        try:
+            granted = await self._acquiring
+        except asyncio.CancelledError:
+            if asyncio.current_task().cancelling():
+                raise
+            # superseded while waiting
+            granted = False
+        finally:
+            self._acquiring = None
+        if self._stale(utterance):
+            self.superseded += 1
+            if granted:
+                self.scheduler.release(self)
+            return
+        if not granted:
+            self._expire(utterance)
+            return
+
+        try:
+            key = self.cache_key(text)
+            on_chunk = None
+            if self.recorder is not None:
+                on_chunk = partial(self.recorder.tts_chunk, self.recorder.tts_request(text, cached=False))
+            started = time.monotonic()
             # Run synchronous generation in executor
             tts_bytes = await self.loop.run_in_executor(
-                None, 
+                None,
                 self._generate_sync,
                 text
             )
-            self.output_track.add_new_bytes(tts_bytes)
-            self.queue.task_done()
+        except BaseException:
+            self.scheduler.release(self)
+            raise
+        if self._stale(utterance):
+            # superseded or cancelled while the request was being made
+            self.superseded += 1
+            self.scheduler.release(self)
+            await close_stream(tts_bytes)
+            return
+        if self.cache:
+            tts_bytes = self.cache.record(key, tts_bytes)
+        tts_bytes = self._playable(tts_bytes)
+        on_first_chunk = None
+        if utterance.turn is not None:
+            on_first_chunk = partial(utterance.turn.span, "tts_first_byte", started)
+        stream = PrefetchedStream(tts_bytes, self.loop, on_first_chunk=on_first_chunk, on_chunk=on_chunk,
+                                  on_done=self._stream_done)
+        self._streams.add(stream)
+        self._play(utterance, stream)
+
+    def _stream_done(self, stream):
+        self._streams.discard(stream)
+        self.scheduler.release(self)
+
+    def _play(self, utterance: Utterance, chunks):
+        interrupt = utterance.interrupt
+        if interrupt and self._track_priority is not None and self._track_priority < utterance.priority \
+                and self.output_track.is_speaking():
+            # small talk waits for the move commentary to finish
+            interrupt = False
+        self._track_priority = utterance.priority
+        self.output_track.add_new_bytes(chunks, interrupt=interrupt, turn=utterance.turn)
+
+    def _playable(self, chunks):
+        """Chunks in the output format as pcm at the track's rate, converted
+        on the reader thread that pulls them."""
+        converter = PcmConverter(self.output_format, self.output_track.sample_rate)
+        if converter.passthrough:
+            return chunks
+        return converter.stream(chunks)
+
+    def cache_key(self, text):
+        return PcmCache.key(text, self.voice, self.model, self.output_format, self.voice_settings)
 
     def _generate_sync(self, text):
         """Synchronous generation method"""
-        print(f"Generating TTS for: {text}")
+        logger.debug("Generating TTS for: %s", text)
         return self.elevenlabs_client.generate(
             text=text,
-            voice="Will",
+            voice=self.voice,
             stream=True,
-            output_format="pcm_24000",
+            output_format=self.output_format,
             model=self.model,
-            voice_settings=VoiceSettings(
-                stability=0.71, 
-                similarity_boost=0.5, 
-                style=0.0, 
-                use_speaker_boost=True
-                
-            )
+            voice_settings=self.voice_settings
+        )
+
+    async def generate(self, text, interrupt=True, audio=None, priority=CHAT):
+        """Async interface for adding to queue. With interrupt=False the audio
+        plays after what is already queued on the track, as part of the same
+        reply. `audio` is what render() returned for `text`."""
+        if interrupt:
+            # a new reply, older ones of the same or lower priority are superseded
+            self._reply += 1
+            for p in self._stale_below:
+                if p >= priority:
+                    self._stale_below[p] = self._reply
+            self.superseded += self._drop_stale()
+        self._seq += 1
+        utterance = Utterance(self._seq, text, priority, interrupt, audio, self._reply, current_turn.get())
+        if self._stale(utterance):
+            # the rest of a reply that was superseded or ran out of time
+            self.superseded += 1
+            return
+        bisect.insort(self.pending, utterance, key=lambda u: (u.priority, u.seq))
+        self._wakeup.set()
+
+    def cancel(self):
+        """Drops queued and in-flight speech, what is already on the track is
+        left to the caller."""
+        for p in self._stale_below:
+            # including the rest of the current reply, the next one starts fresh
+            self._stale_below[p] = self._reply + 1
+        self.superseded += self._drop_stale()
+
+    async def render(self, text, priority=PREPARE):
+        """Synthesizes `text` into memory without playing it, None if no
+        slot could be had in time."""
+        if self.cache:
+            cached = self.cache.get(self.cache_key(text))
+            if cached is not None:
+                return cached
+        if not await self.scheduler.acquire(self, priority, time.monotonic() + TTS_DEADLINE_S):
+            return None
+        try:
+            tts_bytes = await self.loop.run_in_executor(None, self._generate_sync, text)
+            return b"".join([chunk async for chunk in read_chunks(tts_bytes, self.loop)])
+        finally:
+            self.scheduler.release(self)
+
+    def stats(self) -> dict:
+        return {"tts_queue": self.queued(), "tts_superseded": self.superseded, "tts_expired": self.expired}
+
+    def close(self):
+        self.processing_task.cancel()
+        for stream in list(self._streams):
+            stream.cancel()
+
+
+def get_pcm_cache() -> Optional[PcmCache]:
+    global _pcm_cache
+    if _pcm_cache is None and TTS_CACHE_MAX_BYTES > 0:
+        _pcm_cache = PcmCache(TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES)
+    return _pcm_cache
+
+
+def get_tts_scheduler() -> TtsScheduler:
+    global _tts_scheduler
+    if _tts_scheduler is None:
+        _tts_scheduler = TtsScheduler()
+    return _tts_scheduler
+
+
+def warm_up(phrases: List[str]):
+    """Render phrases into the pcm cache so they play without a tts request."""
+    cache = get_pcm_cache()
+    if cache is None:
+        raise SystemExit("The TTS cache is disabled (TTS_CACHE_MAX_MB=0), there is nothing to warm up")
+    client = ElevenLabs(api_key=api_key, base_url=base_url)
+    output_format = negotiate_format(AUDIO_SAMPLE_RATE, OUTPUT_FORMAT)
+    for phrase in phrases:
+        key = PcmCache.key(phrase, VOICE, MODEL, output_format, VOICE_SETTINGS)
+        if key in cache:
+            print(f"Cached: {phrase}")
+            continue
+        print(f"Rendering: {phrase}")
+        stream = client.generate(
+            text=phrase,
+            voice=VOICE,
+            stream=True,
+            output_format=output_format,
+            model=MODEL,
+            voice_settings=VOICE_SETTINGS
         )
+        for _ in cache.record(key, stream):
+            pass
+
 
-    async def generate(self, text):
-        """Async interface for adding to queue"""
-        await self.queue.put(text)
\ No newline at end of file
+# python -m tts.elevenlabs warm-up [phrases.txt]
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2 or sys.argv[1] != "warm-up":
+        print("usage: python -m tts.elevenlabs warm-up [phrases.txt]")
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            phrases = [line.strip() for line in f if line.strip()]
+    else:
+        from intelligence.intelligence import CANNED_COMMENTS
+        phrases = list(CANNED_COMMENTS)
+    warm_up(phrases)
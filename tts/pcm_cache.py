@@ -0,0 +1,134 @@
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Iterator, Optional
+
+from tts.audio_format import CODECS
+
+
+class PcmCache:
+    """Content addressed on-disk cache of rendered tts audio.
+
+    Files are named by a hash of everything that affects the audio, with
+    the codec as the extension (.pcm, .ulaw, .mp3), and are
+    evicted least recently used first once the cache exceeds `max_bytes`.
+    Hits are returned as memoryviews over a read-only mmap of the file.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key -> file size, oldest first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+
+        os.makedirs(directory, exist_ok=True)
+        files = []
+        for name in os.listdir(directory):
+            if name.rpartition(".")[2] in CODECS:
+                stat = os.stat(os.path.join(directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+            elif name.endswith(".tmp"):
+                # left over from an interrupted write
+                os.remove(os.path.join(directory, name))
+        for _, key, size in sorted(files):
+            self._entries[key] = size
+            self._size += size
+
+    @staticmethod
+    def key(text: str, voice: str, model: str, output_format: str, voice_settings) -> str:
+        if hasattr(voice_settings, "model_dump"):
+            voice_settings = voice_settings.model_dump()
+        elif hasattr(voice_settings, "dict"):
+            voice_settings = voice_settings.dict()
+        material = json.dumps(
+            [text.strip(), voice, model, output_format, voice_settings],
+            sort_keys=True,
+        )
+        return f"{hashlib.sha256(material.encode('utf-8')).hexdigest()}.{output_format.split('_')[0]}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[memoryview]:
+        with self._lock:
+            if key not in self._entries or self._entries[key] == 0:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # keeps the eviction order across restarts
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(key)
+            return None
+        return memoryview(data)
+
+    def put(self, key: str, data: bytes):
+        for _ in self.record(key, [data]):
+            pass
+
+    def record(self, key: str, chunks) -> Iterator[bytes]:
+        """Pass chunks through while writing them to the cache. The entry is
+        only stored if the stream is read to the end."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        size = 0
+        complete = False
+        with os.fdopen(fd, "wb") as f:
+            try:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+                complete = True
+            finally:
+                if not complete:
+                    f.close()
+                    os.remove(tmp_path)
+                    close = getattr(chunks, "close", None)
+                    if close is not None:
+                        close()
+        os.replace(tmp_path, self._path(key))
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = size
+            self._size += size
+            self._evict()
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self):
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                # open mmaps of the file stay valid after unlink
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
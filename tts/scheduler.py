@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import os
+import time
+from typing import Dict, List
+
+# tts requests to the vendor at once across all meetings, a request holds its
+# slot until its audio stream is read to the end
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "8"))
+# tts requests started per second across all meetings, 0 = no limit
+TTS_RATE_LIMIT = float(os.getenv("TTS_RATE_LIMIT", "0"))
+# speech that could not be started this many seconds after it was queued is dropped
+TTS_DEADLINE_S = float(os.getenv("TTS_DEADLINE_S", "4"))
+
+# utterance priorities, lower goes first
+MOVE = 0      # commentary on a move
+CHAT = 1      # small talk
+PREPARE = 2   # speculative renders nobody is waiting for yet
+PRIORITY_NAMES = {MOVE: "move", CHAT: "chat", PREPARE: "prepare"}
+
+
+class _Waiter:
+    __slots__ = ("lane", "priority", "seq", "since", "future")
+
+    def __init__(self, lane, priority: int, seq: int, future: asyncio.Future):
+        self.lane = lane
+        self.priority = priority
+        self.seq = seq
+        self.since = time.monotonic()
+        self.future = future
+
+
+class TtsScheduler:
+    """Hands out the process's tts request slots.
+
+    At most `concurrency` requests are out at once and at most `rate` are
+    started per second. A free slot goes to the most important waiter; on a
+    tie to the one whose lane (meeting) holds the fewest slots, so one
+    talkative meeting can't starve the others; then first come first
+    served. A waiter still waiting at its deadline gets no slot.
+    """
+
+    def __init__(self, concurrency: int = TTS_CONCURRENCY, rate: float = TTS_RATE_LIMIT):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.in_flight = 0
+        # lane -> slots it holds
+        self.held: Dict[object, int] = {}
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        # earliest start of the next request under the rate limit
+        self._next_start = 0.0
+        self._timer = None
+        self.granted = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.expired = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.wait_s = 0.0
+
+    async def acquire(self, lane, priority: int, deadline: float) -> bool:
+        """Waits for a slot until `deadline` (monotonic), returns whether one
+        was granted. A granted slot must be given back with release()."""
+        loop = asyncio.get_running_loop()
+        waiter = _Waiter(lane, priority, next(self._seq), loop.create_future())
+        self._waiters.append(waiter)
+        self._dispatch()
+        expiry = loop.call_later(max(deadline - time.monotonic(), 0.0), self._expire, waiter)
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.result():
+                # granted just as the caller gave up
+                self.release(lane)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            expiry.cancel()
+
+    def release(self, lane):
+        self.in_flight -= 1
+        held = self.held.get(lane, 0) - 1
+        if held > 0:
+            self.held[lane] = held
+        else:
+            self.held.pop(lane, None)
+        self._dispatch()
+
+    def _expire(self, waiter: _Waiter):
+        if waiter.future.done():
+            return
+        self._waiters.remove(waiter)
+        self.expired[waiter.priority] += 1
+        waiter.future.set_result(False)
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiters and self.in_flight < self.concurrency:
+            waiter = min(self._waiters, key=lambda w: (w.priority, self.held.get(w.lane, 0), w.seq))
+            if waiter.future.done():
+                # cancelled, its task has not unwound yet
+                self._waiters.remove(waiter)
+                continue
+            if self.rate > 0:
+                now = time.monotonic()
+                if now < self._next_start:
+                    if self._timer is None:
+                        self._timer = asyncio.get_running_loop().call_later(self._next_start - now, self._wake)
+                    return
+                self._next_start = now + 1 / self.rate
+            self._waiters.remove(waiter)
+            self.in_flight += 1
+            self.held[waiter.lane] = self.held.get(waiter.lane, 0) + 1
+            self.granted[waiter.priority] += 1
+            self.wait_s += time.monotonic() - waiter.since
+            waiter.future.set_result(True)
+
+    def stats(self) -> dict:
+        granted = sum(self.granted.values())
+        return {
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "granted": {PRIORITY_NAMES[p]: n for p, n in self.granted.items()},
+            "expired": {PRIORITY_NAMES[p]: n for p, n in self.expired.items()},
+            "mean_wait_ms": round(1000 * self.wait_s / granted, 1) if granted else None,
+        }